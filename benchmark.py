@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+#
+# Replay recorded frames through the ImageWorker processing chain
+#
+# No INDI server, main loop or upload queue is needed, the database is
+# SQLite in memory.  Each config profile runs in a separate process so the
+# peak RSS is reported per profile.
+#
+
+import sys
+import types
+import json
+import time
+import shutil
+import tempfile
+import resource
+import argparse
+import queue
+import logging
+from pathlib import Path
+from collections import OrderedDict
+from multiprocessing import Process
+from multiprocessing import Queue
+from multiprocessing import Value
+
+# The package __init__ imports the camera clients, which require PyIndi and
+# create a flask app for the production DB at import time.  The package is
+# registered without running __init__ so only the processing modules load.
+indi_allsky = types.ModuleType('indi_allsky')
+indi_allsky.__path__ = [str(Path(__file__).parent.absolute().joinpath('indi_allsky'))]
+sys.modules['indi_allsky'] = indi_allsky
+
+from indi_allsky.image import ImageWorker  # noqa: E402
+from indi_allsky.frameQueue import IndiAllSkyFrameQueue  # noqa: E402
+from indi_allsky.flask import create_app  # noqa: E402
+from indi_allsky.flask.miscDb import miscDb  # noqa: E402
+
+try:
+    from astropy.io import fits
+except ImportError:
+    fits = None
+
+
+logger = logging.getLogger('indi_allsky')
+# logger config in indi_allsky/flask/__init__.py
+
+LOG_FORMATTER_STREAM = logging.Formatter('%(asctime)s [%(levelname)s] %(processName)s %(module)s.%(funcName)s() #%(lineno)d: %(message)s')
+
+LOG_HANDLER_STREAM = logging.StreamHandler()
+LOG_HANDLER_STREAM.setFormatter(LOG_FORMATTER_STREAM)
+
+logger.handlers.clear()  # remove syslog
+logger.addHandler(LOG_HANDLER_STREAM)
+
+
+
+class IndiAllSkyBenchmark(object):
+
+    frame_suffixes = {
+        '.fit'  : '.fit',
+        '.fits' : '.fit',
+        '.dng'  : '.dng',
+        '.jpg'  : '.jpg',
+        '.jpeg' : '.jpg',
+        '.png'  : '.png',
+    }
+
+    profiles = OrderedDict({
+        'default'        : {},
+        'clahe_off'      : {
+            'NIGHT_CONTRAST_ENHANCE'    : False,
+            'DAYTIME_CONTRAST_ENHANCE'  : False,
+        },
+        'clahe_on'       : {
+            'NIGHT_CONTRAST_ENHANCE'    : True,
+            'DAYTIME_CONTRAST_ENHANCE'  : True,
+        },
+        'stars_off'      : {
+            'DETECT_STARS'              : False,
+            'DETECT_METEORS'            : False,
+        },
+        'stars_on'       : {
+            'DETECT_STARS'              : True,
+            'DETECT_METEORS'            : True,
+        },
+        'scnr_average'   : {
+            'SCNR_ALGORITHM'            : 'average_neutral',
+        },
+        'scnr_maximum'   : {
+            'SCNR_ALGORITHM'            : 'maximum_neutral',
+        },
+        'scale_50'       : {
+            'IMAGE_SCALE'               : 50,
+        },
+        'scale_25'       : {
+            'IMAGE_SCALE'               : 25,
+        },
+    })
+
+
+    def __init__(self, f_config_file, frame_dir):
+        self.config = json.loads(f_config_file.read(), object_pairs_hook=OrderedDict)
+        f_config_file.close()
+
+        self.frame_dir = Path(frame_dir)
+
+        self._exposure = 15.0
+        self._night = True
+        self._iterations = 1
+
+
+    @property
+    def exposure(self):
+        return self._exposure
+
+    @exposure.setter
+    def exposure(self, new_exposure):
+        self._exposure = float(new_exposure)
+
+
+    @property
+    def night(self):
+        return self._night
+
+    @night.setter
+    def night(self, new_night):
+        self._night = bool(new_night)
+
+
+    @property
+    def iterations(self):
+        return self._iterations
+
+    @iterations.setter
+    def iterations(self, new_iterations):
+        self._iterations = int(new_iterations)
+
+
+    def main(self, profile_list):
+        frame_list = sorted([p for p in self.frame_dir.iterdir() if p.suffix.lower() in self.frame_suffixes.keys()])
+        if not frame_list:
+            logger.error('No frames found in %s', self.frame_dir)
+            sys.exit(1)
+
+        logger.warning('Found %d frames', len(frame_list))
+
+
+        result_list = list()
+        for profile in profile_list:
+            result_q = Queue()
+
+            p = Process(target=self.runProfile, args=(profile, frame_list, result_q), name='Benchmark-{0:s}'.format(profile))
+            p.start()
+            p.join()
+
+            try:
+                result = result_q.get(timeout=5.0)
+            except queue.Empty:
+                result = None
+
+            if not result:
+                logger.error('Profile %s failed', profile)
+                continue
+
+            result_list.append(result)
+
+
+        self.report(result_list)
+
+
+    def runProfile(self, profile, frame_list, result_q):
+        try:
+            result = self._runProfile(profile, frame_list)
+        except Exception:
+            logger.exception('Profile %s exception', profile)
+            result = None
+
+        result_q.put(result)
+
+
+    def _runProfile(self, profile, frame_list):
+        tmp_dir = tempfile.TemporaryDirectory(prefix='indi_allsky_benchmark_')
+        tmp_dir_p = Path(tmp_dir.name)
+
+
+        # in memory database
+        flask_config = {
+            'SQLALCHEMY_DATABASE_URI'        : 'sqlite://',
+            'SQLALCHEMY_TRACK_MODIFICATIONS' : False,
+            'SECRET_KEY'                     : 'benchmark',
+            'MIGRATION_FOLDER'               : str(tmp_dir_p.joinpath('migrations')),
+        }
+
+        app = create_app(config_overrides=flask_config)
+        app.app_context().push()
+
+
+        config = json.loads(json.dumps(self.config), object_pairs_hook=OrderedDict)  # deep copy
+        config.update(self.profiles[profile])
+
+        config['CCD_NAME'] = 'benchmark'
+        config['IMAGE_FOLDER'] = str(tmp_dir_p.joinpath('images'))
+        config['IMAGE_SAVE_FITS'] = False
+        config['IMAGE_EXPORT_RAW'] = ''
+        config['IMAGE_TIMING_CSV'] = ''
+        config.setdefault('FILETRANSFER', {})['UPLOAD_IMAGE'] = 0
+        config['FILETRANSFER']['UPLOAD_METADATA'] = False
+        config.setdefault('MQTTPUBLISH', {})['ENABLE'] = False
+
+
+        camera = miscDb(config).addCamera(config['CCD_NAME'])
+
+
+        image_worker = ImageWorker(
+            0,
+            config,
+            Queue(),  # error_q
+            IndiAllSkyFrameQueue(config),  # image_q
+            Queue(),  # upload_q
+            Value('f', float(config['LOCATION_LATITUDE'])),
+            Value('f', float(config['LOCATION_LONGITUDE'])),
+            Value('f', 0.0),
+            Value('f', 0.0),
+            Value('f', self.exposure),
+            Value('i', int(config['CCD_CONFIG']['NIGHT']['GAIN'])),
+            Value('i', int(config['CCD_CONFIG']['NIGHT']['BINNING'])),
+            Value('f', 0.0),
+            Value('i', int(self.night)),
+            Value('i', 0),
+        )
+
+        image_worker.status_json_file = str(tmp_dir_p.joinpath('indi_allsky_status.json'))
+        image_worker.timing_json_file = str(tmp_dir_p.joinpath('indi_allsky_timing.json'))
+
+
+        frame_count = 0
+        processing_elapsed_s = 0.0
+
+        # frames are one second apart for unique file names
+        start_time = time.time() - (len(frame_list) * self.iterations)
+
+        for i in range(self.iterations):
+            for frame_p in frame_list:
+                # the worker deletes the frame after reading it
+                frame_tmp_p = tmp_dir_p.joinpath('frame{0:s}'.format(self.frame_suffixes[frame_p.suffix.lower()]))
+                shutil.copy2(str(frame_p), str(frame_tmp_p))
+
+                i_dict = {
+                    'filename'    : str(frame_tmp_p),
+                    'exposure'    : self._getExposure(frame_p),
+                    'exp_time'    : start_time + frame_count,
+                    'exp_elapsed' : 0.0,
+                    'camera_id'   : camera.id,
+                    'filename_t'  : None,
+                }
+
+                start = time.time()
+
+                image_worker.processImage(i_dict)
+
+                processing_elapsed_s += time.time() - start
+                frame_count += 1
+
+
+        tmp_dir.cleanup()
+
+
+        result = {
+            'profile'   : profile,
+            'frames'    : frame_count,
+            'elapsed'   : processing_elapsed_s,
+            'fps'       : frame_count / processing_elapsed_s,
+            'rss_mb'    : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,  # kilobytes on linux
+            'stages'    : image_worker._stage_timer.summary()['stages'],
+        }
+
+        return result
+
+
+    def report(self, result_list):
+        for result in result_list:
+            logger.warning('Profile: %s', result['profile'])
+            logger.warning(' Frames: %d in %0.2f s, %0.3f frames/s', result['frames'], result['elapsed'], result['fps'])
+            logger.warning(' Peak RSS: %0.1f MB', result['rss_mb'])
+
+            for stage, stats in result['stages'].items():
+                logger.warning(
+                    '  %-14s p50 %0.4f s, p95 %0.4f s, max %0.4f s',
+                    stage,
+                    stats['p50'],
+                    stats['p95'],
+                    stats['max'],
+                )
+
+
+        logger.warning('Summary')
+        logger.warning(' %-16s %10s %10s', 'profile', 'frames/s', 'rss MB')
+        for result in result_list:
+            logger.warning(' %-16s %10.3f %10.1f', result['profile'], result['fps'], result['rss_mb'])
+
+
+    def _getExposure(self, frame_p):
+        if frame_p.suffix.lower() not in ('.fit', '.fits') or not fits:
+            return self.exposure
+
+        with fits.open(frame_p) as hdulist:
+            return float(hdulist[0].header.get('EXPTIME', self.exposure))
+
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        'frame_dir',
+        help='folder of recorded frames (fit, dng, jpg, png)',
+        type=str,
+    )
+    argparser.add_argument(
+        '--config',
+        '-c',
+        help='config file',
+        type=argparse.FileType('r'),
+        default='/etc/indi-allsky/config.json',
+    )
+    argparser.add_argument(
+        '--profile',
+        '-p',
+        help='config profile (default all)',
+        choices=tuple(IndiAllSkyBenchmark.profiles.keys()),
+        action='append',
+    )
+    argparser.add_argument(
+        '--exposure',
+        '-e',
+        help='exposure when not in the frame header',
+        type=float,
+        default=15.0,
+    )
+    argparser.add_argument(
+        '--iterations',
+        '-i',
+        help='number of passes over the frames',
+        type=int,
+        default=1,
+    )
+    argparser.add_argument(
+        '--day',
+        help='process frames as daytime images',
+        action='store_true',
+    )
+    argparser.add_argument(
+        '--verbose',
+        '-v',
+        help='log image processing',
+        action='store_true',
+    )
+
+
+    args = argparser.parse_args()
+
+
+    if args.verbose:
+        logger.setLevel(logging.INFO)
+    else:
+        logger.setLevel(logging.WARNING)
+
+
+    if args.profile:
+        profile_list = args.profile
+    else:
+        profile_list = list(IndiAllSkyBenchmark.profiles.keys())
+
+
+    b = IndiAllSkyBenchmark(args.config, args.frame_dir)
+    b.exposure = args.exposure
+    b.iterations = args.iterations
+    b.night = not args.day
+
+    b.main(profile_list)
+
+
+# vim let=g:syntastic_python_flake8_args='--ignore="E203,E303,E501,E265,E266,E201,E202,W391"'
+# vim: set tabstop=4 shiftwidth=4 expandtab
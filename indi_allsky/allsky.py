@@ -31,6 +31,9 @@ from . import camera as camera_module
 from .image import ImageWorker
 from .video import VideoWorker
 from .uploader import FileUploader
+from .frameRing import IndiAllSkyFrameRing
+from .imageState import IndiAllSkyImageState
+from .frameQueue import IndiAllSkyFrameQueue
 
 from .exceptions import TimeOutException
 from .exceptions import TemperatureException
@@ -94,10 +97,17 @@ class IndiAllSky(object):
         self.night_sun_radians = math.radians(self.config['NIGHT_SUN_ALT_DEG'])
         self.night_moonmode_radians = math.radians(self.config['NIGHT_MOONMODE_ALT_DEG'])
 
-        self.image_q = Queue()
+        if self.config.get('FRAME_TRANSPORT', 'file') == 'shm':
+            # pass image data in shared memory instead of temporary files
+            self.frame_ring = IndiAllSkyFrameRing(self.config.get('FRAME_RING_SLOTS', 3))
+        else:
+            self.frame_ring = None
+
+        self.image_q = IndiAllSkyFrameQueue(self.config, frame_ring=self.frame_ring)  # bounded
         self.image_error_q = Queue()
-        self.image_worker = None
+        self.image_worker_list = [None] * int(self.config.get('IMAGE_WORKERS', 1))
         self.image_worker_idx = 0
+        self.image_state = IndiAllSkyImageState()  # shared between image workers
 
         self.video_q = Queue()
         self.video_error_q = Queue()
@@ -349,6 +359,8 @@ class IndiAllSky(object):
             self.bin_v,
         )
 
+        self.indiclient.frame_ring = self.frame_ring
+
         # set indi server localhost and port
         self.indiclient.setServer(self.config['INDI_SERVER'], self.config['INDI_PORT'])
 
@@ -580,56 +592,65 @@ class IndiAllSky(object):
 
 
     def _startImageWorker(self):
-        if self.image_worker:
-            if self.image_worker.is_alive():
-                return
-
-            try:
-                image_error, image_traceback = self.image_error_q.get_nowait()
-                for line in image_traceback.split('\n'):
-                    logger.error('Image worker exception: %s', line)
-            except queue.Empty:
-                pass
-
+        for i, image_worker in enumerate(self.image_worker_list):
+            if image_worker:
+                if image_worker.is_alive():
+                    continue
 
-        self.image_worker_idx += 1
+                try:
+                    image_error, image_traceback = self.image_error_q.get_nowait()
+                    for line in image_traceback.split('\n'):
+                        logger.error('Image worker exception: %s', line)
+                except queue.Empty:
+                    pass
+
+
+            self.image_worker_idx += 1
+
+            logger.info('Starting ImageWorker process %d', self.image_worker_idx)
+            image_worker = ImageWorker(
+                self.image_worker_idx,
+                self.config,
+                self.image_error_q,
+                self.image_q,
+                self.upload_q,
+                self.latitude_v,
+                self.longitude_v,
+                self.ra_v,
+                self.dec_v,
+                self.exposure_v,
+                self.gain_v,
+                self.bin_v,
+                self.sensortemp_v,
+                self.night_v,
+                self.moonmode_v,
+                self.frame_ring,
+                self.image_state,
+                worker_slot=i,
+            )
+            image_worker.start()
 
-        logger.info('Starting ImageWorker process')
-        self.image_worker = ImageWorker(
-            self.image_worker_idx,
-            self.config,
-            self.image_error_q,
-            self.image_q,
-            self.upload_q,
-            self.latitude_v,
-            self.longitude_v,
-            self.ra_v,
-            self.dec_v,
-            self.exposure_v,
-            self.gain_v,
-            self.bin_v,
-            self.sensortemp_v,
-            self.night_v,
-            self.moonmode_v,
-        )
-        self.image_worker.start()
+            self.image_worker_list[i] = image_worker
 
 
     def _stopImageWorker(self, terminate=False):
-        if not self.image_worker:
-            return
+        active_worker_list = [w for w in self.image_worker_list if w and w.is_alive()]
 
-        if not self.image_worker.is_alive():
+        if not active_worker_list:
             return
 
         if terminate:
-            logger.info('Terminating ImageWorker process')
-            self.image_worker.terminate()
+            logger.info('Terminating ImageWorker processes')
+            for image_worker in active_worker_list:
+                image_worker.terminate()
 
-        logger.info('Stopping ImageWorker process')
+        logger.info('Stopping ImageWorker processes')
 
-        self.image_q.put({'stop' : True})
-        self.image_worker.join()
+        for image_worker in active_worker_list:
+            self.image_q.put({'stop' : True})
+
+        for image_worker in active_worker_list:
+            image_worker.join()
 
 
     def _startVideoWorker(self):
@@ -847,6 +868,9 @@ class IndiAllSky(object):
 
                     self.indiclient.disconnectServer()
 
+                    if self.frame_ring:
+                        self.frame_ring.close()
+
                     sys.exit()
 
 
@@ -867,8 +891,6 @@ class IndiAllSky(object):
             loop_end = time.time() + 11
 
             while True:
-                time.sleep(0.05)
-
                 now = time.time()
                 if now >= loop_end:
                     break
@@ -877,6 +899,8 @@ class IndiAllSky(object):
                 camera_ready, exposure_state = self.indiclient.getCcdExposureStatus()
 
                 if not camera_ready:
+                    # wait for the exposure to complete
+                    self.indiclient.waitCcdExposure(loop_end - now)
                     continue
 
                 ###########################################
@@ -907,6 +931,9 @@ class IndiAllSky(object):
 
                     self.indiclient.disconnectServer()
 
+                    if self.frame_ring:
+                        self.frame_ring.close()
+
                     sys.exit()
 
 
@@ -949,8 +976,18 @@ class IndiAllSky(object):
                     else:
                         next_frame_time = frame_start_time + self.config['EXPOSURE_PERIOD_DAY']
 
+
+                    if self.image_q.saturated():
+                        # give image processing time to catch up
+                        logger.warning('Image queue backlog (%d frames), doubling exposure period', self.image_q.qsize())
+                        next_frame_time += next_frame_time - frame_start_time
+
                     logger.info('Total time since last exposure %0.4f s', total_elapsed)
 
+                else:
+                    # sleep until the next exposure, wake periodically for shutdown and restart
+                    time.sleep(min(next_frame_time - now, loop_end - now, 1.0))
+
 
             loop_elapsed = now - loop_start_time
             logger.debug('Loop completed in %0.4f s', loop_elapsed)
@@ -1920,6 +1957,20 @@ class IndiAllSky(object):
             .filter(IndiAllSkyDbTaskQueueTable.state.in_(orphaned_statuses))
 
         for task in old_task_list:
+            if task.queue == TaskQueueQueue.UPLOAD:
+                if task.state == TaskQueueState.QUEUED and task.data.get('retry'):
+                    # spooled uploads are retried by the uploader
+                    continue
+
+                if task.data.get('remove_local'):
+                    # temporary files are only removed by the uploader
+                    try:
+                        Path(task.data['local_file']).unlink()
+                    except FileNotFoundError:
+                        pass
+                    except PermissionError as e:
+                        logger.error('Cannot remove local file: %s', str(e))
+
             logger.warning('Expiring orphaned task %d', task.id)
             task.state = TaskQueueState.EXPIRED
 
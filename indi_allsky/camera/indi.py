@@ -1,5 +1,6 @@
 import time
 import io
+import threading
 import tempfile
 import ctypes
 from datetime import datetime
@@ -14,7 +15,7 @@ import PyIndi
 from .fake_indi import FakeIndiCcd
 
 #from ..flask import db
-from ..flask import create_app
+#from ..flask import create_app
 
 #from ..flask.models import TaskQueueQueue
 #from ..flask.models import TaskQueueState
@@ -26,7 +27,7 @@ from ..exceptions import CameraException
 logger = logging.getLogger('indi_allsky')
 
 
-app = create_app()
+#app = create_app()
 
 
 class IndiClient(PyIndi.BaseClient):
@@ -131,6 +132,10 @@ class IndiClient(PyIndi.BaseClient):
 
         self.exposureStartTime = None
 
+        self._frame_ring = None
+
+        self._exposure_event = threading.Event()  # set when the exposure data is received
+
         logger.info('creating an instance of IndiClient')
 
         pyindi_version = '.'.join((
@@ -192,6 +197,14 @@ class IndiClient(PyIndi.BaseClient):
     def filename_t(self, new_filename_t):
         self._filename_t = new_filename_t
 
+    @property
+    def frame_ring(self):
+        return self._frame_ring
+
+    @frame_ring.setter
+    def frame_ring(self, new_frame_ring):
+        self._frame_ring = new_frame_ring
+
 
     def newDevice(self, d):
         logger.info("new device %s", d.getDeviceName())
@@ -220,6 +233,31 @@ class IndiClient(PyIndi.BaseClient):
         blobfile = io.BytesIO(imgdata)
         hdulist = fits.open(blobfile)
 
+        exp_date = datetime.now()
+
+        if self.frame_ring:
+            # pass the image data to the worker in shared memory
+            frame_data = self.frame_ring.put(hdulist[0].data)
+
+            if frame_data:
+                jobdata = {
+                    'filename'    : None,
+                    'header'      : hdulist[0].header.tostring(),
+                    'exposure'    : self._exposure,
+                    'exp_time'    : datetime.timestamp(exp_date),  # datetime objects are not json serializable
+                    'exp_elapsed' : exposure_elapsed_s,
+                    'camera_id'   : self.config['DB_CCD_ID'],
+                    'filename_t'  : self._filename_t,
+                }
+                jobdata.update(frame_data)
+
+                self.image_q.put(jobdata)
+
+                self._exposure_event.set()
+
+                return
+
+
         try:
             f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.fit')
             f_tmpfile_p = Path(f_tmpfile.name)
@@ -236,8 +274,6 @@ class IndiClient(PyIndi.BaseClient):
         #elapsed_s = time.time() - start
         #logger.info('Blob downloaded in %0.4f s', elapsed_s)
 
-        exp_date = datetime.now()
-
         ### process data in worker
         jobdata = {
             'filename'    : str(f_tmpfile_p),
@@ -264,6 +300,8 @@ class IndiClient(PyIndi.BaseClient):
 
         self.image_q.put(jobdata)
 
+        self._exposure_event.set()
+
 
     def newSwitch(self, svp):
         logger.info("new Switch %s for device %s", svp.name, svp.device)
@@ -694,6 +732,8 @@ class IndiClient(PyIndi.BaseClient):
 
         self._exposure = exposure
 
+        self._exposure_event.clear()
+
         ctl_ccd_exposure = self.set_number(self._ccd_device, 'CCD_EXPOSURE', {'CCD_EXPOSURE_VALUE': exposure}, sync=sync, timeout=timeout)
 
         self._ctl_ccd_exposure = ctl_ccd_exposure
@@ -705,6 +745,16 @@ class IndiClient(PyIndi.BaseClient):
         return camera_ready, exposure_state
 
 
+    def waitCcdExposure(self, timeout):
+        # block until the exposure data is received instead of polling the exposure status
+        if self._exposure_event.is_set():
+            # data received, the exposure property state may not be updated yet
+            time.sleep(0.05)
+            return
+
+        self._exposure_event.wait(timeout=timeout)
+
+
     def getCcdGain(self):
         indi_exec = self._ccd_device.getDriverExec()
 
@@ -211,6 +211,18 @@ class IndiClientLibCameraGeneric(IndiClient):
         return True, 'READY'
 
 
+    def waitCcdExposure(self, timeout):
+        # block until libcamera-still exits instead of polling the process
+        if not self.libcamera_process:
+            time.sleep(0.05)
+            return
+
+        try:
+            self.libcamera_process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            pass
+
+
     def _queueImage(self):
         exposure_elapsed_s = time.time() - self.exposureStartTime
 
@@ -0,0 +1,157 @@
+import cv2
+import numpy
+import logging
+
+from .scnr import IndiAllskyScnr
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyColorPipeline(object):
+    # SCNR, white balance and CLAHE applied in place on the 8 bit image
+    #
+    # Work buffers are allocated on the first frame and reused as long as the
+    # image size does not change.  Color data is never split and merged.
+
+    clahe_clip_limit = 3.0
+    clahe_grid_size = (8, 8)
+
+
+    def __init__(self, config):
+        self.config = config
+
+        self._scnr = IndiAllskyScnr(self.config)  # fallback for algorithms not implemented here
+
+        self._clahe = cv2.createCLAHE(clipLimit=self.clahe_clip_limit, tileGridSize=self.clahe_grid_size)
+
+        self._buffers = dict()
+
+
+    def _buffer(self, name, shape, dtype):
+        buf = self._buffers.get(name)
+
+        if isinstance(buf, type(None)) or buf.shape != shape or buf.dtype != dtype:
+            logger.info('Allocating %s buffer %s', name, str(shape))
+            buf = numpy.empty(shape, dtype=dtype)
+            self._buffers[name] = buf
+
+        return buf
+
+
+    def prepare(self, scidata):
+        # the data must be a writable contiguous array to be modified in place
+        if len(scidata.shape) == 2:
+            return scidata
+
+        if scidata.flags.c_contiguous and scidata.flags.writeable:
+            return scidata
+
+        return scidata.copy()
+
+
+    def scnr(self, scidata, algorithm):
+        if len(scidata.shape) == 2:
+            # grayscale
+            return scidata
+
+        b = scidata[:, :, 0]
+        g = scidata[:, :, 1]
+        r = scidata[:, :, 2]
+
+        m = self._buffer('scnr_m', scidata.shape[:2], numpy.uint8)
+
+        if algorithm == 'average_neutral':
+            m16 = self._buffer('scnr_m16', scidata.shape[:2], numpy.uint16)
+            numpy.add(r, b, out=m16, dtype=numpy.uint16)
+            numpy.right_shift(m16, 1, out=m16)
+            numpy.copyto(m, m16, casting='unsafe')
+        elif algorithm == 'maximum_neutral':
+            numpy.maximum(r, b, out=m)
+        else:
+            scnr_function = getattr(self._scnr, algorithm)
+            return scnr_function(scidata)
+
+        numpy.minimum(g, m, out=g)
+
+        return scidata
+
+
+    def white_balance(self, scidata):
+        if len(scidata.shape) == 2:
+            # mono
+            return scidata
+
+
+        wb_factors = self._manual_wb_factors()
+
+        if self.config.get('AUTO_WB'):
+            # channel averages after the manual factors are applied
+            channel_avg = cv2.mean(scidata)[:3]
+            wb_avg = [avg * factor for avg, factor in zip(channel_avg, wb_factors)]
+
+            k = sum(wb_avg) / 3
+
+            auto_factors = list()
+            for avg in wb_avg:
+                try:
+                    auto_factors.append(k / avg)
+                except ZeroDivisionError:
+                    auto_factors.append(k / 0.1)
+
+            wb_factors = [factor * auto for factor, auto in zip(wb_factors, auto_factors)]
+
+
+        if wb_factors == [1.0, 1.0, 1.0]:
+            return scidata
+
+
+        # manual and auto gains in a single multiply
+        cv2.multiply(scidata, (wb_factors[0], wb_factors[1], wb_factors[2], 0.0), dst=scidata)
+
+        return scidata
+
+
+    def _manual_wb_factors(self):
+        if not self.config.get('WBB_FACTOR'):
+            logger.error('Missing WBB_FACTOR setting')
+            return [1.0, 1.0, 1.0]
+
+        if not self.config.get('WBG_FACTOR'):
+            logger.error('Missing WBG_FACTOR setting')
+            return [1.0, 1.0, 1.0]
+
+        if not self.config.get('WBR_FACTOR'):
+            logger.error('Missing WBR_FACTOR setting')
+            return [1.0, 1.0, 1.0]
+
+        return [
+            float(self.config['WBB_FACTOR']),
+            float(self.config['WBG_FACTOR']),
+            float(self.config['WBR_FACTOR']),
+        ]
+
+
+    def contrast_clahe(self, scidata):
+        ### ohhhh, contrasty
+        if len(scidata.shape) == 2:
+            # mono, a new array is returned since the data may still be referenced by the fits data
+            return self._clahe.apply(scidata)
+
+
+        # color, apply to luminance
+        lab = self._buffer('lab', scidata.shape, numpy.uint8)
+        l = self._buffer('l', scidata.shape[:2], numpy.uint8)
+        cl = self._buffer('cl', scidata.shape[:2], numpy.uint8)
+
+        cv2.cvtColor(scidata, cv2.COLOR_BGR2LAB, dst=lab)
+        cv2.extractChannel(lab, 0, dst=l)
+
+        self._clahe.apply(l, dst=cl)
+
+        cv2.insertChannel(cl, lab, 0)
+        cv2.cvtColor(lab, cv2.COLOR_LAB2BGR, dst=scidata)
+
+        return scidata
+
@@ -0,0 +1,162 @@
+import time
+import math
+from collections import OrderedDict
+import logging
+
+from .flask.models import IndiAllSkyDbBadPixelMapTable
+from .flask.models import IndiAllSkyDbDarkFrameTable
+
+from sqlalchemy import func
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyDarkCache(object):
+
+    temperature_bucket_size = 1.0  # degrees C
+
+
+    def __init__(self, config):
+        self.config = config
+
+        self._max_bytes = int(self.config.get('CALIBRATION_CACHE_MB', 128)) * 1024 * 1024
+
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+
+        self._db_signature = None
+        self._validate_interval = float(self.config.get('CALIBRATION_CACHE_CHECK', 300))
+        self._next_validate = 0.0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, new_max_bytes):
+        self._max_bytes = int(new_max_bytes)
+
+
+    def key(self, camera_id, bitdepth, gain, binmode, exposure, temp):
+        # Dark exposures are stored as integers and the closest dark with an exposure >= the
+        # light exposure is selected, so the ceiling of the exposure maps to the same dark
+        exposure_bucket = int(math.ceil(exposure))
+
+        temp_bucket = int(math.floor(temp / self.temperature_bucket_size))
+
+        return (int(camera_id), int(bitdepth), int(gain), int(binmode), exposure_bucket, temp_bucket)
+
+
+    def get(self, key):
+        # returns a tuple of (found, master_dark), master_dark is None when no dark was found for the key
+        try:
+            master_dark = self._cache[key]
+        except KeyError:
+            self.misses += 1
+            return False, None
+
+        self._cache.move_to_end(key)  # most recently used
+        self.hits += 1
+
+        return True, master_dark
+
+
+    def put(self, key, master_dark):
+        if key in self._cache:
+            self._remove(key)
+
+
+        if isinstance(master_dark, type(None)):
+            # negative entries prevent repeated lookups when darks do not exist
+            entry_bytes = 0
+        else:
+            entry_bytes = master_dark.nbytes
+
+            if entry_bytes > self._max_bytes:
+                logger.warning('Master dark (%d bytes) exceeds dark cache size, not caching', entry_bytes)
+                return
+
+            master_dark.flags.writeable = False  # cached data is shared between frames
+
+
+        while self._cache and (self._cache_bytes + entry_bytes) > self._max_bytes:
+            old_key = next(iter(self._cache))
+            self._remove(old_key)
+            self.evictions += 1
+
+
+        self._cache[key] = master_dark
+        self._cache_bytes += entry_bytes
+
+
+    def clear(self):
+        self._cache.clear()
+        self._cache_bytes = 0
+
+
+    def validate(self):
+        # Invalidate the cache when darks or bad pixel maps are added or removed
+        #
+        # The DB is only checked every CALIBRATION_CACHE_CHECK seconds, new darks are
+        # usually created with the camera stopped and the workers are restarted
+        now = time.time()
+        if now < self._next_validate:
+            return
+
+        self._next_validate = now + self._validate_interval
+
+        db_signature = self._getDbSignature()
+
+        if db_signature == self._db_signature:
+            return
+
+        if not isinstance(self._db_signature, type(None)):
+            logger.warning('Dark frames changed in DB, clearing dark cache')
+
+        self._db_signature = db_signature
+        self.clear()
+
+
+    def logStats(self):
+        logger.debug(
+            'Dark cache: %d hits, %d misses, %d evictions, %d entries, %0.1f MB',
+            self.hits,
+            self.misses,
+            self.evictions,
+            len(self._cache),
+            self._cache_bytes / 1024.0 / 1024.0,
+        )
+
+
+    def _remove(self, key):
+        master_dark = self._cache.pop(key)
+
+        if not isinstance(master_dark, type(None)):
+            self._cache_bytes -= master_dark.nbytes
+
+
+    def _getDbSignature(self):
+        dark_stats = IndiAllSkyDbDarkFrameTable.query\
+            .with_entities(
+                func.count(IndiAllSkyDbDarkFrameTable.id),
+                func.max(IndiAllSkyDbDarkFrameTable.id),
+                func.max(IndiAllSkyDbDarkFrameTable.createDate),
+            )\
+            .one()
+
+        bpm_stats = IndiAllSkyDbBadPixelMapTable.query\
+            .with_entities(
+                func.count(IndiAllSkyDbBadPixelMapTable.id),
+                func.max(IndiAllSkyDbBadPixelMapTable.id),
+                func.max(IndiAllSkyDbBadPixelMapTable.createDate),
+            )\
+            .one()
+
+        return tuple(dark_stats) + tuple(bpm_stats)
@@ -1,4 +1,5 @@
 import time
+import math
 import cv2
 import numpy
 import logging
@@ -14,6 +15,7 @@ class IndiAllskyDetectLines(object):
     canny_high_threshold = 50
 
     blur_kernel_size = 5
+    pyramid_blur_kernel_size = 3  # the downscaled image is already smoothed
 
     rho = 1  # distance resolution in pixels of the Hough grid
     theta = numpy.pi / 180  # angular resolution in radians of the Hough grid
@@ -23,6 +25,11 @@ class IndiAllskyDetectLines(object):
 
     mask_blur_kernel_size = 75
 
+    # temporal detection
+    background_decay = 0.9  # background is a decaying maximum of the previous frames
+    diff_pixel_threshold = 25  # brightening that counts as a changed pixel
+    scene_change_fraction = 0.05  # background is reset when more of the image changes (exposure, clouds)
+
 
     def __init__(self, config, bin_v, mask=None):
         self.config = config
@@ -30,9 +37,28 @@ class IndiAllskyDetectLines(object):
 
         self._sqm_mask = mask
         self._sqm_gradient_mask = None
+        self._sqm_gradient_rect = None
+
+        # 0 = full resolution, 1 = 2x downscale
+        # thin lines are lost at 4x downscale while cloud and moon edges are detected
+        self._pyramid_level = min(int(self.config.get('DETECT_PYRAMID_LEVEL', 0)), 1)
+
+        # only detect lines in the difference to the previous frames
+        self._temporal = bool(self.config.get('DETECT_METEORS_TEMPORAL'))
+        self._diff_min_pixels = int(self.config.get('DETECT_METEORS_DIFF_PIXELS', 100))
+
+        # the background is kept per process, image workers do not see consecutive frames
+        if self._temporal and int(self.config.get('IMAGE_WORKERS', 1)) > 1:
+            logger.warning('DETECT_METEORS_TEMPORAL is not supported with IMAGE_WORKERS > 1, using single frame line detection')
+            self._temporal = False
+
+        self._background = None
+        self._background_date = None
 
+        self.frame_pair = None  # exposure dates of the frames compared for the last detection
 
-    def detectLines(self, original_img):
+
+    def detectLines(self, original_img, exp_date=None):
         if isinstance(self._sqm_mask, type(None)):
             # This only needs to be done once if a mask is not provided
             self._generateSqmMask(original_img)
@@ -42,34 +68,61 @@ class IndiAllskyDetectLines(object):
             self._generateSqmGradientMask(original_img)
 
 
-        # apply the gradient to the image
-        masked_img = (original_img * self._sqm_gradient_mask).astype(numpy.uint8)
+        # only the bounding rectangle of the gradient mask is processed
+        x, y, w, h = self._sqm_gradient_rect
+        roi_img = original_img[y:y + h, x:x + w]
 
 
         if len(original_img.shape) == 2:
-            img_gray = masked_img
+            roi_gray = roi_img
         else:
-            img_gray = cv2.cvtColor(masked_img, cv2.COLOR_BGR2GRAY)
+            roi_gray = cv2.cvtColor(roi_img, cv2.COLOR_BGR2GRAY)
+
+
+        # apply the gradient to the image
+        img_gray = cv2.multiply(roi_gray, self._sqm_gradient_mask, scale=1.0 / 255)
 
 
 
         lines_start = time.time()
 
-        blur_gray = cv2.GaussianBlur(img_gray, (self.blur_kernel_size, self.blur_kernel_size), cv2.BORDER_DEFAULT)
+        # hough parameters are in pixels of the detection image
+        scale = 2 ** self._pyramid_level
+        for i in range(self._pyramid_level):
+            img_gray = self._downscale(img_gray)
 
 
-        edges = cv2.Canny(blur_gray, self.canny_low_threshold, self.canny_high_threshold)
+        if self._temporal:
+            img_gray = self._differenceImage(img_gray, exp_date)
+
+            if isinstance(img_gray, type(None)):
+                lines_elapsed_s = time.time() - lines_start
+                logger.info('No changes for line detection in %0.4f s', lines_elapsed_s)
+                return list()
+
+
+        if self._pyramid_level:
+            blur_kernel_size = self.pyramid_blur_kernel_size
+        else:
+            blur_kernel_size = self.blur_kernel_size
+
+        blur_gray = cv2.GaussianBlur(img_gray, (blur_kernel_size, blur_kernel_size), cv2.BORDER_DEFAULT)
+
+
+        # gradients of wide edges (clouds, moon glow) are steeper in the downscaled image
+        edges = cv2.Canny(blur_gray, self.canny_low_threshold * scale, self.canny_high_threshold * scale)
 
         # Run Hough on edge detected image
         # Output "lines" is an array containing endpoints of detected line segments
+        # The vote threshold is only reduced by sqrt(scale), halving it finds the moon glow
         lines = cv2.HoughLinesP(
             edges,
             self.rho,
             self.theta,
-            self.threshold,
+            int(self.threshold / math.sqrt(scale)),
             numpy.array([]),
-            self.min_line_length,
-            self.max_line_gap,
+            self.min_line_length / scale,
+            self.max_line_gap / scale,
         )
 
         lines_elapsed_s = time.time() - lines_start
@@ -82,11 +135,60 @@ class IndiAllskyDetectLines(object):
 
         logger.info('Detected %d lines', len(lines))
 
+        # offset to full frame coordinates
+        lines = (lines * scale) + numpy.array([x, y, x, y], dtype=lines.dtype)
+
         self._drawLines(original_img, lines)
 
         return lines
 
 
+    def _downscale(self, img_gray):
+        # 2x2 maximum keeps the contrast of thin lines, pyrDown averages them into the background
+        img_max = cv2.dilate(img_gray, numpy.ones((2, 2), dtype=numpy.uint8), anchor=(0, 0))
+
+        image_height, image_width = img_gray.shape[:2]
+        return cv2.resize(img_max, (image_width // 2, image_height // 2), interpolation=cv2.INTER_NEAREST)
+
+
+    def _differenceImage(self, img_gray, exp_date):
+        # returns the brightening compared to the background, or None if nothing changed
+        background = self._background
+        background_date = self._background_date
+
+        self._background_date = exp_date
+        self.frame_pair = None
+
+        if isinstance(background, type(None)) or background.shape != img_gray.shape:
+            self._background = img_gray.copy()
+            return None
+
+
+        # update the background for the next frame
+        self._background = cv2.max(cv2.multiply(background, self.background_decay), img_gray)
+
+
+        diff = cv2.subtract(img_gray, background)
+
+        _, diff_mask = cv2.threshold(diff, self.diff_pixel_threshold, 255, cv2.THRESH_BINARY)
+        changed_pixels = cv2.countNonZero(diff_mask)
+
+        logger.info('Changed pixels: %d', changed_pixels)
+
+        if changed_pixels > (diff.shape[0] * diff.shape[1] * self.scene_change_fraction):
+            logger.warning('Scene change, resetting line detection background')
+            self._background = img_gray.copy()
+            return None
+
+        if changed_pixels < self._diff_min_pixels:
+            return None
+
+
+        self.frame_pair = (background_date, exp_date)
+
+        return diff
+
+
     def _generateSqmMask(self, img):
         logger.info('Generating mask based on SQM_ROI')
 
@@ -126,14 +228,19 @@ class IndiAllskyDetectLines(object):
         # blur the mask to prevent mask edges from being detected as lines
         blur_mask = cv2.blur(self._sqm_mask, (self.mask_blur_kernel_size, self.mask_blur_kernel_size), cv2.BORDER_DEFAULT)
 
-        if len(img.shape) == 2:
-            # mono
-            mask = blur_mask
-        else:
-            # color
-            mask = cv2.cvtColor(blur_mask, cv2.COLOR_GRAY2BGR)
+        x, y, w, h = cv2.boundingRect(blur_mask)
+
+        if not w or not h:
+            logger.error('Line detection mask is empty, using full frame')
+            image_height, image_width = img.shape[:2]
+            x, y, w, h = 0, 0, image_width, image_height
+
+        logger.info('Line detection region: %d x %d at %d, %d', w, h, x, y)
+
+        self._sqm_gradient_rect = (x, y, w, h)
 
-        self._sqm_gradient_mask = mask / 255
+        # uint8 gradient (0-255) applied to the grayscale image
+        self._sqm_gradient_mask = numpy.ascontiguousarray(blur_mask[y:y + h, x:x + w])
 
 
     def _drawLines(self, img, lines):
@@ -44,6 +44,11 @@ class GenericFileTransfer(object):
         pass
 
 
+    def alive(self):
+        # checked before a persistent connection is reused
+        return True
+
+
     def put(self, *args, **kwargs):
         local_file = kwargs['local_file']
 
@@ -80,6 +80,17 @@ class paramiko_sftp(GenericFileTransfer):
             self.client.close()
 
 
+    def alive(self):
+        if not self.client or not self.sftp:
+            return False
+
+        transport = self.client.get_transport()
+        if not transport or not transport.is_active():
+            return False
+
+        return True
+
+
     def put(self, *args, **kwargs):
         super(paramiko_sftp, self).put(*args, **kwargs)
 
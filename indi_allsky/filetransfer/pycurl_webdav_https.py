@@ -107,6 +107,7 @@ class pycurl_webdav_https(GenericFileTransfer):
             d_url = '{0:s}/{1:s}'.format(self.url, d_str)
 
             self.client.setopt(pycurl.URL, d_url)
+            self.client.setopt(pycurl.UPLOAD, 0)  # the handle is reused after an upload
             self.client.setopt(pycurl.CUSTOMREQUEST, 'MKCOL')  # mkdir
 
             try:
@@ -60,6 +60,19 @@ class python_ftpes(GenericFileTransfer):
             self.client.quit()
 
 
+    def alive(self):
+        if not self.client:
+            return False
+
+        try:
+            self.client.voidcmd('NOOP')
+        except ftplib.all_errors as e:
+            logger.warning('FTP connection check failed: %s', str(e))
+            return False
+
+        return True
+
+
     def put(self, *args, **kwargs):
         super(python_ftpes, self).put(*args, **kwargs)
 
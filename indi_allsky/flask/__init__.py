@@ -70,7 +70,7 @@ def _sqlite_pragma_on_connect(dbapi_con, con_record):
     #dbapi_con.execute('PRAGMA foreign_keys=ON')
 
 
-def create_app():
+def create_app(config_overrides=None):
     """Construct the core application."""
     app = Flask(
         __name__,
@@ -78,7 +78,12 @@ def create_app():
     )
 
     p_flask_config = Path('/etc/indi-allsky/flask.json')
-    app.config.from_file(p_flask_config, load=json.load)
+
+    # flask config is optional when overrides are passed (benchmarking)
+    app.config.from_file(p_flask_config, load=json.load, silent=bool(config_overrides))
+
+    if config_overrides:
+        app.config.update(config_overrides)
 
     csrf.init_app(app)
 
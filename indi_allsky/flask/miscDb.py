@@ -15,6 +15,8 @@ from .models import IndiAllSkyDbStarTrailsTable
 from .models import IndiAllSkyDbStarTrailsVideoTable
 from .models import IndiAllSkyDbFitsImageTable
 from .models import IndiAllSkyDbRawImageTable
+from .models import IndiAllSkyDbTaskQueueTable
+from .models import TaskQueueState
 
 from sqlalchemy.orm.exc import NoResultFound
 
@@ -438,10 +440,30 @@ class miscDb(object):
         return fits_image
 
 
-    def addUploadedFlag(self, entry):
+    def addUploadedFlag(self, entry, commit=True):
         entry.uploaded = True
+
+        if commit:
+            db.session.commit()
+
+
+    def addTasks(self, queue, jobdata_list, state=TaskQueueState.QUEUED):
+        # several tasks in a single transaction
+        task_list = list()
+        for jobdata in jobdata_list:
+            task = IndiAllSkyDbTaskQueueTable(
+                queue=queue,
+                state=state,
+                data=jobdata,
+            )
+
+            db.session.add(task)
+            task_list.append(task)
+
         db.session.commit()
 
+        return task_list
+
 
     def getCurrentCameraId(self):
         if self.config.get('DB_CCD_ID'):
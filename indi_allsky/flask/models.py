@@ -490,7 +490,11 @@ class IndiAllSkyDbTaskQueueTable(db.Model):
         self.result = result
         db.session.commit()
 
-    def setExpired(self):
+    def setExpired(self, result=None):
         self.state = TaskQueueState.EXPIRED
+
+        if result:
+            self.result = result
+
         db.session.commit()
 
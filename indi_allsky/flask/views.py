@@ -27,6 +27,7 @@ import astropy
 import flask
 
 from ..version import __version__
+from ..stageTimer import IndiAllSkyStageTimer
 
 from flask import render_template
 from flask import request
@@ -1539,6 +1540,8 @@ class SystemInfoView(TemplateView):
 
         context['uptime_str'] = self.getUptime()
 
+        context['image_queue_status'] = self.getImageQueueStatus()
+
         context['cpu_count'] = self.getCpuCount()
         context['cpu_usage'] = self.getCpuUsage()
 
@@ -1590,6 +1593,31 @@ class SystemInfoView(TemplateView):
         return context
 
 
+    def getImageQueueStatus(self):
+        status_p = Path(app.config.get('INDI_ALLSKY_STATUS', '/var/lib/indi-allsky/indi_allsky_status.json'))
+
+        try:
+            with io.open(str(status_p), 'r') as f_status:
+                status = json.loads(f_status.read())
+        except FileNotFoundError:
+            return dict()
+        except PermissionError as e:
+            app.logger.error('Unable to read %s: %s', status_p, str(e))
+            return dict()
+        except json.JSONDecodeError as e:
+            app.logger.error('Error decoding json: %s', str(e))
+            return dict()
+
+
+        queue_status = {
+            'image_queue'     : status.get('image_queue', 0),
+            'frames_dropped'  : status.get('frames_dropped', 0),
+            'frames_degraded' : status.get('frames_degraded', 0),
+        }
+
+        return queue_status
+
+
     def getUptime(self):
         uptime_s = time.time() - psutil.boot_time()
 
@@ -2699,6 +2727,15 @@ class FocusView(TemplateView):
         return context
 
 
+class JsonStageTimingView(JsonView):
+    def get_objects(self):
+        timing_p = Path(app.config.get('INDI_ALLSKY_TIMING', '/var/lib/indi-allsky/indi_allsky_timing.json'))
+
+        # one file per image worker
+        return IndiAllSkyStageTimer.mergeJson(timing_p)
+
+
+
 class JsonFocusView(JsonView):
 
     def __init__(self, **kwargs):
@@ -2776,6 +2813,7 @@ bp.add_url_rule('/charts', view_func=ChartView.as_view('chart_view', template_na
 bp.add_url_rule('/js/charts', view_func=JsonChartView.as_view('js_chart_view'))
 bp.add_url_rule('/system', view_func=SystemInfoView.as_view('system_view', template_name='system.html'))
 bp.add_url_rule('/tasks', view_func=TaskQueueView.as_view('taskqueue_view', template_name='taskqueue.html'))
+bp.add_url_rule('/js/timing', view_func=JsonStageTimingView.as_view('js_stage_timing_view'))
 bp.add_url_rule('/timelapse', view_func=TimelapseGeneratorView.as_view('timelapse_view', template_name='timelapse.html'))
 bp.add_url_rule('/focus', view_func=FocusView.as_view('focus_view', template_name='focus.html'))
 bp.add_url_rule('/js/focus', view_func=JsonFocusView.as_view('js_focus_view'))
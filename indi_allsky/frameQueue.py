@@ -0,0 +1,134 @@
+from pathlib import Path
+from multiprocessing import Queue
+from multiprocessing import Value
+import queue
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyFrameQueue(object):
+    # Bounded image queue with a policy for frames that arrive when processing falls behind
+    #
+    # drop_oldest - discard the oldest queued frame
+    # drop_newest - discard the new frame
+    # degrade     - skip optional processing stages when the backlog exceeds the threshold,
+    #               the oldest frame is discarded if the queue is full
+
+    policies = ('drop_oldest', 'drop_newest', 'degrade')
+
+
+    def __init__(self, config, frame_ring=None):
+        self.config = config
+        self.frame_ring = frame_ring
+
+        self._maxsize = int(self.config.get('IMAGE_QUEUE_MAX', 6))
+        self._backlog = int(self.config.get('IMAGE_QUEUE_BACKLOG', 3))
+
+        self._policy = self.config.get('IMAGE_QUEUE_POLICY', 'drop_oldest')
+        if self._policy not in self.policies:
+            logger.error('Unknown image queue policy %s, using drop_oldest', self._policy)
+            self._policy = 'drop_oldest'
+
+        self._q = Queue(maxsize=self._maxsize)
+
+        self.dropped_v = Value('i', 0)
+        self.degraded_v = Value('i', 0)
+
+
+    @property
+    def policy(self):
+        return self._policy
+
+
+    def put(self, item):
+        if item.get('stop'):
+            # control messages are never dropped
+            self._q.put(item)
+            return
+
+
+        try:
+            self._q.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+
+
+        if self._policy == 'drop_newest':
+            logger.error('Image queue full, dropping new frame')
+            self._drop(item)
+            return
+
+
+        # drop_oldest and degrade
+        try:
+            old_item = self._q.get_nowait()
+        except queue.Empty:
+            old_item = None
+
+        if old_item:
+            if old_item.get('stop'):
+                # keep the control message, drop the new frame
+                self._q.put(old_item)
+                old_item = item
+                logger.error('Image queue full, dropping new frame')
+            else:
+                logger.error('Image queue full, dropping oldest frame')
+
+            self._drop(old_item)
+
+
+        try:
+            self._q.put_nowait(item)
+        except queue.Full:
+            logger.error('Image queue full, dropping new frame')
+            self._drop(item)
+
+
+    def get(self, block=True, timeout=None):
+        return self._q.get(block=block, timeout=timeout)
+
+
+    def get_nowait(self):
+        return self._q.get_nowait()
+
+
+    def qsize(self):
+        return self._q.qsize()
+
+
+    def saturated(self):
+        # processing is not keeping up with the camera
+        return self._q.qsize() >= self._backlog
+
+
+    def degrade(self):
+        # returns True if optional processing should be skipped for the current frame
+        if self._policy != 'degrade':
+            return False
+
+        if not self.saturated():
+            return False
+
+        with self.degraded_v.get_lock():
+            self.degraded_v.value += 1
+
+        return True
+
+
+    def _drop(self, item):
+        with self.dropped_v.get_lock():
+            self.dropped_v.value += 1
+
+
+        if item.get('filename'):
+            try:
+                Path(item['filename']).unlink()
+            except FileNotFoundError:
+                pass
+
+        if self.frame_ring and not isinstance(item.get('frame_slot'), type(None)):
+            self.frame_ring.release(item['frame_slot'])
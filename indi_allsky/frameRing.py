@@ -0,0 +1,151 @@
+from multiprocessing import Queue
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+import queue
+import logging
+
+import numpy
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyFrameRing(object):
+    # Ring of shared memory frame slots to pass image data from the camera client to the image worker
+
+    def __init__(self, slots):
+        self._slots = int(slots)
+
+        self.free_q = Queue()
+        for i in range(self._slots):
+            self.free_q.put(i)
+
+        self._shm_list = [None] * self._slots  # producer segments
+        self._attached = dict()  # consumer segments
+
+
+    def __getstate__(self):
+        # shared memory segments are not passed to other processes, they are attached by name
+        state = self.__dict__.copy()
+        state['_shm_list'] = [None] * self._slots
+        state['_attached'] = dict()
+        return state
+
+
+    @property
+    def slots(self):
+        return self._slots
+
+
+    def put(self, data):
+        # returns the slot metadata for the image queue, None if a slot is not available
+        try:
+            slot = self.free_q.get_nowait()
+        except queue.Empty:
+            logger.warning('No free frame slots, falling back to file transport')
+            return None
+
+
+        # fits data may be big endian
+        dtype = data.dtype.newbyteorder('=')
+
+        shm = self._shm_list[slot]
+
+        try:
+            if isinstance(shm, type(None)) or shm.size < data.nbytes:
+                if not isinstance(shm, type(None)):
+                    # slot is too small (binning changed)
+                    shm.close()
+                    shm.unlink()
+                    self._shm_list[slot] = None
+
+                shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+                self._shm_list[slot] = shm
+        except OSError as e:
+            logger.error('Unable to create shared memory frame slot: %s', str(e))
+            self.free_q.put(slot)
+            return None
+
+
+        frame = numpy.ndarray(data.shape, dtype=dtype, buffer=shm.buf)
+        frame[:] = data
+
+
+        frame_data = {
+            'frame_slot'  : slot,
+            'frame_shm'   : shm.name,
+            'frame_shape' : data.shape,
+            'frame_dtype' : dtype.str,
+        }
+
+        return frame_data
+
+
+    def ndarray(self, frame_data):
+        # maps the slot data directly, the slot must be released after the data is no longer used
+        slot = frame_data['frame_slot']
+        shm_name = frame_data['frame_shm']
+
+        shm = self._attached.get(slot)
+        if isinstance(shm, type(None)) or shm.name != shm_name:
+            shm = self._attach(slot, shm_name)
+
+
+        frame = numpy.ndarray(
+            frame_data['frame_shape'],
+            dtype=numpy.dtype(frame_data['frame_dtype']),
+            buffer=shm.buf,
+        )
+
+        return frame
+
+
+    def release(self, slot):
+        self.free_q.put(slot)
+
+
+    def close(self):
+        for shm in self._attached.values():
+            self._close(shm)
+
+        self._attached.clear()
+
+
+        for i, shm in enumerate(self._shm_list):
+            if isinstance(shm, type(None)):
+                continue
+
+            self._close(shm)
+
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+
+            self._shm_list[i] = None
+
+
+    def _attach(self, slot, shm_name):
+        # the segment name changes when a slot is resized
+        old_shm = self._attached.pop(slot, None)
+        if not isinstance(old_shm, type(None)):
+            self._close(old_shm)
+
+
+        shm = shared_memory.SharedMemory(name=shm_name)
+
+        # the producer owns the segment, prevent the resource tracker from removing it when the worker exits
+        resource_tracker.unregister(shm._name, 'shared_memory')
+
+        self._attached[slot] = shm
+
+        return shm
+
+
+    def _close(self, shm):
+        try:
+            shm.close()
+        except BufferError:
+            # arrays still reference the segment, it is released when they are garbage collected
+            pass
@@ -29,18 +29,22 @@ from .sqm import IndiAllskySqm
 from .stars import IndiAllSkyStars
 from .detectLines import IndiAllskyDetectLines
 from .draw import IndiAllSkyDraw
-from .scnr import IndiAllskyScnr
+from .colorPipeline import IndiAllSkyColorPipeline
+from .liveProducts import IndiAllSkyLiveProducts
+from .darkCache import IndiAllSkyDarkCache
+from .stageTimer import IndiAllSkyStageTimer
+from .imageState import IndiAllSkyImageState
 
 from .flask import db
 from .flask.miscDb import miscDb
 
-from .flask.models import TaskQueueState
+#from .flask.models import TaskQueueState
 from .flask.models import TaskQueueQueue
 from .flask.models import IndiAllSkyDbCameraTable
 from .flask.models import IndiAllSkyDbImageTable
 from .flask.models import IndiAllSkyDbBadPixelMapTable
 from .flask.models import IndiAllSkyDbDarkFrameTable
-from .flask.models import IndiAllSkyDbTaskQueueTable
+#from .flask.models import IndiAllSkyDbTaskQueueTable
 
 from sqlalchemy import func
 #from sqlalchemy.orm.exc import NoResultFound
@@ -65,6 +69,15 @@ class ImageWorker(Process):
     sqm_history_minutes = 30
     stars_history_minutes = 30
 
+    queue_timeout = 5.0  # seconds to block waiting for a job
+
+    status_json_file = '/var/lib/indi-allsky/indi_allsky_status.json'
+    timing_json_file = '/var/lib/indi-allsky/indi_allsky_timing.json'
+
+    # frame received to image written latency histogram buckets (seconds)
+    latency_buckets = (0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+    latency_log_frames = 20  # log histogram every x frames
+
     __cfa_bgr_map = {
         'GRBG' : cv2.COLOR_BAYER_GB2BGR,
         'RGGB' : cv2.COLOR_BAYER_BG2BGR,
@@ -97,6 +110,9 @@ class ImageWorker(Process):
         sensortemp_v,
         night_v,
         moonmode_v,
+        frame_ring=None,
+        image_state=None,
+        worker_slot=0,
     ):
         super(ImageWorker, self).__init__()
 
@@ -107,6 +123,14 @@ class ImageWorker(Process):
         self.error_q = error_q
         self.image_q = image_q
         self.upload_q = upload_q
+        self.frame_ring = frame_ring
+        self.worker_slot = worker_slot  # position in the worker pool, stable across restarts
+
+        if image_state:
+            self.image_state = image_state
+        else:
+            # single worker
+            self.image_state = IndiAllSkyImageState()
 
         self.indi_rgb = True  # INDI returns array in the wrong order for cv2
 
@@ -129,13 +153,13 @@ class ImageWorker(Process):
 
         self.filename_t = 'ccd{0:d}_{1:s}.{2:s}'
 
-        self.target_adu_found = False
-        self.current_adu_target = 0
-        self.hist_adu = []
         self.target_adu = float(self.config['TARGET_ADU'])
 
         self.image_count = 0
 
+        self._latency_hist = [0] * (len(self.latency_buckets) + 1)
+        self._latency_count = 0
+
         self._orb = IndiAllskyOrbGenerator(self.config)
 
         self._sqm = IndiAllskySqm(self.config, self.bin_v, mask=None)
@@ -148,16 +172,57 @@ class ImageWorker(Process):
         self._lineDetect = IndiAllskyDetectLines(self.config, self.bin_v, mask=self._detection_mask)
         self._draw = IndiAllSkyDraw(self.config, self.bin_v, mask=self._detection_mask)
 
-        self._scnr = IndiAllskyScnr(self.config)
+        self._color = IndiAllSkyColorPipeline(self.config)
+
+        self._dark_cache = IndiAllSkyDarkCache(self.config)
+
+        self._lut_8bit = dict()  # 16->8 bit lookup tables by bit depth
+
+        if self.config.get('KEOGRAM_STARTRAILS_LIVE'):
+            # keogram and star trail updated with each image
+            self._live_products = IndiAllSkyLiveProducts(self.config, self.bin_v, mask=self._detection_mask)
+        else:
+            self._live_products = None
+
+        self._stage_timer = IndiAllSkyStageTimer(self.config)
 
         self._miscDb = miscDb(self.config)
 
+        # upload tasks for the current image, created in one transaction
+        self._upload_tasks = list()
+
         if self.config.get('IMAGE_FOLDER'):
             self.image_dir = Path(self.config['IMAGE_FOLDER']).absolute()
         else:
             self.image_dir = Path(__file__).parent.parent.joinpath('html', 'images').absolute()
 
 
+    # ADU feedback state is shared between workers
+    @property
+    def target_adu_found(self):
+        return bool(self.image_state.target_adu_found_v.value)
+
+    @target_adu_found.setter
+    def target_adu_found(self, new_target_adu_found):
+        self.image_state.target_adu_found_v.value = int(new_target_adu_found)
+
+    @property
+    def current_adu_target(self):
+        return self.image_state.current_adu_target_v.value
+
+    @current_adu_target.setter
+    def current_adu_target(self, new_current_adu_target):
+        self.image_state.current_adu_target_v.value = float(new_current_adu_target)
+
+    @property
+    def hist_adu(self):
+        return self.image_state.getHistAdu()
+
+    @hist_adu.setter
+    def hist_adu(self, new_hist_adu):
+        self.image_state.setHistAdu(new_hist_adu)
+
+
 
     def run(self):
         ### use this as a method to log uncaught exceptions
@@ -174,14 +239,24 @@ class ImageWorker(Process):
         #raise Exception('Test exception handling in worker')
 
         while True:
-            time.sleep(0.05)  # sleep every loop
+            # frames are numbered in queue order
+            with self.image_state.seq_lock:
+                try:
+                    # block until a job is available, the timeout keeps the loop alive
+                    i_dict = self.image_q.get(timeout=self.queue_timeout)
+                except queue.Empty:
+                    continue
+
+                if not i_dict.get('stop'):
+                    i_dict['frame_seq'] = self.image_state.nextSeq()
 
-            try:
-                i_dict = self.image_q.get_nowait()
-            except queue.Empty:
-                continue
 
             if i_dict.get('stop'):
+                self._stage_timer.logSummary()
+
+                if self._live_products:
+                    self._live_products.close()
+
                 return
 
             ### Not using DB task queue for image processing to reduce database I/O
@@ -210,311 +285,469 @@ class ImageWorker(Process):
             #filename_t = task.data.get('filename_t')
             ###
 
-            filename_p = Path(i_dict['filename'])
-            exposure = i_dict['exposure']
-            exp_date = datetime.fromtimestamp(i_dict['exp_time'])
-            exp_elapsed = i_dict['exp_elapsed']
-            camera_id = i_dict['camera_id']
-            filename_t = i_dict.get('filename_t')
+            try:
+                self.processImage(i_dict)
+            finally:
+                if not isinstance(i_dict.get('frame_slot'), type(None)):
+                    # shared memory slot may be reused by the camera
+                    self.frame_ring.release(i_dict['frame_slot'])
 
 
-            if filename_t:
-                self.filename_t = filename_t
+    def processImage(self, i_dict):
+        if isinstance(i_dict.get('frame_seq'), type(None)):
+            # not called from the worker loop
+            with self.image_state.seq_lock:
+                i_dict['frame_seq'] = self.image_state.nextSeq()
 
-            self.image_count += 1
+        try:
+            self._processImage(i_dict)
+        finally:
+            # other workers wait on this frame for ordered stages
+            self.image_state.release(i_dict['frame_seq'])
+
+
+    def _processImage(self, i_dict):
+        exposure = i_dict['exposure']
+        exp_date = datetime.fromtimestamp(i_dict['exp_time'])
+        exp_elapsed = i_dict['exp_elapsed']
+        camera_id = i_dict['camera_id']
+        filename_t = i_dict.get('filename_t')
+
+
+        if filename_t:
+            self.filename_t = filename_t
+
+
+        frame_seq = i_dict['frame_seq']
 
+        self.image_count = frame_seq + 1
+
+
+        # skip optional processing when processing is falling behind
+        degraded = self.image_q.degrade()
+        if degraded:
+            logger.warning('Image queue backlog, skipping optional processing stages')
+
+
+        if i_dict.get('filename'):
+            filename_p = Path(i_dict['filename'])
 
             if not filename_p.exists():
                 logger.error('Frame not found: %s', filename_p)
                 #task.setFailed('Frame not found: {0:s}'.format(str(filename_p)))
-                continue
+                return
 
 
             if filename_p.stat().st_size == 0:
                 logger.error('Frame is empty: %s', filename_p)
-                continue
+                return
+        else:
+            # image data is in shared memory
+            filename_p = None
+
+
+        self._stage_timer.start()
+
+
+        ### Open file
+        if not filename_p:
+            # map the shared memory data directly, no file I/O
+            scidata = self.frame_ring.ndarray(i_dict)
 
+            hdu = fits.PrimaryHDU(scidata, header=fits.Header.fromstring(i_dict['header']))
+            hdulist = fits.HDUList([hdu])
 
-            ### Open file
-            if filename_p.suffix in ['.fit']:
-                hdulist = fits.open(filename_p)
+            image_bitpix = hdulist[0].header['BITPIX']
+            image_bayerpat = hdulist[0].header.get('BAYERPAT')
+        elif filename_p.suffix in ['.fit']:
+            hdulist = fits.open(filename_p)
 
-                #logger.info('Initial HDU Header = %s', pformat(hdulist[0].header))
-                image_bitpix = hdulist[0].header['BITPIX']
-                image_bayerpat = hdulist[0].header.get('BAYERPAT')
+            #logger.info('Initial HDU Header = %s', pformat(hdulist[0].header))
+            image_bitpix = hdulist[0].header['BITPIX']
+            image_bayerpat = hdulist[0].header.get('BAYERPAT')
 
-                scidata = hdulist[0].data
-            elif filename_p.suffix in ['.jpg', '.jpeg']:
-                self.indi_rgb = False
+            scidata = hdulist[0].data
+        elif filename_p.suffix in ['.jpg', '.jpeg']:
+            self.indi_rgb = False
 
-                scidata = cv2.imread(str(filename_p), cv2.IMREAD_UNCHANGED)
+            hdulist = None  # no fits data
 
-                image_bitpix = 8
-                image_bayerpat = None
-            elif filename_p.suffix in ['.png']:
-                self.indi_rgb = False
+            scidata = cv2.imread(str(filename_p), cv2.IMREAD_UNCHANGED)
 
-                scidata = cv2.imread(str(filename_p), cv2.IMREAD_UNCHANGED)
+            image_bitpix = 8
+            image_bayerpat = None
+        elif filename_p.suffix in ['.png']:
+            self.indi_rgb = False
 
-                image_bitpix = 8
-                image_bayerpat = None
-            elif filename_p.suffix in ['.dng']:
-                if not rawpy:
-                    filename_p.unlink()
-                    raise Exception('*** rawpy module not available ***')
+            hdulist = None  # no fits data
 
-                # DNG raw
-                raw = rawpy.imread(str(filename_p))
-                scidata = raw.raw_image
+            scidata = cv2.imread(str(filename_p), cv2.IMREAD_UNCHANGED)
 
-                # create a new fits container for DNG data
-                hdu = fits.PrimaryHDU(scidata)
-                hdulist = fits.HDUList([hdu])
+            image_bitpix = 8
+            image_bayerpat = None
+        elif filename_p.suffix in ['.dng']:
+            if not rawpy:
+                filename_p.unlink()
+                raise Exception('*** rawpy module not available ***')
 
-                hdulist[0].header['EXTEND'] = True
-                hdulist[0].header['IMAGETYP'] = 'Light Frame'
-                hdulist[0].header['INSTRUME'] = 'libcamera'
-                hdulist[0].header['FOCALLEN'] = 10  # smallest possible value
-                hdulist[0].header['APTDIA'] = 10  # smallest possible value
-                hdulist[0].header['EXPTIME'] = float(exposure)
-                hdulist[0].header['XBINNING'] = 1
-                hdulist[0].header['YBINNING'] = 1
-                hdulist[0].header['GAIN'] = float(self.gain_v.value)
-                hdulist[0].header['CCD-TEMP'] = self.sensortemp_v.value
-                hdulist[0].header['BITPIX'] = 16
-                hdulist[0].header['SITELAT'] = self.latitude_v.value
-                hdulist[0].header['SITELONG'] = self.longitude_v.value
-                hdulist[0].header['RA'] = self.ra_v.value
-                hdulist[0].header['DEC'] = self.dec_v.value
-                hdulist[0].header['DATE-OBS'] = exp_date.isoformat()
+            # DNG raw
+            raw = rawpy.imread(str(filename_p))
+            scidata = raw.raw_image
 
+            # create a new fits container for DNG data
+            hdu = fits.PrimaryHDU(scidata)
+            hdulist = fits.HDUList([hdu])
 
-                if self.config['CFA_PATTERN']:
-                    hdulist[0].header['BAYERPAT'] = self.config['CFA_PATTERN']
-                    hdulist[0].header['XBAYROFF'] = 0
-                    hdulist[0].header['YBAYROFF'] = 0
+            hdulist[0].header['EXTEND'] = True
+            hdulist[0].header['IMAGETYP'] = 'Light Frame'
+            hdulist[0].header['INSTRUME'] = 'libcamera'
+            hdulist[0].header['FOCALLEN'] = 10  # smallest possible value
+            hdulist[0].header['APTDIA'] = 10  # smallest possible value
+            hdulist[0].header['EXPTIME'] = float(exposure)
+            hdulist[0].header['XBINNING'] = 1
+            hdulist[0].header['YBINNING'] = 1
+            hdulist[0].header['GAIN'] = float(self.gain_v.value)
+            hdulist[0].header['CCD-TEMP'] = self.sensortemp_v.value
+            hdulist[0].header['BITPIX'] = 16
+            hdulist[0].header['SITELAT'] = self.latitude_v.value
+            hdulist[0].header['SITELONG'] = self.longitude_v.value
+            hdulist[0].header['RA'] = self.ra_v.value
+            hdulist[0].header['DEC'] = self.dec_v.value
+            hdulist[0].header['DATE-OBS'] = exp_date.isoformat()
 
-                image_bitpix = hdulist[0].header['BITPIX']
-                image_bayerpat = hdulist[0].header.get('BAYERPAT')
 
+            if self.config['CFA_PATTERN']:
+                hdulist[0].header['BAYERPAT'] = self.config['CFA_PATTERN']
+                hdulist[0].header['XBAYROFF'] = 0
+                hdulist[0].header['YBAYROFF'] = 0
 
-            # Override these
+            image_bitpix = hdulist[0].header['BITPIX']
+            image_bayerpat = hdulist[0].header.get('BAYERPAT')
 
+
+        # Override these
+        if not isinstance(hdulist, type(None)):
             hdulist[0].header['OBJECT'] = 'AllSky'
             hdulist[0].header['TELESCOP'] = 'indi-allsky'
 
 
 
-            #logger.info('Final HDU Header = %s', pformat(hdulist[0].header))
+        #logger.info('Final HDU Header = %s', pformat(hdulist[0].header))
 
 
+        if filename_p:
             filename_p.unlink()  # no longer need the original file
-            logger.info('Detected image bits: %d, cfa: %s', image_bitpix, str(image_bayerpat))
 
+        logger.info('Detected image bits: %d, cfa: %s', image_bitpix, str(image_bayerpat))
 
+        self._stage_timer.mark('fits_open')
 
-            processing_start = time.time()
 
 
-            image_bit_depth = self.detectBitDepth(scidata)
+        processing_start = time.time()
 
 
-            if len(scidata.shape) == 2:
-                # gray scale or bayered
+        image_bit_depth = self.detectBitDepth(scidata)
 
-                if self.config.get('IMAGE_SAVE_FITS'):
-                    self.write_fit(hdulist, camera_id, exposure, exp_date, image_bitpix)
+        self._stage_timer.mark('bit_depth')
 
-                try:
-                    scidata = self.calibrate(scidata, exposure, camera_id, image_bitpix)
-                    calibrated = True
-                except CalibrationNotFound:
-                    calibrated = False
 
+        if len(scidata.shape) == 2:
+            # gray scale or bayered
+
+            try:
+                scidata = self.calibrate(scidata, exposure, camera_id, image_bitpix)
+                calibrated = True
+            except CalibrationNotFound:
+                calibrated = False
 
-                # sqm calculation
-                self.sqm_value = self.calculateSqm(scidata, exposure)
+            write_fits = bool(self.config.get('IMAGE_SAVE_FITS'))
 
-                # debayer
-                scidata = self.debayer(scidata, image_bayerpat)
+            if write_fits:
+                # fits file is written with the same calibrated data, the display
+                # pipeline may modify or draw into scidata before the fits is written
+                hdulist[0].data = scidata.copy()
 
-            else:
-                # data is probably RGB
+            self._stage_timer.mark('calibrate')
+
+
+            # sqm calculation
+            self.sqm_value = self.calculateSqm(scidata, exposure)
+
+            self._stage_timer.mark('sqm')
+
+            # debayer
+            scidata = self.debayer(scidata, image_bayerpat)
+
+            self._stage_timer.mark('debayer')
+
+        else:
+            # data is probably RGB
+            #logger.info('Channels: %s', pformat(scidata.shape))
+
+            if self.indi_rgb:
+                # INDI returns array in the wrong order for cv2
+                scidata = numpy.swapaxes(scidata, 0, 2)
+                scidata = numpy.swapaxes(scidata, 0, 1)
                 #logger.info('Channels: %s', pformat(scidata.shape))
 
-                if self.indi_rgb:
-                    # INDI returns array in the wrong order for cv2
-                    scidata = numpy.swapaxes(scidata, 0, 2)
-                    scidata = numpy.swapaxes(scidata, 0, 1)
-                    #logger.info('Channels: %s', pformat(scidata.shape))
+                scidata = cv2.cvtColor(scidata, cv2.COLOR_RGB2BGR)
+            else:
+                # normal rgb data
+                pass
 
-                    scidata = cv2.cvtColor(scidata, cv2.COLOR_RGB2BGR)
-                else:
-                    # normal rgb data
-                    pass
+            self._stage_timer.mark('debayer')
 
 
-                # sqm calculation
-                self.sqm_value = self.calculateSqm(scidata, exposure)
+            # sqm calculation
+            self.sqm_value = self.calculateSqm(scidata, exposure)
 
-                calibrated = False
+            self._stage_timer.mark('sqm')
 
+            calibrated = False
+            write_fits = False
 
-            image_height, image_width = scidata.shape[:2]
-            logger.info('Image: %d x %d', image_width, image_height)
 
+        image_height, image_width = scidata.shape[:2]
+        logger.info('Image: %d x %d', image_width, image_height)
 
-            ### IMAGE IS CALIBRATED ###
-            self._export_raw_image(scidata, exp_date, exposure, camera_id, image_bitpix, image_bit_depth)
 
-            scidata = self._convert_16bit_to_8bit(scidata, image_bitpix, image_bit_depth)
+        ### IMAGE IS CALIBRATED ###
+        self._export_raw_image(scidata, exp_date, exposure, camera_id, image_bitpix, image_bit_depth)
 
+        self._stage_timer.mark('export_raw')
 
-            #with io.open('/tmp/indi_allsky_numpy.npy', 'w+b') as f_numpy:
-            #    numpy.save(f_numpy, scidata)
-            #logger.info('Wrote Numpy data: /tmp/indi_allsky_numpy.npy')
+        scidata = self._convert_16bit_to_8bit(scidata, image_bitpix, image_bit_depth)
 
+        self._stage_timer.mark('convert_8bit')
 
-            # rotation
-            if self.config.get('IMAGE_ROTATE'):
-                try:
-                    rotate_enum = getattr(cv2, self.config['IMAGE_ROTATE'])
-                    scidata = cv2.rotate(scidata, rotate_enum)
-                except AttributeError:
-                    logger.error('Unknown rotation option: %s', self.config['IMAGE_ROTATE'])
 
+        #with io.open('/tmp/indi_allsky_numpy.npy', 'w+b') as f_numpy:
+        #    numpy.save(f_numpy, scidata)
+        #logger.info('Wrote Numpy data: /tmp/indi_allsky_numpy.npy')
 
-            # verticle flip
-            if self.config.get('IMAGE_FLIP_V'):
-                scidata = cv2.flip(scidata, 0)
 
-            # horizontal flip
-            if self.config.get('IMAGE_FLIP_H'):
-                scidata = cv2.flip(scidata, 1)
+        # rotation
+        if self.config.get('IMAGE_ROTATE'):
+            try:
+                rotate_enum = getattr(cv2, self.config['IMAGE_ROTATE'])
+                scidata = cv2.rotate(scidata, rotate_enum)
+            except AttributeError:
+                logger.error('Unknown rotation option: %s', self.config['IMAGE_ROTATE'])
 
 
-            # adu calculate (before processing)
-            adu, adu_average = self.calculate_histogram(scidata, exposure)
+        # verticle flip
+        if self.config.get('IMAGE_FLIP_V'):
+            scidata = cv2.flip(scidata, 0)
 
+        # horizontal flip
+        if self.config.get('IMAGE_FLIP_H'):
+            scidata = cv2.flip(scidata, 1)
 
-            # line detection
-            if self.night_v.value and self.config.get('DETECT_METEORS'):
-                image_lines = self._lineDetect.detectLines(scidata)
-            else:
-                image_lines = list()
+        self._stage_timer.mark('rotate_flip')
 
 
-            # star detection
-            if self.night_v.value and self.config.get('DETECT_STARS', True):
-                blob_stars = self._stars.detectObjects(scidata)
-            else:
-                blob_stars = list()
+        # adu calculate (before processing), exposure feedback is processed in frame order
+        self.image_state.wait('adu', frame_seq)
+        adu, adu_average = self.calculate_histogram(scidata, exposure)
+        self.image_state.advance('adu', frame_seq)
 
+        self._stage_timer.mark('histogram')
 
-            # additional draw code
-            if self.config.get('DETECT_DRAW'):
-                scidata = self._draw.main(scidata)
 
+        # line detection
+        if not degraded and self.night_v.value and self.config.get('DETECT_METEORS'):
+            image_lines = self._lineDetect.detectLines(scidata, exp_date=exp_date)
 
-            # crop
-            if self.config.get('IMAGE_CROP_ROI'):
-                scidata = self.crop_image(scidata)
+            if len(image_lines) and self._lineDetect.frame_pair:
+                prev_date, curr_date = self._lineDetect.frame_pair
+                logger.warning(
+                    'Detected %d lines between frames %s and %s',
+                    len(image_lines),
+                    prev_date.strftime('%Y%m%d_%H%M%S') if prev_date else 'unknown',
+                    curr_date.strftime('%Y%m%d_%H%M%S') if curr_date else 'unknown',
+                )
+        else:
+            image_lines = list()
 
+        self._stage_timer.mark('detect_lines')
 
-            # green removal
-            scnr_algo = self.config.get('SCNR_ALGORITHM')
-            if scnr_algo:
-                scnr_function = getattr(self._scnr, scnr_algo)
-                scidata = scnr_function(scidata)
 
+        # star detection
+        if not degraded and self.night_v.value and self.config.get('DETECT_STARS', True):
+            blob_stars = self._stars.detectObjects(scidata)
+        else:
+            blob_stars = list()
 
-            # white balance
-            scidata = self.white_balance_manual_bgr(scidata)
-            scidata = self.white_balance_auto_bgr(scidata)
+        self._stage_timer.mark('detect_stars')
 
 
-            if not self.night_v.value and self.config['DAYTIME_CONTRAST_ENHANCE']:
-                # Contrast enhancement during the day
-                scidata = self.contrast_clahe(scidata)
-            elif self.night_v.value and self.config['NIGHT_CONTRAST_ENHANCE']:
-                # Contrast enhancement during night
-                scidata = self.contrast_clahe(scidata)
+        # additional draw code
+        if self.config.get('DETECT_DRAW'):
+            scidata = self._draw.main(scidata)
 
+        self._stage_timer.mark('draw')
 
-            if self.config['IMAGE_SCALE'] and self.config['IMAGE_SCALE'] != 100:
-                scidata = self.scale_image(scidata)
 
+        # crop
+        if self.config.get('IMAGE_CROP_ROI'):
+            scidata = self.crop_image(scidata)
 
-            # blur
-            #scidata = self.median_blur(scidata)
+        self._stage_timer.mark('crop')
 
-            # denoise
-            #scidata = self.fastDenoise(scidata)
 
-            self.image_text(scidata, exposure, exp_date, exp_elapsed, blob_stars, image_lines)
+        # color processing modifies the image in place
+        scidata = self._color.prepare(scidata)
 
 
-            processing_elapsed_s = time.time() - processing_start
-            logger.info('Image processed in %0.4f s', processing_elapsed_s)
+        # green removal
+        scnr_algo = self.config.get('SCNR_ALGORITHM')
+        if scnr_algo:
+            scidata = self._color.scnr(scidata, scnr_algo)
 
+        self._stage_timer.mark('scnr')
 
-            #task.setSuccess('Image processed')
 
+        # manual and auto white balance
+        scidata = self._color.white_balance(scidata)
 
-            self.write_status_json(exposure, exp_date, adu, adu_average, blob_stars)  # write json status file
+        self._stage_timer.mark('white_balance')
 
 
-            latest_file, new_filename = self.write_img(scidata, exp_date, camera_id)
+        if degraded:
+            pass
+        elif not self.night_v.value and self.config['DAYTIME_CONTRAST_ENHANCE']:
+            # Contrast enhancement during the day
+            scidata = self._color.contrast_clahe(scidata)
+        elif self.night_v.value and self.config['NIGHT_CONTRAST_ENHANCE']:
+            # Contrast enhancement during night
+            scidata = self._color.contrast_clahe(scidata)
+
+        self._stage_timer.mark('clahe')
+
+
+        if self.config['IMAGE_SCALE'] and self.config['IMAGE_SCALE'] != 100:
+            scidata = self.scale_image(scidata)
+
+        self._stage_timer.mark('scale')
+
+
+        # blur
+        #scidata = self.median_blur(scidata)
+
+        # denoise
+        #scidata = self.fastDenoise(scidata)
+
+        self.image_text(scidata, exposure, exp_date, exp_elapsed, blob_stars, image_lines)
+
+        self._stage_timer.mark('text')
+
+
+        processing_elapsed_s = time.time() - processing_start
+        logger.info('Image processed in %0.4f s', processing_elapsed_s)
+
+
+        #task.setSuccess('Image processed')
+
+
+        # results are committed in frame order
+        self._stage_timer.reset()
+        self.image_state.wait('commit', frame_seq)
+
+
+        self.write_status_json(exposure, exp_date, adu, adu_average, blob_stars)  # write json status file
+
+        self._stage_timer.reset()
+
+
+        latest_file, new_filename = self.write_img(scidata, exp_date, camera_id)
+
+        self._stage_timer.mark('encode')
+
+        # exp_time is set when the frame is received from the camera
+        self._recordLatency(time.time() - i_dict['exp_time'])
+
+        if new_filename:
+            image_entry = self._miscDb.addImage(
+                new_filename,
+                camera_id,
+                exp_date,
+                exposure,
+                exp_elapsed,
+                self.gain_v.value,
+                self.bin_v.value,
+                self.sensortemp_v.value,
+                adu,
+                self.target_adu_found,  # stable
+                bool(self.moonmode_v.value),
+                self.moon_phase,
+                night=bool(self.night_v.value),
+                adu_roi=self.config['ADU_ROI'],
+                calibrated=calibrated,
+                sqm=self.sqm_value,
+                stars=len(blob_stars),
+                detections=len(image_lines),
+            )
+
+            self._stage_timer.mark('db_insert')
+        else:
+            # images not being saved
+            image_entry = None
+
+
+        if latest_file:
+            # build mqtt data
+            mqtt_data = {
+                'exposure' : round(exposure, 6),
+                'gain'     : self.gain_v.value,
+                'bin'      : self.bin_v.value,
+                'temp'     : round(self.sensortemp_v.value, 1),
+                'sunalt'   : round(self.sun_alt, 1),
+                'moonalt'  : round(self.moon_alt, 1),
+                'moonphase': round(self.moon_phase, 1),
+                'moonmode' : bool(self.moonmode_v.value),
+                'night'    : bool(self.night_v.value),
+                'sqm'      : round(self.sqm_value, 1),
+                'stars'    : len(blob_stars),
+                'latitude' : round(self.latitude_v.value, 3),
+                'longitude': round(self.longitude_v.value, 3),
+            }
+
+            self.mqtt_publish(latest_file, mqtt_data)
 
-            if new_filename:
-                image_entry = self._miscDb.addImage(
-                    new_filename,
-                    camera_id,
-                    exp_date,
-                    exposure,
-                    exp_elapsed,
-                    self.gain_v.value,
-                    self.bin_v.value,
-                    self.sensortemp_v.value,
-                    adu,
-                    self.target_adu_found,  # stable
-                    bool(self.moonmode_v.value),
-                    self.moon_phase,
-                    night=bool(self.night_v.value),
-                    adu_roi=self.config['ADU_ROI'],
-                    calibrated=calibrated,
-                    sqm=self.sqm_value,
-                    stars=len(blob_stars),
-                    detections=len(image_lines),
-                )
-            else:
-                # images not being saved
-                image_entry = None
 
+            self.upload_image(latest_file, exp_date, image_entry=image_entry)
+            self.upload_metadata(exposure, exp_date, adu, adu_average, blob_stars, camera_id)
 
-            if latest_file:
-                # build mqtt data
-                mqtt_data = {
-                    'exposure' : round(exposure, 6),
-                    'gain'     : self.gain_v.value,
-                    'bin'      : self.bin_v.value,
-                    'temp'     : round(self.sensortemp_v.value, 1),
-                    'sunalt'   : round(self.sun_alt, 1),
-                    'moonalt'  : round(self.moon_alt, 1),
-                    'moonphase': round(self.moon_phase, 1),
-                    'moonmode' : bool(self.moonmode_v.value),
-                    'night'    : bool(self.night_v.value),
-                    'sqm'      : round(self.sqm_value, 1),
-                    'stars'    : len(blob_stars),
-                    'latitude' : round(self.latitude_v.value, 3),
-                    'longitude': round(self.longitude_v.value, 3),
-                }
+            self._queueUploadTasks()
 
-                self.mqtt_publish(latest_file, mqtt_data)
 
+        if self._live_products and new_filename:
+            # same images as the end of night processing
+            self._stage_timer.reset()
+            self._live_products.processImage(scidata, exp_date, bool(self.night_v.value), camera_id)
+            self._stage_timer.mark('live_products')
 
-                self.upload_image(latest_file, exp_date, image_entry=image_entry)
-                self.upload_metadata(exposure, exp_date, adu, adu_average, blob_stars, camera_id)
+
+        self.image_state.advance('commit', frame_seq)
+
+
+        if self._live_products and new_filename:
+            # partial products are rendered outside of the ordered commit stage
+            self._stage_timer.reset()
+            if self._live_products.writePreview():
+                self._stage_timer.mark('live_preview')
+
+
+        # fits are written last, the display image is not delayed by the fits write
+        if write_fits:
+            self._stage_timer.reset()
+            self.write_fit(hdulist, camera_id, exposure, exp_date, image_bitpix)
+            self._stage_timer.mark('fits_write')
+
+
+        self._stage_timer.finish(exp_date)
+        self._stage_timer.writeJson(IndiAllSkyStageTimer.workerFile(Path(self.timing_json_file), self.worker_slot))
 
 
     def upload_image(self, latest_file, exp_date, image_entry=None):
@@ -556,19 +789,12 @@ class ImageWorker(Process):
             'remote_file' : str(remote_file_p),
         }
 
-        task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : task.id})
+        # a newer upload to the same remote file replaces this one if it is still queued
+        self._upload_tasks.append((jobdata, {'payload' : 'image', 'coalesce' : str(remote_file_p)}))
 
         if image_entry:
             # image was not saved
-            self._miscDb.addUploadedFlag(image_entry)
+            self._miscDb.addUploadedFlag(image_entry, commit=False)
 
 
     def upload_metadata(self, exposure, exp_date, adu, adu_average, blob_stars, camera_id):
@@ -639,15 +865,7 @@ class ImageWorker(Process):
             'remove_local' : True,
         }
 
-        task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(task)
-        db.session.commit()
-
-        self.upload_q.put({'task_id' : task.id})
+        self._upload_tasks.append((jobdata, {'payload' : 'metadata', 'coalesce' : str(remote_file_p)}))
 
 
     def mqtt_publish(self, latest_file, mq_data):
@@ -664,15 +882,21 @@ class ImageWorker(Process):
             'mq_data'     : mq_data,
         }
 
-        task = IndiAllSkyDbTaskQueueTable(
-            queue=TaskQueueQueue.UPLOAD,
-            state=TaskQueueState.QUEUED,
-            data=jobdata,
-        )
-        db.session.add(task)
-        db.session.commit()
+        # only the latest image is published
+        self._upload_tasks.append((jobdata, {'payload' : 'mqtt', 'coalesce' : 'mqtt:{0:s}'.format(self.config['MQTTPUBLISH']['BASE_TOPIC'])}))
+
 
-        self.upload_q.put({'task_id' : task.id})
+    def _queueUploadTasks(self):
+        if not self._upload_tasks:
+            return
+
+        task_list = self._miscDb.addTasks(TaskQueueQueue.UPLOAD, [jobdata for jobdata, u_dict in self._upload_tasks])
+
+        for task, (jobdata, u_dict) in zip(task_list, self._upload_tasks):
+            u_dict['task_id'] = task.id
+            self.upload_q.put(u_dict)
+
+        self._upload_tasks = list()
 
 
     def getSqmData(self, camera_id):
@@ -727,6 +951,7 @@ class ImageWorker(Process):
 
     def detectBitDepth(self, data):
         ### This will need some rework if cameras return signed int data
+        # This is the only full scan for the max value, the 8 bit conversion uses a lookup table
         max_val = numpy.amax(data)
         logger.info('Image max value: %d', int(max_val))
 
@@ -764,12 +989,9 @@ class ImageWorker(Process):
             return
 
 
-        try:
-            calibrated_data = self.calibrate(hdulist[0].data, exposure, camera_id, image_bitpix)
-            hdulist[0].data = calibrated_data
-        except CalibrationNotFound:
-            pass
+        # hdulist data is already calibrated (if possible) by the main processing chain
 
+        write_fit_start = time.time()
 
         f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.fit')
 
@@ -816,9 +1038,32 @@ class ImageWorker(Process):
 
         Path(f_tmpfile.name).unlink()  # delete temp file
 
-        logger.info('Finished writing fit file')
+        write_fit_elapsed_s = time.time() - write_fit_start
+        logger.info('Finished writing fit file in %0.4f s', write_fit_elapsed_s)
+
 
 
+    def _recordLatency(self, latency_s):
+        for i, bucket in enumerate(self.latency_buckets):
+            if latency_s <= bucket:
+                self._latency_hist[i] += 1
+                break
+        else:
+            self._latency_hist[-1] += 1
+
+        self._latency_count += 1
+
+        logger.info('Frame received to image written in %0.4f s', latency_s)
+
+
+        if self._latency_count % self.latency_log_frames != 0:
+            return
+
+        hist_str_list = ['<={0:0.2f}s: {1:d}'.format(b, c) for b, c in zip(self.latency_buckets, self._latency_hist)]
+        hist_str_list.append('>{0:0.2f}s: {1:d}'.format(self.latency_buckets[-1], self._latency_hist[-1]))
+
+        logger.info('Frame latency histogram (%d frames): %s', self._latency_count, ', '.join(hist_str_list))
+
 
     def write_img(self, scidata, exp_date, camera_id):
         f_tmpfile = tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.{0}'.format(self.config['IMAGE_FILE_TYPE']))
@@ -913,10 +1158,13 @@ class ImageWorker(Process):
             'time'                : exp_date.strftime('%s'),
             'latitude'            : self.latitude_v.value,
             'longitude'           : self.longitude_v.value,
+            'image_queue'         : self.image_q.qsize(),
+            'frames_dropped'      : self.image_q.dropped_v.value,
+            'frames_degraded'     : self.image_q.degraded_v.value,
         }
 
 
-        indi_allsky_status_p = Path('/var/lib/indi-allsky/indi_allsky_status.json')
+        indi_allsky_status_p = Path(self.status_json_file)
 
         with io.open(str(indi_allsky_status_p), 'w') as f_indi_status:
             json.dump(status, f_indi_status, indent=4)
@@ -951,16 +1199,45 @@ class ImageWorker(Process):
 
 
     def calibrate(self, scidata_uncalibrated, exposure, camera_id, image_bitpix):
+        gain = self.gain_v.value
+        binmode = self.bin_v.value
+        sensortemp = self.sensortemp_v.value
+
+        self._dark_cache.validate()
+
+        cache_key = self._dark_cache.key(camera_id, image_bitpix, gain, binmode, exposure, sensortemp)
+        cache_found, master_dark = self._dark_cache.get(cache_key)
+
+        if not cache_found:
+            # query with the bucket temperature so the cached dark is the same for every frame in the bucket
+            bucket_temp = cache_key[5] * self._dark_cache.temperature_bucket_size
+
+            master_dark = self._getMasterDark(exposure, camera_id, image_bitpix, gain, binmode, bucket_temp)
+            self._dark_cache.put(cache_key, master_dark)
+
+        self._dark_cache.logStats()
+
+
+        if isinstance(master_dark, type(None)):
+            raise CalibrationNotFound('Dark not found')
+
+
+        scidata_calibrated = cv2.subtract(scidata_uncalibrated, master_dark)
+
+        return scidata_calibrated
+
+
+    def _getMasterDark(self, exposure, camera_id, image_bitpix, gain, binmode, sensortemp):
         # pick a bad pixel map that is closest to the exposure and temperature
-        logger.info('Searching for bad pixel map: gain %d, exposure >= %0.1f, temp >= %0.1fc', self.gain_v.value, exposure, self.sensortemp_v.value)
+        logger.info('Searching for bad pixel map: gain %d, exposure >= %0.1f, temp >= %0.1fc', gain, exposure, sensortemp)
         bpm_entry = IndiAllSkyDbBadPixelMapTable.query\
             .filter(IndiAllSkyDbBadPixelMapTable.camera_id == camera_id)\
             .filter(IndiAllSkyDbBadPixelMapTable.bitdepth == image_bitpix)\
-            .filter(IndiAllSkyDbBadPixelMapTable.gain == self.gain_v.value)\
-            .filter(IndiAllSkyDbBadPixelMapTable.binmode == self.bin_v.value)\
+            .filter(IndiAllSkyDbBadPixelMapTable.gain == gain)\
+            .filter(IndiAllSkyDbBadPixelMapTable.binmode == binmode)\
             .filter(IndiAllSkyDbBadPixelMapTable.exposure >= exposure)\
-            .filter(IndiAllSkyDbBadPixelMapTable.temp >= self.sensortemp_v.value)\
-            .filter(IndiAllSkyDbBadPixelMapTable.temp <= (self.sensortemp_v.value + self.dark_temperature_range))\
+            .filter(IndiAllSkyDbBadPixelMapTable.temp >= sensortemp)\
+            .filter(IndiAllSkyDbBadPixelMapTable.temp <= (sensortemp + self.dark_temperature_range))\
             .order_by(
                 IndiAllSkyDbBadPixelMapTable.exposure.asc(),
                 IndiAllSkyDbBadPixelMapTable.temp.asc(),
@@ -969,14 +1246,14 @@ class ImageWorker(Process):
             .first()
 
         if not bpm_entry:
-            logger.warning('Temperature matched bad pixel map not found: %0.2fc', self.sensortemp_v.value)
+            logger.warning('Temperature matched bad pixel map not found: %0.2fc', sensortemp)
 
             # pick a bad pixel map that matches the exposure at the hightest temperature found
             bpm_entry = IndiAllSkyDbBadPixelMapTable.query\
                 .filter(IndiAllSkyDbBadPixelMapTable.camera_id == camera_id)\
                 .filter(IndiAllSkyDbBadPixelMapTable.bitdepth == image_bitpix)\
-                .filter(IndiAllSkyDbBadPixelMapTable.gain == self.gain_v.value)\
-                .filter(IndiAllSkyDbBadPixelMapTable.binmode == self.bin_v.value)\
+                .filter(IndiAllSkyDbBadPixelMapTable.gain == gain)\
+                .filter(IndiAllSkyDbBadPixelMapTable.binmode == binmode)\
                 .filter(IndiAllSkyDbBadPixelMapTable.exposure >= exposure)\
                 .order_by(
                     IndiAllSkyDbBadPixelMapTable.exposure.asc(),
@@ -992,22 +1269,22 @@ class ImageWorker(Process):
                     camera_id,
                     image_bitpix,
                     float(exposure),
-                    self.gain_v.value,
-                    self.bin_v.value,
-                    self.sensortemp_v.value,
+                    gain,
+                    binmode,
+                    sensortemp,
                 )
 
 
         # pick a dark frame that is closest to the exposure and temperature
-        logger.info('Searching for dark frame: gain %d, exposure >= %0.1f, temp >= %0.1fc', self.gain_v.value, exposure, self.sensortemp_v.value)
+        logger.info('Searching for dark frame: gain %d, exposure >= %0.1f, temp >= %0.1fc', gain, exposure, sensortemp)
         dark_frame_entry = IndiAllSkyDbDarkFrameTable.query\
             .filter(IndiAllSkyDbDarkFrameTable.camera_id == camera_id)\
             .filter(IndiAllSkyDbDarkFrameTable.bitdepth == image_bitpix)\
-            .filter(IndiAllSkyDbDarkFrameTable.gain == self.gain_v.value)\
-            .filter(IndiAllSkyDbDarkFrameTable.binmode == self.bin_v.value)\
+            .filter(IndiAllSkyDbDarkFrameTable.gain == gain)\
+            .filter(IndiAllSkyDbDarkFrameTable.binmode == binmode)\
             .filter(IndiAllSkyDbDarkFrameTable.exposure >= exposure)\
-            .filter(IndiAllSkyDbDarkFrameTable.temp >= self.sensortemp_v.value)\
-            .filter(IndiAllSkyDbDarkFrameTable.temp <= (self.sensortemp_v.value + self.dark_temperature_range))\
+            .filter(IndiAllSkyDbDarkFrameTable.temp >= sensortemp)\
+            .filter(IndiAllSkyDbDarkFrameTable.temp <= (sensortemp + self.dark_temperature_range))\
             .order_by(
                 IndiAllSkyDbDarkFrameTable.exposure.asc(),
                 IndiAllSkyDbDarkFrameTable.temp.asc(),
@@ -1016,14 +1293,14 @@ class ImageWorker(Process):
             .first()
 
         if not dark_frame_entry:
-            logger.warning('Temperature matched dark not found: %0.2fc', self.sensortemp_v.value)
+            logger.warning('Temperature matched dark not found: %0.2fc', sensortemp)
 
             # pick a dark frame that matches the exposure at the hightest temperature found
             dark_frame_entry = IndiAllSkyDbDarkFrameTable.query\
                 .filter(IndiAllSkyDbDarkFrameTable.camera_id == camera_id)\
                 .filter(IndiAllSkyDbDarkFrameTable.bitdepth == image_bitpix)\
-                .filter(IndiAllSkyDbDarkFrameTable.gain == self.gain_v.value)\
-                .filter(IndiAllSkyDbDarkFrameTable.binmode == self.bin_v.value)\
+                .filter(IndiAllSkyDbDarkFrameTable.gain == gain)\
+                .filter(IndiAllSkyDbDarkFrameTable.binmode == binmode)\
                 .filter(IndiAllSkyDbDarkFrameTable.exposure >= exposure)\
                 .order_by(
                     IndiAllSkyDbDarkFrameTable.exposure.asc(),
@@ -1039,12 +1316,12 @@ class ImageWorker(Process):
                     camera_id,
                     image_bitpix,
                     float(exposure),
-                    self.gain_v.value,
-                    self.bin_v.value,
-                    self.sensortemp_v.value,
+                    gain,
+                    binmode,
+                    sensortemp,
                 )
 
-                raise CalibrationNotFound('Dark not found')
+                return None
 
 
         if bpm_entry:
@@ -1079,9 +1356,7 @@ class ImageWorker(Process):
             master_dark = dark
 
 
-        scidata_calibrated = cv2.subtract(scidata_uncalibrated, master_dark)
-
-        return scidata_calibrated
+        return master_dark
 
 
     def debayer(self, scidata, image_bayerpat):
@@ -1412,8 +1687,9 @@ class ImageWorker(Process):
             return adu, 0.0
 
 
-        self.hist_adu.append(adu)
-        self.hist_adu = self.hist_adu[(history_max_vals * -1):]  # remove oldest values, up to history_max_vals
+        hist_adu = self.hist_adu
+        hist_adu.append(adu)
+        self.hist_adu = hist_adu[(history_max_vals * -1):]  # remove oldest values, up to history_max_vals
 
         logger.info('Current target ADU: %0.2f (%0.2f/%0.2f)', self.current_adu_target, current_adu_target_min, current_adu_target_max)
         logger.info('Current ADU history: (%d) [%s]', len(self.hist_adu), ', '.join(['{0:0.2f}'.format(x) for x in self.hist_adu]))
@@ -1472,26 +1748,6 @@ class ImageWorker(Process):
             self.exposure_v.value = new_exposure
 
 
-    def contrast_clahe(self, data_bytes):
-        ### ohhhh, contrasty
-        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-
-        if len(data_bytes.shape) == 2:
-            # mono
-            return clahe.apply(data_bytes)
-
-        # color, apply to luminance
-        lab = cv2.cvtColor(data_bytes, cv2.COLOR_BGR2LAB)
-
-        l, a, b = cv2.split(lab)
-
-        cl = clahe.apply(l)
-
-        new_lab = cv2.merge((cl, a, b))
-
-        return cv2.cvtColor(new_lab, cv2.COLOR_LAB2BGR)
-
-
     def equalizeHistogram(self, data_bytes):
         if len(data_bytes.shape) == 2:
             # mono
@@ -1519,77 +1775,6 @@ class ImageWorker(Process):
         return cv2.cvtColor(ycrcb_img, cv2.COLOR_YCrCb2BGR)
 
 
-    def white_balance_auto_bgr(self, data_bytes):
-        if len(data_bytes.shape) == 2:
-            # mono
-            return data_bytes
-
-        if not self.config.get('AUTO_WB'):
-            return data_bytes
-
-        ### This seems to work
-        b, g, r = cv2.split(data_bytes)
-        b_avg = cv2.mean(b)[0]
-        g_avg = cv2.mean(g)[0]
-        r_avg = cv2.mean(r)[0]
-
-        # Find the gain of each channel
-        k = (b_avg + g_avg + r_avg) / 3
-
-        try:
-            kb = k / b_avg
-        except ZeroDivisionError:
-            kb = k / 0.1
-
-        try:
-            kg = k / g_avg
-        except ZeroDivisionError:
-            kg = k / 0.1
-
-        try:
-            kr = k / r_avg
-        except ZeroDivisionError:
-            kr = k / 0.1
-
-        b = cv2.addWeighted(src1=b, alpha=kb, src2=0, beta=0, gamma=0)
-        g = cv2.addWeighted(src1=g, alpha=kg, src2=0, beta=0, gamma=0)
-        r = cv2.addWeighted(src1=r, alpha=kr, src2=0, beta=0, gamma=0)
-
-        return cv2.merge([b, g, r])
-
-
-    def white_balance_manual_bgr(self, data_bytes):
-        if len(data_bytes.shape) == 2:
-            # mono
-            return data_bytes
-
-
-        if not self.config.get('WBB_FACTOR'):
-            logger.error('Missing WBB_FACTOR setting')
-            return data_bytes
-
-        if not self.config.get('WBG_FACTOR'):
-            logger.error('Missing WBG_FACTOR setting')
-            return data_bytes
-
-        if not self.config.get('WBR_FACTOR'):
-            logger.error('Missing WBR_FACTOR setting')
-            return data_bytes
-
-        WBB_FACTOR = float(self.config.get('WBB_FACTOR'))
-        WBG_FACTOR = float(self.config.get('WBG_FACTOR'))
-        WBR_FACTOR = float(self.config.get('WBR_FACTOR'))
-
-        b, g, r = cv2.split(data_bytes)
-
-        logger.info('Applying manual color balance settings')
-        wbb = cv2.multiply(b, WBB_FACTOR)
-        wbg = cv2.multiply(g, WBG_FACTOR)
-        wbr = cv2.multiply(r, WBR_FACTOR)
-
-        return cv2.merge([wbb, wbg, wbr])
-
-
     def white_balance_bgr_2(self, data_bytes):
         if len(data_bytes.shape) == 2:
             # mono
@@ -1658,9 +1843,29 @@ class ImageWorker(Process):
 
         logger.info('Resampling image from %d to 8 bits', image_bitpix)
 
-        div_factor = int((2 ** image_bit_depth) / 255)
+        if data_bytes_16.dtype != numpy.uint16:
+            div_factor = int((2 ** image_bit_depth) / 255)
+            return (data_bytes_16 / div_factor).astype(numpy.uint8)
+
+
+        # indexing the lookup table only allocates the 8 bit result
+        return self._get8bitLut(image_bit_depth)[data_bytes_16]
+
+
+    def _get8bitLut(self, image_bit_depth):
+        lut = self._lut_8bit.get(image_bit_depth)
+
+        if isinstance(lut, type(None)):
+            logger.info('Generating 8 bit lookup table for %d bit data', image_bit_depth)
+
+            div_factor = int((2 ** image_bit_depth) / 255)
+
+            lut = numpy.arange(2 ** 16, dtype=numpy.uint32) // div_factor
+            lut = numpy.clip(lut, 0, 255).astype(numpy.uint8)
+
+            self._lut_8bit[image_bit_depth] = lut
 
-        return (data_bytes_16 / div_factor).astype(numpy.uint8)
+        return lut
 
 
     def _export_raw_image(self, scidata, exp_date, exposure, camera_id, image_bitpix, image_bit_depth):
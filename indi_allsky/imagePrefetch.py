@@ -0,0 +1,70 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+import cv2
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyImagePrefetch(object):
+    # Decode images ahead of the consumer with a small thread pool
+    #
+    # cv2.imread() releases the GIL while decoding.  At most depth images are
+    # decoded or waiting at any time to keep memory bounded, and images are
+    # returned in the order of the file list.
+
+    def __init__(self, workers=2, depth=4, imread_flags=cv2.IMREAD_UNCHANGED, scale=1.0):
+        self.workers = max(int(workers), 1)
+        self.depth = max(int(depth), self.workers)
+        self.imread_flags = imread_flags
+        self.scale = scale  # images are resized in the pool
+
+        self.wait_s = 0.0  # time the consumer waited for images
+
+
+    def read(self, file_list):
+        # generator of (file, image), image is None if the file could not be read
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for file_p in file_list:
+                pending.append((file_p, executor.submit(self._imread, file_p)))
+
+                if len(pending) < self.depth:
+                    continue
+
+                yield self._next(pending)
+
+
+            while pending:
+                yield self._next(pending)
+
+
+    def _next(self, pending):
+        file_p, future = pending.popleft()
+
+        wait_start = time.time()
+        image = future.result()
+        self.wait_s += time.time() - wait_start
+
+        return file_p, image
+
+
+    def _imread(self, file_p):
+        image = cv2.imread(str(file_p), self.imread_flags)
+
+        if isinstance(image, type(None)) or self.scale == 1.0:
+            return image
+
+        height, width = image.shape[:2]
+
+        # even dimensions for yuv420p video
+        new_width = int(width * self.scale) & ~1
+        new_height = int(height * self.scale) & ~1
+
+        return cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
+
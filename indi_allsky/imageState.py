@@ -0,0 +1,88 @@
+from multiprocessing import Value
+from multiprocessing import Array
+from multiprocessing import Lock
+from multiprocessing import Condition
+import logging
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyImageState(object):
+    # State shared between the image worker processes
+    #
+    # Frames are numbered when they are taken off the image queue.  The ADU
+    # feedback and the commit (latest image, DB, uploads) stages run in frame
+    # order so the results are the same as a single worker.
+
+    adu_history_max = 10
+
+    order_timeout = 120.0  # a missing frame (dead worker) is skipped after this time
+
+
+    def __init__(self):
+        self.seq_lock = Lock()
+        self._next_seq_v = Value('i', 0, lock=False)  # protected by seq_lock
+
+        self._cond = Condition()
+        self._stage_seq = {
+            'adu'    : Value('i', 0, lock=False),  # protected by _cond
+            'commit' : Value('i', 0, lock=False),
+        }
+
+        # ADU feedback state
+        self.target_adu_found_v = Value('i', 0)
+        self.current_adu_target_v = Value('d', 0.0)
+        self.hist_adu_a = Array('d', self.adu_history_max)
+        self.hist_adu_count_v = Value('i', 0)
+
+
+    def nextSeq(self):
+        # seq_lock must be held by the caller
+        seq = self._next_seq_v.value
+        self._next_seq_v.value = seq + 1
+        return seq
+
+
+    def wait(self, stage, seq):
+        stage_seq_v = self._stage_seq[stage]
+
+        with self._cond:
+            ready = self._cond.wait_for(lambda: stage_seq_v.value >= seq, timeout=self.order_timeout)
+
+            if not ready:
+                logger.error('Timeout waiting for frame %d %s stage, continuing out of order', stage_seq_v.value, stage)
+
+
+    def advance(self, stage, seq):
+        stage_seq_v = self._stage_seq[stage]
+
+        with self._cond:
+            if stage_seq_v.value <= seq:
+                stage_seq_v.value = seq + 1
+
+            self._cond.notify_all()
+
+
+    def release(self, seq):
+        # ensure all ordered stages are complete for a frame that was not fully processed
+        for stage in self._stage_seq.keys():
+            if self._stage_seq[stage].value > seq:
+                continue
+
+            self.wait(stage, seq)
+            self.advance(stage, seq)
+
+
+    def getHistAdu(self):
+        with self.hist_adu_count_v.get_lock():
+            return list(self.hist_adu_a[:self.hist_adu_count_v.value])
+
+
+    def setHistAdu(self, hist_adu):
+        hist_adu = hist_adu[(self.adu_history_max * -1):]
+
+        with self.hist_adu_count_v.get_lock():
+            self.hist_adu_a[:len(hist_adu)] = hist_adu
+            self.hist_adu_count_v.value = len(hist_adu)
@@ -1,8 +1,8 @@
 import cv2
 import numpy
-import math
 import time
 #import copy
+from pathlib import Path
 from datetime import datetime
 import logging
 from pprint import pformat
@@ -24,6 +24,7 @@ class KeogramGenerator(object):
         self._angle = self.config['KEOGRAM_ANGLE']
         self._v_scale_factor = 100
         self._h_scale_factor = 100
+        self._reduction = 1  # images are decoded at a reduced size
 
         self.original_width = None
         self.original_height = None
@@ -31,7 +32,16 @@ class KeogramGenerator(object):
         self.rotated_width = None
         self.rotated_height = None
 
-        self.keogram_data = None
+        # source coordinates of the rotated center line
+        self._center_line_geometry = None
+        self._center_line_map_x = None
+        self._center_line_map_y = None
+        self._center_line_valid = None  # rows of the center line inside the original image
+
+        self._keogram_store = None  # preallocated columns, grown when full
+        self._keogram_columns = 0
+        self._expected_frames = 0
+        self._store_file = None  # keep the columns in a .npy memmap
 
         self.timestamps_list = list()
         self.image_processing_elapsed_s = 0
@@ -46,6 +56,47 @@ class KeogramGenerator(object):
         self._angle = new_angle
 
 
+    @property
+    def expected_frames(self):
+        return self._expected_frames
+
+    @expected_frames.setter
+    def expected_frames(self, new_expected_frames):
+        # initial size of the column store
+        self._expected_frames = int(new_expected_frames)
+
+
+    @property
+    def store_file(self):
+        return self._store_file
+
+    @store_file.setter
+    def store_file(self, new_store_file):
+        self._store_file = Path(new_store_file)
+
+
+    @property
+    def keogram_columns(self):
+        return self._keogram_columns
+
+
+    @property
+    def keogram_capacity(self):
+        if isinstance(self._keogram_store, type(None)):
+            return 0
+
+        return self._keogram_store.shape[0]
+
+
+    @property
+    def keogram_data(self):
+        if isinstance(self._keogram_store, type(None)):
+            return None
+
+        # columns are stored as rows
+        return numpy.ascontiguousarray(self._keogram_store[:self._keogram_columns].swapaxes(0, 1))
+
+
     @property
     def v_scale_factor(self):
         return self._v_scale_factor
@@ -64,6 +115,16 @@ class KeogramGenerator(object):
         self._h_scale_factor = int(new_factor)
 
 
+    @property
+    def reduction(self):
+        return self._reduction
+
+    @reduction.setter
+    def reduction(self, new_reduction):
+        # the vertical scale is applied relative to the full size image
+        self._reduction = int(new_reduction)
+
+
     def generate(self, outfile, file_list):
         # Exclude empty files
         file_list_nonzero = filter(lambda p: p.stat().st_size != 0, file_list)
@@ -91,38 +152,98 @@ class KeogramGenerator(object):
         logger.warning('Total keogram processing in %0.1f s', processing_elapsed_s)
 
 
-    def processImage(self, filename, image):
+    def processImage(self, filename, image, timestamp=None):
         image_processing_start = time.time()
 
-        self.timestamps_list.append(filename.stat().st_mtime)
+        if isinstance(timestamp, type(None)):
+            timestamp = filename.stat().st_mtime
+
+        self.timestamps_list.append(timestamp)
 
         height, width = image.shape[:2]
         self.original_height = height
         self.original_width = width
 
 
-        rotated_image = self.rotate(image)
+        # only the center line of the rotated image is sampled
+        rotated_center_line = self.sampleCenterLine(image)
         del image
 
+        self._addColumn(rotated_center_line)
+
+        self.image_processing_elapsed_s += time.time() - image_processing_start
 
-        rot_height, rot_width = rotated_image.shape[:2]
-        self.rotated_height = rot_height
-        self.rotated_width = rot_width
 
-        rotated_center_line = rotated_image[:, [int(rot_width / 2)]]
+    def _addColumn(self, column):
+        # each column is stored as a contiguous row of the store
+        if isinstance(self._keogram_store, type(None)):
+            capacity = max(self._expected_frames, 256)
 
-        if isinstance(self.keogram_data, type(None)):
-            new_shape = rotated_center_line.shape
+            new_shape = (capacity,) + column.shape
             logger.info('New Shape: %s', pformat(new_shape))
 
-            new_dtype = rotated_center_line.dtype
+            new_dtype = column.dtype
             logger.info('New dtype: %s', new_dtype)
 
-            self.keogram_data = numpy.empty(new_shape, dtype=new_dtype)
+            self._keogram_store = self._newStore(new_shape, new_dtype)
+            self._commitStore()
 
-        self.keogram_data = numpy.append(self.keogram_data, rotated_center_line, 1)
+        elif column.shape != self._keogram_store.shape[1:]:
+            logger.error('Image dimensions changed, skipping keogram column')
+            return
+
+        elif self._keogram_columns == self._keogram_store.shape[0]:
+            # double the capacity
+            new_store = self._newStore((self._keogram_store.shape[0] * 2,) + self._keogram_store.shape[1:], self._keogram_store.dtype)
+            new_store[:self._keogram_columns] = self._keogram_store[:self._keogram_columns]
+            self._keogram_store = new_store
+            self._commitStore()
 
-        self.image_processing_elapsed_s += time.time() - image_processing_start
+
+        self._keogram_store[self._keogram_columns] = column
+        self._keogram_columns += 1
+
+
+    def _newStore(self, shape, dtype):
+        if not self._store_file:
+            return numpy.empty(shape, dtype=dtype)
+
+        store_tmp_p = self._store_file.with_name('{0:s}.tmp'.format(self._store_file.name))
+        return numpy.lib.format.open_memmap(str(store_tmp_p), mode='w+', dtype=dtype, shape=shape)
+
+
+    def _commitStore(self):
+        if not self._store_file:
+            return
+
+        store_tmp_p = self._store_file.with_name('{0:s}.tmp'.format(self._store_file.name))
+        store_tmp_p.replace(self._store_file)
+
+
+    def flush(self):
+        if isinstance(self._keogram_store, numpy.memmap):
+            self._keogram_store.flush()
+
+
+    def loadStore(self, store_file, columns, timestamps_list, original_width, original_height):
+        # resume from a checkpoint
+        self._store_file = Path(store_file)
+        self._keogram_store = numpy.lib.format.open_memmap(str(self._store_file), mode='r+')
+        self._keogram_columns = int(columns)
+
+        self.timestamps_list = list(timestamps_list)[:self._keogram_columns]
+
+        self.original_width = int(original_width)
+        self.original_height = int(original_height)
+        self._generateCenterLineMap(self.original_width, self.original_height)
+
+        logger.info('Loaded %d keogram columns from %s', self._keogram_columns, self._store_file)
+
+
+    def syncStore(self, columns, timestamps_list):
+        # columns added to the same store by another process
+        self._keogram_columns = int(columns)
+        self.timestamps_list = list(timestamps_list)[:self._keogram_columns]
 
 
     def finalize(self, outfile):
@@ -134,7 +255,7 @@ class KeogramGenerator(object):
         # scale horizontal size
         trimmed_height, trimmed_width = keogram_trimmed.shape[:2]
         new_width = int(trimmed_width * self._h_scale_factor / 100)
-        new_height = int(trimmed_height * self._v_scale_factor / 100)
+        new_height = int(trimmed_height * self._v_scale_factor * self._reduction / 100)
         keogram_resized = cv2.resize(keogram_trimmed, (new_width, new_height), interpolation=cv2.INTER_AREA)
 
         # apply time labels
@@ -157,8 +278,27 @@ class KeogramGenerator(object):
         logger.info('Image compressed in %0.4f s', write_img_elapsed_s)
 
 
-    def rotate(self, image):
+    def sampleCenterLine(self, image):
         height, width = image.shape[:2]
+
+        if self._center_line_geometry != (width, height, self._angle):
+            self._generateCenterLineMap(width, height)
+
+        center_line = cv2.remap(
+            image,
+            self._center_line_map_x,
+            self._center_line_map_y,
+            interpolation=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=0,
+        )
+
+        # remap returns a 1 pixel wide image
+        return center_line[:, 0]
+
+
+    def _generateCenterLineMap(self, width, height):
+        # rotated image bounds, the rotated image is not generated
         center = (width / 2, height / 2)
 
         rot = cv2.getRotationMatrix2D(center, self._angle, 1.0)
@@ -172,61 +312,53 @@ class KeogramGenerator(object):
         rot[0, 2] += bound_w / 2 - center[0]
         rot[1, 2] += bound_h / 2 - center[1]
 
-        rotated = cv2.warpAffine(image, rot, (bound_w, bound_h))
+        self.rotated_width = bound_w
+        self.rotated_height = bound_h
 
-        return rotated
 
+        # map the center column of the rotated image back to the original image
+        inv_rot = cv2.invertAffineTransform(rot)
 
-    def trimEdges(self, image):
-        # if the rotation angle exceeds the diagonal angle of the original image, use the height as the hypotenuse
-        switch_angle = 90 - math.degrees(math.atan(self.original_height / self.original_width))
-        logger.info('Switch angle: %0.2f', switch_angle)
+        rot_y = numpy.arange(bound_h, dtype=numpy.float64)
+        rot_x = numpy.full(bound_h, int(bound_w / 2), dtype=numpy.float64)
 
+        src_x = (inv_rot[0, 0] * rot_x) + (inv_rot[0, 1] * rot_y) + inv_rot[0, 2]
+        src_y = (inv_rot[1, 0] * rot_x) + (inv_rot[1, 1] * rot_y) + inv_rot[1, 2]
 
-        angle_180_r = abs(self._angle) % 180
-        if angle_180_r > 90:
-            angle_90_r = 90 - (abs(self._angle) % 90)
-        else:
-            angle_90_r = abs(self._angle) % 90
+        self._center_line_map_x = src_x.astype(numpy.float32).reshape((bound_h, 1))
+        self._center_line_map_y = src_y.astype(numpy.float32).reshape((bound_h, 1))
 
 
-        if angle_90_r < switch_angle:
-            hyp_1 = self.original_width
-            c_angle = angle_90_r
+        valid = numpy.nonzero((src_x >= 0) & (src_x <= width - 1) & (src_y >= 0) & (src_y <= height - 1))[0]
+        if len(valid):
+            self._center_line_valid = (int(valid[0]), int(valid[-1]) + 1)
         else:
-            hyp_1 = self.original_height
-            c_angle = 90 - angle_90_r
+            self._center_line_valid = (0, bound_h)
+
+        logger.info('Keogram center line: %d pixels, rows %d - %d inside the image', bound_h, *self._center_line_valid)
 
+        self._center_line_geometry = (width, height, self._angle)
 
-        logger.info('Trim angle: %d', c_angle)
 
+    def trimEdges(self, image):
+        # rows outside the original image are known from the center line map
         height, width = image.shape[:2]
         logger.info('Keogram dimensions: %d x %d', width, height)
         logger.info('Original image dimensions: %d x %d', self.original_width, self.original_height)
         logger.info('Original rotated image dimensions: %d x %d', self.rotated_width, self.rotated_height)
 
-
-        adj_1 = math.cos(math.radians(c_angle)) * hyp_1
-        adj_2 = adj_1 - (self.rotated_width / 2)
-
-        trim_height_pre = math.tan(math.radians(c_angle)) * adj_2
+        valid_y1, valid_y2 = self._center_line_valid
 
         # trim double the orb radius so they do not show up in the keograms
-        trim_height = trim_height_pre + (self.config['ORB_PROPERTIES']['RADIUS'] * 2)
-
-        trim_height_int = int(trim_height)
-        logger.info('Trim height: %d', trim_height_int)
-
+        orb_trim = int(self.config['ORB_PROPERTIES']['RADIUS'] * 2 / self._reduction)
 
-        x1 = 0
-        y1 = trim_height_int
-        x2 = width
-        y2 = height - trim_height_int
+        y1 = min(valid_y1 + orb_trim, height)
+        y2 = max(valid_y2 - orb_trim, y1)
 
-        logger.info('Calculated trimmed area: (%d, %d) (%d, %d)', x1, y1, x2, y2)
+        logger.info('Calculated trimmed area: (%d, %d) (%d, %d)', 0, y1, width, y2)
         trimmed_image = image[
             y1:y2,
-            x1:x2,
+            0:width,
         ]
 
         trimmed_height, trimmed_width = trimmed_image.shape[:2]
@@ -0,0 +1,338 @@
+import io
+import time
+import json
+import shutil
+from pathlib import Path
+from datetime import timedelta
+import logging
+
+import cv2
+import numpy
+
+from .keogram import KeogramGenerator
+from .starTrails import StarTrailGenerator
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyLiveProducts(object):
+    # Keogram and star trail for the current day/night, updated from each processed image
+    #
+    # The keogram columns and star trail image are kept in .npy memmaps and the
+    # state is checkpointed periodically so a restart resumes the night.  The
+    # end of night task only needs to finalize the products.
+
+    state_file = 'state.json'
+    keogram_file = 'keogram.npy'
+    startrail_file = 'startrail.npy'
+    placeholder_file = 'placeholder.npy'
+    timelapse_folder = 'startrail_timelapse'
+
+
+    def __init__(self, config, bin_v, mask=None):
+        self.config = config
+        self.bin_v = bin_v
+        self._mask = mask
+
+        self._checkpoint_frames = int(self.config.get('KEOGRAM_STARTRAILS_CHECKPOINT', 10))
+        self._preview_period = float(self.config.get('KEOGRAM_STARTRAILS_PREVIEW_PERIOD', 300))
+
+        # image workers share the products on disk
+        self._shared = int(self.config.get('IMAGE_WORKERS', 1)) > 1
+        if self._shared:
+            self._checkpoint_frames = 1
+
+        self._key = None
+        self._folder_p = None
+        self._frames = 0
+        self._placeholder_adu_saved = None
+
+        self.keogram = None
+        self.startrail = None
+
+
+    @classmethod
+    def folder(cls, config, camera_id, timespec, timeofday):
+        if config.get('IMAGE_FOLDER'):
+            image_dir = Path(config['IMAGE_FOLDER']).absolute()
+        else:
+            image_dir = Path(__file__).parent.parent.joinpath('html', 'images').absolute()
+
+        return image_dir.joinpath('live', 'ccd{0:d}_{1:s}_{2:s}'.format(camera_id, timespec, timeofday))
+
+
+    @property
+    def frames(self):
+        return self._frames
+
+
+    def processImage(self, image, exp_date, night, camera_id):
+        if night:
+            # night products go in the previous day's folder until noon
+            day_ref = exp_date - timedelta(hours=12)
+            timeofday = 'night'
+        else:
+            day_ref = exp_date
+            timeofday = 'day'
+
+        key = (camera_id, day_ref.strftime('%Y%m%d'), timeofday)
+
+        if key != self._key:
+            self.close()  # finish the previous period
+            self._open(key)
+        elif self._shared:
+            self._sync()
+
+
+        timestamp = exp_date.timestamp()
+
+        self.keogram.processImage(None, image, timestamp=timestamp)
+
+        if night:
+            self.startrail.processImage(None, image, timestamp=timestamp)
+
+        self._frames += 1
+
+
+        if self._frames % self._checkpoint_frames == 0:
+            self.checkpoint()
+
+
+    def close(self):
+        # shared products are checkpointed after every frame, a stale state must not be written
+        if self._shared:
+            return
+
+        self.checkpoint()
+
+
+    def restore(self, camera_id, timespec, timeofday):
+        # load a checkpoint for finalizing, returns the number of frames
+        folder_p = self.folder(self.config, camera_id, timespec, timeofday)
+        if not folder_p.joinpath(self.state_file).exists():
+            return 0
+
+        self._open((camera_id, timespec, timeofday))
+
+        return self._frames
+
+
+    def remove(self):
+        if not self._folder_p:
+            return
+
+        logger.info('Removing live products: %s', self._folder_p)
+        shutil.rmtree(str(self._folder_p), ignore_errors=True)
+
+        self._key = None
+        self._folder_p = None
+
+
+    def _open(self, key):
+        camera_id, timespec, timeofday = key
+
+        self._key = key
+        self._folder_p = self.folder(self.config, camera_id, timespec, timeofday)
+
+        timelapse_folder_p = self._folder_p.joinpath(self.timelapse_folder)
+        if not timelapse_folder_p.exists():
+            timelapse_folder_p.mkdir(mode=0o755, parents=True)
+
+
+        self.keogram = KeogramGenerator(self.config)
+        self.keogram.angle = self.config['KEOGRAM_ANGLE']
+        self.keogram.h_scale_factor = self.config['KEOGRAM_H_SCALE']
+        self.keogram.v_scale_factor = self.config['KEOGRAM_V_SCALE']
+        self.keogram.store_file = self._folder_p.joinpath(self.keogram_file)
+
+        if timeofday == 'night':
+            self.startrail = StarTrailGenerator(self.config, self.bin_v, mask=self._mask)
+            self.startrail.max_brightness = self.config['STARTRAILS_MAX_ADU']
+            self.startrail.mask_threshold = self.config['STARTRAILS_MASK_THOLD']
+            self.startrail.pixel_cutoff_threshold = self.config['STARTRAILS_PIXEL_THOLD']
+            self.startrail.trail_file = self._folder_p.joinpath(self.startrail_file)
+            self.startrail.timelapse_folder = timelapse_folder_p
+        else:
+            self.startrail = None
+
+
+        state = self._readState()
+        if not state:
+            logger.info('Starting live products in %s', self._folder_p)
+            self._frames = 0
+            self._placeholder_adu_saved = None
+            return
+
+
+        self._frames = state['frames']
+
+        if state['keogram_columns']:
+            self.keogram.loadStore(
+                self._folder_p.joinpath(self.keogram_file),
+                state['keogram_columns'],
+                state['timestamps'],
+                state['original_width'],
+                state['original_height'],
+            )
+
+
+        self._loadTrail(state)
+
+
+        logger.info('Resumed live products with %d frames from %s', self._frames, self._folder_p)
+
+
+    def _loadTrail(self, state):
+        startrail_p = self._folder_p.joinpath(self.startrail_file)
+        if not self.startrail or not state.get('startrail') or not startrail_p.exists():
+            return
+
+        self.startrail.loadTrail(startrail_p, state['startrail'], placeholder_image=self._loadPlaceholder())
+        self._placeholder_adu_saved = self.startrail.placeholder_adu
+
+
+    def _loadPlaceholder(self):
+        placeholder_p = self._folder_p.joinpath(self.placeholder_file)
+        if not placeholder_p.exists():
+            return None
+
+        return numpy.load(str(placeholder_p))
+
+
+    def _sync(self):
+        # another image worker may have added frames
+        #
+        # The memmaps are shared with the other workers and stay open, only the
+        # state is re-read.  The keogram store is reopened when it was replaced.
+        state = self._readState()
+        if not state:
+            return
+
+        if state['frames'] == self._frames:
+            return
+
+        self._frames = state['frames']
+
+
+        if state['keogram_columns']:
+            if state.get('keogram_capacity') != self.keogram.keogram_capacity:
+                self.keogram.loadStore(
+                    self._folder_p.joinpath(self.keogram_file),
+                    state['keogram_columns'],
+                    state['timestamps'],
+                    state['original_width'],
+                    state['original_height'],
+                )
+            else:
+                self.keogram.syncStore(state['keogram_columns'], state['timestamps'])
+
+
+        if not self.startrail or not state.get('startrail'):
+            return
+
+        if isinstance(self.startrail.trail_image, type(None)):
+            # trail image started by another worker
+            self._loadTrail(state)
+            return
+
+        self.startrail.syncTrail(state['startrail'])
+
+        if self.startrail.placeholder_adu != self._placeholder_adu_saved:
+            self.startrail.placeholder_image = self._loadPlaceholder()
+            self._placeholder_adu_saved = self.startrail.placeholder_adu
+
+
+    def _readState(self):
+        state_p = self._folder_p.joinpath(self.state_file)
+
+        try:
+            with io.open(str(state_p), 'r') as f_state:
+                return json.load(f_state)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError as e:
+            logger.error('Error decoding live products state: %s', str(e))
+            return None
+
+
+    def checkpoint(self):
+        if not self._key:
+            return
+
+        self.keogram.flush()
+
+        state = {
+            'frames'           : self._frames,
+            'keogram_columns'  : self.keogram.keogram_columns,
+            'keogram_capacity' : self.keogram.keogram_capacity,
+            'timestamps'       : self.keogram.timestamps_list,
+            'original_width'   : self.keogram.original_width,
+            'original_height'  : self.keogram.original_height,
+            'startrail'        : None,
+        }
+
+
+        if self.startrail and not isinstance(self.startrail.trail_image, type(None)):
+            self.startrail.flush()
+
+            if not isinstance(self.startrail.placeholder_image, type(None)) and self.startrail.placeholder_adu != self._placeholder_adu_saved:
+                placeholder_tmp_p = self._folder_p.joinpath('{0:s}.tmp'.format(self.placeholder_file))
+
+                with io.open(str(placeholder_tmp_p), 'wb') as f_placeholder:
+                    numpy.save(f_placeholder, self.startrail.placeholder_image)
+
+                placeholder_tmp_p.replace(self._folder_p.joinpath(self.placeholder_file))
+                self._placeholder_adu_saved = self.startrail.placeholder_adu
+
+            state['startrail'] = {
+                'trail_count'      : self.startrail.trail_count,
+                'excluded_images'  : self.startrail.excluded_images,
+                'placeholder_adu'  : self.startrail.placeholder_adu,
+            }
+
+
+        state_tmp_p = self._folder_p.joinpath('{0:s}.tmp'.format(self.state_file))
+
+        with io.open(str(state_tmp_p), 'w') as f_state:
+            json.dump(state, f_state)
+
+        state_tmp_p.replace(self._folder_p.joinpath(self.state_file))
+
+
+    def writePreview(self):
+        # partial products for the web interface, returns True when written
+        #
+        # This is called after the ordered commit stage.  The age of the keogram
+        # preview limits the rate for all image workers.
+        if not self.config.get('KEOGRAM_STARTRAILS_LIVE_PREVIEW', True):
+            return False
+
+        if not self._key or not self.keogram.keogram_columns:
+            return False
+
+        image_type = self.config['IMAGE_FILE_TYPE']
+
+        keogram_p = self._folder_p.joinpath('keogram.{0:s}'.format(image_type))
+
+        try:
+            if time.time() - keogram_p.stat().st_mtime < self._preview_period:
+                return False
+        except FileNotFoundError:
+            pass
+
+
+        self.keogram.finalize(keogram_p)
+
+        if self.startrail and self.startrail.trail_count:
+            preview_p = self._folder_p.joinpath('startrail.{0:s}'.format(image_type))
+
+            if image_type in ('jpg', 'jpeg'):
+                cv2.imwrite(str(preview_p), self.startrail.trail_image, [cv2.IMWRITE_JPEG_QUALITY, self.config['IMAGE_FILE_COMPRESSION']['jpg']])
+            elif image_type in ('png',):
+                cv2.imwrite(str(preview_p), self.startrail.trail_image, [cv2.IMWRITE_PNG_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['png']])
+            elif image_type in ('tif', 'tiff'):
+                cv2.imwrite(str(preview_p), self.startrail.trail_image, [cv2.IMWRITE_TIFF_COMPRESSION, self.config['IMAGE_FILE_COMPRESSION']['tif']])
+
+        return True
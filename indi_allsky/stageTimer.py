@@ -0,0 +1,253 @@
+import io
+import time
+import json
+from pathlib import Path
+from collections import deque
+import logging
+
+import numpy
+
+
+logger = logging.getLogger('indi_allsky')
+
+
+
+class IndiAllSkyStageTimer(object):
+    # Per stage timing of the image processing pipeline
+
+    stages = (
+        'fits_open',
+        'bit_depth',
+        'calibrate',
+        'sqm',
+        'debayer',
+        'export_raw',
+        'convert_8bit',
+        'rotate_flip',
+        'histogram',
+        'detect_lines',
+        'detect_stars',
+        'draw',
+        'crop',
+        'scnr',
+        'white_balance',
+        'clahe',
+        'scale',
+        'text',
+        'encode',
+        'db_insert',
+        'live_products',
+        'live_preview',
+        'fits_write',
+    )
+
+
+    def __init__(self, config, history=300):
+        self.config = config
+
+        # rolling history of the last frames
+        self._history = {stage: deque(maxlen=history) for stage in self.stages}
+
+        # run-wide stats
+        self._run_count = {stage: 0 for stage in self.stages}
+        self._run_total = {stage: 0.0 for stage in self.stages}
+        self._run_max = {stage: 0.0 for stage in self.stages}
+
+        self._frame_count = 0
+        self._frame = dict()
+        self._last = time.time()
+
+        if self.config.get('IMAGE_TIMING_CSV'):
+            self._csv_p = Path(self.config['IMAGE_TIMING_CSV'])
+        else:
+            self._csv_p = None
+
+
+    def start(self):
+        self._frame = dict()
+        self._last = time.time()
+
+
+    def reset(self):
+        # time since the last mark is not assigned to a stage
+        self._last = time.time()
+
+
+    def mark(self, stage):
+        # time since the last mark is assigned to the stage
+        now = time.time()
+        self._frame[stage] = self._frame.get(stage, 0.0) + (now - self._last)
+        self._last = now
+
+
+    def finish(self, exp_date):
+        self._frame_count += 1
+
+        for stage, elapsed_s in self._frame.items():
+            self._history[stage].append(elapsed_s)
+
+            self._run_count[stage] += 1
+            self._run_total[stage] += elapsed_s
+            self._run_max[stage] = max(self._run_max[stage], elapsed_s)
+
+
+        logger.info(
+            'Stage timings: %s',
+            ', '.join(['{0:s} {1:0.4f}'.format(s, self._frame[s]) for s in self.stages if s in self._frame]),
+        )
+
+
+        if self._csv_p:
+            self._writeCsv(exp_date)
+
+
+    def summary(self):
+        stage_stats = dict()
+
+        for stage in self.stages:
+            history = self._history[stage]
+            if not history:
+                continue
+
+            history_array = numpy.array(history)
+
+            stage_stats[stage] = {
+                'count'    : len(history),
+                'p50'      : round(float(numpy.percentile(history_array, 50)), 6),
+                'p95'      : round(float(numpy.percentile(history_array, 95)), 6),
+                'max'      : round(float(numpy.amax(history_array)), 6),
+                'run_count': self._run_count[stage],
+                'run_mean' : round(self._run_total[stage] / self._run_count[stage], 6),
+                'run_max'  : round(self._run_max[stage], 6),
+            }
+
+
+        data = {
+            'frames' : self._frame_count,
+            'time'   : int(time.time()),
+            'stages' : stage_stats,
+        }
+
+        return data
+
+
+    @staticmethod
+    def workerFile(timing_p, worker_slot):
+        # each image worker writes its own file, merged by mergeJson()
+        return timing_p.with_name('{0:s}_{1:d}{2:s}'.format(timing_p.stem, worker_slot, timing_p.suffix))
+
+
+    def writeJson(self, timing_p):
+        data = self.summary()
+
+        # the rolling history is needed to merge percentiles of several workers
+        data['history'] = {stage: [round(x, 6) for x in self._history[stage]] for stage in data['stages'].keys()}
+
+        timing_tmp_p = timing_p.with_name('{0:s}.tmp'.format(timing_p.name))
+
+        try:
+            with io.open(str(timing_tmp_p), 'w') as f_timing:
+                json.dump(data, f_timing)
+
+            timing_tmp_p.chmod(0o644)
+            timing_tmp_p.replace(timing_p)
+        except OSError as e:
+            logger.error('Unable to write stage timings: %s', str(e))
+
+
+    @classmethod
+    def mergeJson(cls, timing_p, max_age=3600):
+        # combined stats of the worker files, files of stopped workers are skipped after max_age seconds
+        worker_list = list()
+        for worker_p in sorted(timing_p.parent.glob('{0:s}_*{1:s}'.format(timing_p.stem, timing_p.suffix))):
+            try:
+                with io.open(str(worker_p), 'r') as f_timing:
+                    worker_list.append(json.load(f_timing))
+            except OSError as e:
+                logger.error('Unable to read %s: %s', worker_p, str(e))
+            except json.JSONDecodeError as e:
+                logger.error('Error decoding %s: %s', worker_p, str(e))
+
+
+        if not worker_list:
+            return dict()
+
+        latest_time = max([w['time'] for w in worker_list])
+        worker_list = [w for w in worker_list if latest_time - w['time'] < max_age]
+
+
+        stage_stats = dict()
+        for stage in cls.stages:
+            stage_workers = [w for w in worker_list if stage in w['stages']]
+            if not stage_workers:
+                continue
+
+            history_list = list()
+            for w in stage_workers:
+                history_list.extend(w.get('history', {}).get(stage, []))
+
+            run_count = sum([w['stages'][stage]['run_count'] for w in stage_workers])
+            run_total = sum([w['stages'][stage]['run_mean'] * w['stages'][stage]['run_count'] for w in stage_workers])
+
+            stage_stats[stage] = {
+                'count'    : len(history_list),
+                'run_count': run_count,
+                'run_mean' : round(run_total / run_count, 6),
+                'run_max'  : max([w['stages'][stage]['run_max'] for w in stage_workers]),
+            }
+
+            if history_list:
+                history_array = numpy.array(history_list)
+
+                stage_stats[stage]['p50'] = round(float(numpy.percentile(history_array, 50)), 6)
+                stage_stats[stage]['p95'] = round(float(numpy.percentile(history_array, 95)), 6)
+                stage_stats[stage]['max'] = round(float(numpy.amax(history_array)), 6)
+
+
+        data = {
+            'frames'  : sum([w['frames'] for w in worker_list]),
+            'time'    : latest_time,
+            'workers' : len(worker_list),
+            'stages'  : stage_stats,
+        }
+
+        return data
+
+
+    def logSummary(self):
+        summary = self.summary()
+
+        logger.info('Stage timing summary for %d frames', summary['frames'])
+        for stage, stats in summary['stages'].items():
+            logger.info(
+                ' %-14s p50 %0.4f s, p95 %0.4f s, max %0.4f s, run mean %0.4f s, run max %0.4f s',
+                stage,
+                stats['p50'],
+                stats['p95'],
+                stats['max'],
+                stats['run_mean'],
+                stats['run_max'],
+            )
+
+
+    def _writeCsv(self, exp_date):
+        write_header = not self._csv_p.exists()
+
+        try:
+            with io.open(str(self._csv_p), 'a') as f_csv:
+                if write_header:
+                    f_csv.write(','.join(('time',) + self.stages) + '\n')
+
+                row = [exp_date.strftime('%Y-%m-%d %H:%M:%S')]
+                for stage in self.stages:
+                    elapsed_s = self._frame.get(stage)
+
+                    if isinstance(elapsed_s, type(None)):
+                        row.append('')
+                    else:
+                        row.append('{0:0.6f}'.format(elapsed_s))
+
+                f_csv.write(','.join(row) + '\n')
+        except OSError as e:
+            logger.error('Unable to write stage timing CSV: %s', str(e))
+            self._csv_p = None  # disable
@@ -6,6 +6,8 @@ from pathlib import Path
 import tempfile
 import logging
 
+from .timelapse import TimelapseGenerator
+
 
 logger = logging.getLogger('indi_allsky')
 
@@ -23,6 +25,7 @@ class StarTrailGenerator(object):
 
         self.trail_image = None
         self.trail_count = 0
+        self._trail_file = None  # keep the trail image in a .npy memmap
         self.pixels_cutoff = None
         self.excluded_images = 0
 
@@ -38,6 +41,9 @@ class StarTrailGenerator(object):
         self._timelapse_frame_count = 0
         self._timelapse_frame_list = list()
 
+        self._timelapse_file = None  # frames are piped to ffmpeg instead of written to files
+        self._timelapse_stream = None
+
 
         if self.config['IMAGE_FOLDER']:
             self.image_dir = Path(self.config['IMAGE_FOLDER']).absolute()
@@ -47,6 +53,7 @@ class StarTrailGenerator(object):
 
         self.timelapse_tmpdir = tempfile.TemporaryDirectory(dir=self.image_dir, suffix='_startrail_timelapse')
         self.timelapse_tmpdir_p = Path(self.timelapse_tmpdir.name)
+        self._timelapse_folder_p = self.timelapse_tmpdir_p
 
 
     def __del__(self):
@@ -93,6 +100,31 @@ class StarTrailGenerator(object):
     def timelapse_frame_list(self, new_frame_list):
         return  # read only
 
+    @property
+    def timelapse_folder(self):
+        return self._timelapse_folder_p
+
+    @timelapse_folder.setter
+    def timelapse_folder(self, new_folder):
+        # persistent folder for timelapse frames, not removed by cleanup()
+        self._timelapse_folder_p = Path(new_folder)
+
+    @property
+    def timelapse_file(self):
+        return self._timelapse_file
+
+    @timelapse_file.setter
+    def timelapse_file(self, new_timelapse_file):
+        self._timelapse_file = Path(new_timelapse_file)
+
+    @property
+    def trail_file(self):
+        return self._trail_file
+
+    @trail_file.setter
+    def trail_file(self, new_trail_file):
+        self._trail_file = Path(new_trail_file)
+
 
     def generate(self, outfile, file_list):
         # Exclude empty files
@@ -122,7 +154,7 @@ class StarTrailGenerator(object):
         logger.warning('Total star trail processing in %0.1f s', processing_elapsed_s)
 
 
-    def processImage(self, file_p, image):
+    def processImage(self, file_p, image, timestamp=None):
         image_processing_start = time.time()
 
 
@@ -132,11 +164,19 @@ class StarTrailGenerator(object):
             self.pixels_cutoff = (image_height * image_width) * (self._pixel_cutoff_threshold / 100)
 
             # base image is just a black image
-            if len(image.shape) == 2:
+            if self._trail_file:
+                # new memmap files are zero filled
+                self.trail_image = numpy.lib.format.open_memmap(str(self._trail_file), mode='w+', dtype=numpy.uint8, shape=image.shape)
+            elif len(image.shape) == 2:
                 self.trail_image = numpy.zeros((image_height, image_width), dtype=numpy.uint8)
             else:
                 self.trail_image = numpy.zeros((image_height, image_width, 3), dtype=numpy.uint8)
 
+        elif self.trail_image.shape != image.shape:
+            logger.error('Image dimensions changed, skipping star trail image')
+            self.excluded_images += 1
+            return
+
 
         if isinstance(self._sqm_mask, type(None)):
             self._generateSqmMask(image)
@@ -175,14 +215,21 @@ class StarTrailGenerator(object):
 
 
         ### Here is the magic
-        self.trail_image = cv2.max(self.trail_image, image)
+        numpy.maximum(self.trail_image, image, out=self.trail_image)
 
 
         # Star trail timelapse processing
-        if self.config.get('STARTRAILS_TIMELAPSE', True):
-            image_mtime = file_p.stat().st_mtime
+        if self.config.get('STARTRAILS_TIMELAPSE', True) and self._timelapse_file:
+            self._streamTimelapseFrame()
 
-            f_tmp_frame = tempfile.NamedTemporaryFile(dir=self.timelapse_tmpdir_p, suffix='.{0:s}'.format(self.config['IMAGE_FILE_TYPE']), delete=False)
+        if self.config.get('STARTRAILS_TIMELAPSE', True) and not self._timelapse_file:
+            # frames are written to files when not streaming (live products, or ffmpeg could not be started)
+            if isinstance(timestamp, type(None)):
+                image_mtime = file_p.stat().st_mtime
+            else:
+                image_mtime = timestamp
+
+            f_tmp_frame = tempfile.NamedTemporaryFile(dir=self._timelapse_folder_p, prefix='{0:d}_'.format(int(image_mtime)), suffix='.{0:s}'.format(self.config['IMAGE_FILE_TYPE']), delete=False)
             f_tmp_frame.close()
 
             f_tmp_frame_p = Path(f_tmp_frame.name)
@@ -206,8 +253,52 @@ class StarTrailGenerator(object):
         self.image_processing_elapsed_s += time.time() - image_processing_start
 
 
+    def _streamTimelapseFrame(self):
+        if not self._timelapse_stream:
+            image_height, image_width = self.trail_image.shape[:2]
+
+            if len(self.trail_image.shape) == 2:
+                pix_fmt = 'gray'
+            else:
+                pix_fmt = 'bgr24'
+
+            self._timelapse_stream = TimelapseGenerator(self.config)
+            if not self._timelapse_stream.openStream(self._timelapse_file, image_width, image_height, pix_fmt=pix_fmt):
+                self._timelapse_file = None
+                return
+
+        if self._timelapse_stream.writeFrame(self.trail_image):
+            self._timelapse_frame_count += 1
+            return
+
+        if not self._timelapse_stream.streaming:
+            # remaining frames are written to files
+            logger.error('Star trail timelapse stream failed, falling back to frame files')
+            self._discardTimelapseStream()
+
+
+    def _discardTimelapseStream(self):
+        # the partial video is not usable
+        self._timelapse_stream.closeStream()
+        self._timelapse_stream = None
+
+        try:
+            self._timelapse_file.unlink()
+        except FileNotFoundError:
+            pass
+
+        self._timelapse_file = None
+        self._timelapse_frame_count = 0
+
+
     def finalize(self, outfile):
         logger.warning('Star trails images processed in %0.1f s', self.image_processing_elapsed_s)
+
+        if self._timelapse_stream:
+            if self._timelapse_stream.closeStream() not in (0, None):
+                logger.error('Star trail timelapse encoding failed, discarding %s', self._timelapse_file)
+                self._discardTimelapseStream()
+
         logger.warning('Excluded %d images', self.excluded_images)
 
 
@@ -232,8 +323,41 @@ class StarTrailGenerator(object):
         logger.info('Image compressed in %0.4f s', write_img_elapsed_s)
 
 
+    def flush(self):
+        if isinstance(self.trail_image, numpy.memmap):
+            self.trail_image.flush()
+
+
+    def loadTrail(self, trail_file, state, placeholder_image=None):
+        # resume from a checkpoint
+        self._trail_file = Path(trail_file)
+        self.trail_image = numpy.lib.format.open_memmap(str(self._trail_file), mode='r+')
+
+        image_height, image_width = self.trail_image.shape[:2]
+        self.pixels_cutoff = (image_height * image_width) * (self._pixel_cutoff_threshold / 100)
+
+        self.syncTrail(state)
+        self.placeholder_image = placeholder_image
+
+        # frames are named by timestamp
+        self._timelapse_frame_list = sorted(self._timelapse_folder_p.glob('*.{0:s}'.format(self.config['IMAGE_FILE_TYPE'])))
+        self._timelapse_frame_count = len(self._timelapse_frame_list)
+
+        logger.info('Loaded star trail with %d images from %s', self.trail_count, self._trail_file)
+
+
+    def syncTrail(self, state):
+        # images added to the same trail image by another process
+        self.trail_count = int(state['trail_count'])
+        self.excluded_images = int(state['excluded_images'])
+        self.placeholder_adu = float(state['placeholder_adu'])
+
+
     def cleanup(self):
         # cleanup the folder
+        if self._timelapse_stream:
+            self._timelapse_stream.cleanup()
+
         self.timelapse_tmpdir.cleanup()
 
 
@@ -12,15 +12,23 @@ class IndiAllSkyStars(object):
 
     _distanceThreshold = 10
 
+    _pyramidChunkSize = 1000  # downscaled matches refined per full resolution mosaic
+
 
     def __init__(self, config, bin_v, mask=None):
         self.config = config
         self.bin_v = bin_v
 
         self._sqm_mask = mask
+        self._sqm_mask_rect = None
+        self._sqm_mask_crop = None
 
         self._detectionThreshold = self.config.get('DETECT_STARS_THOLD', 0.6)
 
+        # 0 = full resolution, 1 = 2x downscale
+        # the star template is only 4 pixels at 4x downscale, too small to reject noise
+        self._pyramid_level = min(int(self.config.get('DETECT_PYRAMID_LEVEL', 0)), 1)
+
         if self.config['IMAGE_FOLDER']:
             self.image_dir = Path(self.config['IMAGE_FOLDER']).absolute()
         else:
@@ -48,36 +56,47 @@ class IndiAllSkyStars(object):
         self.star_template_w, self.star_template_h = self.star_template.shape[::-1]
 
 
+        self.pyramid_template = self.star_template
+        for i in range(self._pyramid_level):
+            self.pyramid_template = cv2.pyrDown(self.pyramid_template)
+
+
     def detectObjects(self, original_data):
         if isinstance(self._sqm_mask, type(None)):
             # This only needs to be done once if a mask is not provided
             self._generateSqmMask(original_data)
 
-        masked_img = cv2.bitwise_and(original_data, original_data, mask=self._sqm_mask)
+        if isinstance(self._sqm_mask_rect, type(None)):
+            self._generateSqmMaskRect()
+
+
+        # only the bounding rectangle of the mask is processed
+        x, y, w, h = self._sqm_mask_rect
+        roi_data = original_data[y:y + h, x:x + w]
 
         if len(original_data.shape) == 2:
             # gray scale or bayered
-            grey_img = masked_img
+            grey_img = roi_data
         else:
             # assume color
-            grey_img = cv2.cvtColor(masked_img, cv2.COLOR_BGR2GRAY)
+            grey_img = cv2.cvtColor(roi_data, cv2.COLOR_BGR2GRAY)
 
+        if not isinstance(self._sqm_mask_crop, type(None)):
+            # mask is not rectangular
+            grey_img = cv2.bitwise_and(grey_img, grey_img, mask=self._sqm_mask_crop)
 
-        sep_start = time.time()
 
+        sep_start = time.time()
 
-        result = cv2.matchTemplate(grey_img, self.star_template, cv2.TM_CCOEFF_NORMED)
-        result_filter = numpy.where(result >= self._detectionThreshold)
 
-        blobs = list()
-        for pt in zip(*result_filter[::-1]):
-            for blob in blobs:
-                if (abs(pt[0] - blob[0]) < self._distanceThreshold) and (abs(pt[1] - blob[1]) < self._distanceThreshold):
-                    break
+        if self._pyramid_level:
+            roi_blobs = self._detectPyramid(grey_img)
+        else:
+            result = cv2.matchTemplate(grey_img, self.star_template, cv2.TM_CCOEFF_NORMED)
+            roi_blobs = self._findPeaks(result)
 
-            else:
-                # if none of the points are under the distance threshold, then add it
-                blobs.append(pt)
+        # offset to full frame coordinates
+        blobs = [(blob_x + x, blob_y + y) for blob_x, blob_y in roi_blobs]
 
 
         sep_elapsed_s = time.time() - sep_start
@@ -90,6 +109,144 @@ class IndiAllSkyStars(object):
         return blobs
 
 
+    def _findPeaks(self, result, threshold=None, distance=None):
+        # Non-maximum suppression, a point is kept if it is the maximum
+        # response within the distance threshold in both axes
+        if isinstance(threshold, type(None)):
+            threshold = self._detectionThreshold
+
+        if isinstance(distance, type(None)):
+            distance = self._distanceThreshold
+
+        window = (distance * 2) - 1
+        kernel = numpy.ones((window, window), dtype=numpy.uint8)
+
+        result_max = cv2.dilate(result, kernel)
+
+        peaks = numpy.logical_and(result >= threshold, result >= result_max)
+
+        peak_y, peak_x = numpy.nonzero(peaks)
+
+        # plateaus can return more than one point per star, keep the first in raster order
+        return self._dedupPoints(zip(peak_x.tolist(), peak_y.tolist()), result.shape, distance)
+
+
+    def _dedupPoints(self, points, shape, distance):
+        taken = numpy.zeros(shape, dtype=numpy.bool_)
+        d = distance - 1
+
+        blobs = list()
+        for x, y in points:
+            if taken[max(y - d, 0):y + d + 1, max(x - d, 0):x + d + 1].any():
+                continue
+
+            taken[y, x] = True
+            blobs.append((x, y))
+
+        return blobs
+
+
+    def _detectPyramid(self, grey_img):
+        # Find candidates on the downscaled image, then refine all of them
+        # with full resolution matches on mosaics of small windows
+        scale = 2 ** self._pyramid_level
+
+        image_height, image_width = grey_img.shape[:2]
+
+        # result coordinates at full resolution
+        result_h = image_height - self.star_template_h + 1
+        result_w = image_width - self.star_template_w + 1
+
+        # the candidate corresponds to a scale x scale block of full resolution positions, plus one block of margin
+        span = scale * 3
+
+        if result_h < span or result_w < span:
+            result = cv2.matchTemplate(grey_img, self.star_template, cv2.TM_CCOEFF_NORMED)
+            return self._findPeaks(result)
+
+
+        pyramid_img = grey_img
+        for i in range(self._pyramid_level):
+            pyramid_img = cv2.pyrDown(pyramid_img)
+
+        pyramid_result = cv2.matchTemplate(pyramid_img, self.pyramid_template, cv2.TM_CCOEFF_NORMED)
+
+
+        # local maxima above the detection threshold, duplicates are removed at full resolution
+        window = (max(int(self._distanceThreshold / scale), 1) * 2) - 1
+        pyramid_max = cv2.dilate(pyramid_result, numpy.ones((window, window), dtype=numpy.uint8))
+
+        c_y, c_x = numpy.nonzero(numpy.logical_and(pyramid_result >= self._detectionThreshold, pyramid_result >= pyramid_max))
+
+        if not len(c_x):
+            return list()
+
+
+        x1 = numpy.clip((c_x * scale) - scale, 0, result_w - span)
+        y1 = numpy.clip((c_y * scale) - scale, 0, result_h - span)
+
+        window_h = span + self.star_template_h - 1
+        window_w = span + self.star_template_w - 1
+
+        if len(x1) * window_h * window_w >= image_height * image_width:
+            # dense star field, the windows are larger than the image
+            logger.info('%d star candidates, using full resolution detection', len(x1))
+            result = cv2.matchTemplate(grey_img, self.star_template, cv2.TM_CCOEFF_NORMED)
+            return self._findPeaks(result)
+
+
+        # full resolution result for the bounding rectangle of the candidates, positions without a candidate never match
+        roi_x = int(numpy.amin(x1))
+        roi_y = int(numpy.amin(y1))
+
+        result = numpy.full((int(numpy.amax(y1)) + span - roi_y, int(numpy.amax(x1)) + span - roi_x), -1.0, dtype=numpy.float32)
+
+        mosaic_pad = numpy.zeros((self.star_template_h - 1, span), dtype=numpy.float32)
+
+        for i in range(0, len(x1), self._pyramidChunkSize):
+            chunk_x1 = x1[i:i + self._pyramidChunkSize]
+            chunk_y1 = y1[i:i + self._pyramidChunkSize]
+
+            windows = grey_img[
+                (chunk_y1[:, None] + numpy.arange(window_h))[:, :, None],
+                (chunk_x1[:, None] + numpy.arange(window_w))[:, None, :],
+            ]
+
+            # windows are stacked vertically, matches across window boundaries are discarded
+            mosaic_result = cv2.matchTemplate(windows.reshape(-1, window_w), self.star_template, cv2.TM_CCOEFF_NORMED)
+            mosaic_result = numpy.vstack((mosaic_result, mosaic_pad))
+            window_result = mosaic_result.reshape(len(chunk_x1), window_h, span)[:, :span, :]
+
+            result[
+                (chunk_y1[:, None] - roi_y + numpy.arange(span))[:, :, None],
+                (chunk_x1[:, None] - roi_x + numpy.arange(span))[:, None, :],
+            ] = window_result
+
+        return [(blob_x + roi_x, blob_y + roi_y) for blob_x, blob_y in self._findPeaks(result)]
+
+
+    def _generateSqmMaskRect(self):
+        x, y, w, h = cv2.boundingRect(self._sqm_mask)
+
+        if w < self.star_template_w or h < self.star_template_h:
+            logger.error('Star detection mask is smaller than the star template, using full frame')
+            image_height, image_width = self._sqm_mask.shape[:2]
+            x, y, w, h = 0, 0, image_width, image_height
+
+        logger.info('Star detection region: %d x %d at %d, %d', w, h, x, y)
+
+        self._sqm_mask_rect = (x, y, w, h)
+
+
+        mask_crop = self._sqm_mask[y:y + h, x:x + w]
+
+        if cv2.countNonZero(mask_crop) == w * h:
+            # rectangular mask, cropping is sufficient
+            self._sqm_mask_crop = None
+        else:
+            self._sqm_mask_crop = numpy.ascontiguousarray(mask_crop)
+
+
     def _generateSqmMask(self, img):
         logger.info('Generating mask based on SQM_ROI')
 
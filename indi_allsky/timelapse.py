@@ -5,6 +5,10 @@ from pathlib import Path
 import subprocess
 import logging
 
+import numpy
+
+from .imagePrefetch import IndiAllSkyImagePrefetch
+
 
 logger = logging.getLogger('indi_allsky')
 
@@ -12,12 +16,24 @@ logger = logging.getLogger('indi_allsky')
 
 class TimelapseGenerator(object):
 
+    # encoders listed by ffmpeg, populated on first use
+    _ffmpeg_encoders = None
+
+
     def __init__(self, config):
         self.config = config
 
         self.seqfolder = tempfile.TemporaryDirectory(suffix='_timelapse')
         self.seqfolder_p = Path(self.seqfolder.name)
 
+        # raw frames piped to ffmpeg
+        self._stream_subproc = None
+        self._stream_log = None
+        self._stream_file = None
+        self._stream_start = None
+        self._stream_size = None
+        self.stream_frame_count = 0
+
 
     def __del__(self):
         self.cleanup()
@@ -31,24 +47,169 @@ class TimelapseGenerator(object):
         file_list_ordered = sorted(file_list_nonzero, key=lambda p: p.stat().st_mtime)
 
 
-        for i, f in enumerate(file_list_ordered):
-            p_symlink = self.seqfolder_p.joinpath('{0:05d}.{1:s}'.format(i, self.config['IMAGE_FILE_TYPE']))
-            p_symlink.symlink_to(f)
+        prescale = self.config.get('FFMPEG_PRESCALE', 100)
+
+        if prescale >= 100:
+            for i, f in enumerate(file_list_ordered):
+                p_symlink = self.seqfolder_p.joinpath('{0:05d}.{1:s}'.format(i, self.config['IMAGE_FILE_TYPE']))
+                p_symlink.symlink_to(f)
 
 
+        codec = self.codec
+
+        returncode = self._generate(video_file, file_list_ordered, codec, prescale)
+
+        if returncode != 0 and codec != 'libx264':
+            logger.error('Encoding with %s failed, retrying with libx264', codec)
+            returncode = self._generate(video_file, file_list_ordered, 'libx264', prescale)
+
+
+    def _generate(self, video_file, file_list_ordered, codec, prescale):
         start = time.time()
 
+        if prescale < 100:
+            # frames are downscaled once while decoding and piped to ffmpeg
+            returncode = self._generatePrescaled(video_file, file_list_ordered, codec, prescale)
+        else:
+            cmd = [
+                'ffmpeg',
+                '-y',
+                '-f', 'image2',
+                '-r', '{0:d}'.format(self.config['FFMPEG_FRAMERATE']),
+                '-i', '{0:s}/%05d.{1:s}'.format(str(self.seqfolder_p), self.config['IMAGE_FILE_TYPE']),
+            ]
+
+            cmd.extend(self._outputOptions(video_file, codec))
+
+
+            ffmpeg_subproc = subprocess.run(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                preexec_fn=self._nice,
+            )
+
+            logger.info('FFMPEG output: %s', ffmpeg_subproc.stdout)
+
+            returncode = ffmpeg_subproc.returncode
+
+
+        elapsed_s = time.time() - start
+        logger.info('Timelapse generated in %0.4f s', elapsed_s)
+        logger.warning('Timelapse encode: %d frames, %s, %0.1f fps', len(file_list_ordered), codec, len(file_list_ordered) / elapsed_s)
+
+        return returncode
+
+
+    def _generatePrescaled(self, video_file, file_list_ordered, codec, prescale):
+        prefetch = IndiAllSkyImagePrefetch(
+            workers=self.config.get('FFMPEG_DECODE_WORKERS', 2),
+            depth=self.config.get('FFMPEG_DECODE_WORKERS', 2) * 2,
+            scale=prescale / 100,
+        )
+
+        for f, image in prefetch.read(file_list_ordered):
+            if isinstance(image, type(None)):
+                logger.error('Unable to read %s', f)
+                continue
+
+            if not self._stream_subproc:
+                image_height, image_width = image.shape[:2]
+
+                if len(image.shape) == 2:
+                    pix_fmt = 'gray'
+                else:
+                    pix_fmt = 'bgr24'
+
+                if not self.openStream(video_file, image_width, image_height, pix_fmt=pix_fmt, codec=codec):
+                    return 1
+
+            if not self.writeFrame(image) and not self._stream_subproc:
+                # ffmpeg exited
+                return 1
+
+
+        if not self._stream_subproc:
+            logger.error('No frames for timelapse')
+            return 1
+
+        return self.closeStream()
+
+
+    @property
+    def codec(self):
+        codec = self.config.get('FFMPEG_CODEC', 'libx264')
+
+        if codec == 'libx264':
+            return codec
+
+        if codec not in self._encoders():
+            logger.warning('ffmpeg encoder %s not available, using libx264', codec)
+            return 'libx264'
+
+        return codec
+
+
+    @classmethod
+    def _encoders(cls):
+        if not isinstance(cls._ffmpeg_encoders, type(None)):
+            return cls._ffmpeg_encoders
+
+        cls._ffmpeg_encoders = set()
+
+        try:
+            encoders_subproc = subprocess.run(
+                ['ffmpeg', '-hide_banner', '-encoders'],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True,
+            )
+        except OSError as e:
+            logger.error('Unable to list ffmpeg encoders: %s', str(e))
+            return cls._ffmpeg_encoders
+
+
+        # " V....D libx264              libx264 H.264 / AVC ..."
+        for line in encoders_subproc.stdout.splitlines():
+            fields = line.split()
+            if len(fields) >= 2:
+                cls._ffmpeg_encoders.add(fields[1])
+
+        return cls._ffmpeg_encoders
+
+
+    def _nice(self):
+        os.nice(int(self.config.get('FFMPEG_NICE', 19)))
+
+
+    def _outputOptions(self, video_file, codec):
         cmd = [
-            'ffmpeg',
-            '-y',
-            '-f', 'image2',
-            '-r', '{0:d}'.format(self.config['FFMPEG_FRAMERATE']),
-            '-i', '{0:s}/%05d.{1:s}'.format(str(self.seqfolder_p), self.config['IMAGE_FILE_TYPE']),
-            '-vcodec', 'libx264',
-            '-b:v', '{0:s}'.format(self.config['FFMPEG_BITRATE']),
+            '-vcodec', codec,
+        ]
+
+
+        if codec == 'libx264':
+            if self.config.get('FFMPEG_PRESET'):
+                cmd.extend(['-preset', '{0:s}'.format(self.config['FFMPEG_PRESET'])])
+
+            if self.config.get('FFMPEG_CRF') not in (None, ''):
+                # constant quality instead of bitrate, 0 is lossless
+                cmd.extend(['-crf', '{0:d}'.format(int(self.config['FFMPEG_CRF']))])
+            else:
+                cmd.extend(['-b:v', '{0:s}'.format(self.config['FFMPEG_BITRATE'])])
+        else:
+            # hardware encoders only support a bitrate
+            cmd.extend(['-b:v', '{0:s}'.format(self.config['FFMPEG_BITRATE'])])
+
+
+        if self.config.get('FFMPEG_THREADS'):
+            cmd.extend(['-threads', '{0:d}'.format(int(self.config['FFMPEG_THREADS']))])
+
+
+        cmd.extend([
             '-pix_fmt', 'yuv420p',
             '-movflags', '+faststart',
-        ]
+        ])
 
 
         # add scaling option if defined
@@ -61,21 +222,111 @@ class TimelapseGenerator(object):
         # finally add filename
         cmd.append('{0:s}'.format(str(video_file)))
 
+        return cmd
 
-        ffmpeg_subproc = subprocess.run(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            preexec_fn=lambda: os.nice(19),
-        )
 
-        elapsed_s = time.time() - start
-        logger.info('Timelapse generated in %0.4f s', elapsed_s)
+    def openStream(self, video_file, width, height, pix_fmt='bgr24', codec=None):
+        # frames are written with writeFrame() as they are produced, no intermediate files
+        if not codec:
+            codec = self.codec
+
+        cmd = [
+            'ffmpeg',
+            '-y',
+            '-f', 'rawvideo',
+            '-pix_fmt', pix_fmt,
+            '-s', '{0:d}x{1:d}'.format(width, height),
+            '-r', '{0:d}'.format(self.config['FFMPEG_FRAMERATE']),
+            '-i', '-',
+        ]
+
+        cmd.extend(self._outputOptions(video_file, codec))
+
+
+        # ffmpeg output is collected in a file, a full pipe would block the encoder
+        self._stream_log = tempfile.TemporaryFile()
+
+        try:
+            self._stream_subproc = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE,
+                stdout=self._stream_log,
+                stderr=subprocess.STDOUT,
+                preexec_fn=self._nice,
+            )
+        except OSError as e:
+            logger.error('Unable to start ffmpeg: %s', str(e))
+            self._stream_log.close()
+            self._stream_log = None
+            return False
+
+
+        self._stream_file = video_file
+        self._stream_start = time.time()
+        self._stream_size = (height, width)
+        self.stream_frame_count = 0
+
+        logger.info('Streaming %dx%d timelapse frames to %s (%s)', width, height, video_file, codec)
+
+        return True
+
+
+    @property
+    def streaming(self):
+        return bool(self._stream_subproc)
+
+
+    def writeFrame(self, image):
+        # returns True if the frame was written
+        if not self._stream_subproc:
+            return False
+
+        if image.shape[:2] != self._stream_size:
+            logger.error('Frame dimensions changed, skipping timelapse frame')
+            return False
+
+        try:
+            self._stream_subproc.stdin.write(memoryview(numpy.ascontiguousarray(image)))
+        except BrokenPipeError:
+            logger.error('ffmpeg exited, timelapse stream stopped: %s', self._stream_file)
+            self.closeStream()
+            return False
+
+        self.stream_frame_count += 1
+
+        return True
+
+
+    def closeStream(self):
+        if not self._stream_subproc:
+            return None
+
+        try:
+            self._stream_subproc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        self._stream_subproc.wait()
+
+        elapsed_s = time.time() - self._stream_start
+        logger.info('Timelapse stream of %d frames closed after %0.4f s (%0.1f fps)', self.stream_frame_count, elapsed_s, self.stream_frame_count / elapsed_s)
+
+        self._stream_log.seek(0)
+        logger.info('FFMPEG output: %s', self._stream_log.read())
+        self._stream_log.close()
+
+        returncode = self._stream_subproc.returncode
+        if returncode != 0:
+            logger.error('ffmpeg returned %d for %s', returncode, self._stream_file)
+
+        self._stream_subproc = None
+        self._stream_log = None
 
-        logger.info('FFMPEG output: %s', ffmpeg_subproc.stdout)
+        return returncode
 
 
     def cleanup(self):
         # delete all existing symlinks and sequence folder
+        self.closeStream()
         self.seqfolder.cleanup()
 
@@ -1,13 +1,23 @@
 import time
 from pathlib import Path
+from datetime import datetime
 import traceback
+import itertools
+import heapq
+import random
 import logging
 
 from multiprocessing import Process
-#from threading import Thread
+from threading import Thread
+from threading import Lock
+from threading import Condition
+from threading import Event
+from threading import BoundedSemaphore
 import queue
 
-#from .flask import db
+from flask import current_app
+
+from .flask import db
 
 from .flask.models import TaskQueueState
 from .flask.models import TaskQueueQueue
@@ -22,6 +32,34 @@ logger = logging.getLogger('indi_allsky')
 
 
 class FileUploader(Process):
+
+    queue_timeout = 5.0  # seconds to block waiting for a job
+
+    # payload: (lane, priority), lower priority values are uploaded first
+    payload_lanes = {
+        'image'     : ('fast', 0),
+        'metadata'  : ('fast', 1),
+        'mqtt'      : ('fast', 2),
+        'keogram'   : ('bulk', 3),
+        'startrail' : ('bulk', 3),
+        'video'     : ('bulk', 4),
+    }
+
+    transfer_failures = {
+        filetransfer.exceptions.ConnectionFailure            : 'Connection failure',
+        filetransfer.exceptions.AuthenticationFailure        : 'Authentication failure',
+        filetransfer.exceptions.TransferFailure              : 'Tranfer failure',
+        filetransfer.exceptions.PermissionFailure            : 'Permission failure',
+        filetransfer.exceptions.CertificateValidationFailure : 'Certificate validation failure',
+    }
+
+    # failures that may succeed later, the others need a configuration change
+    retry_failures = (
+        filetransfer.exceptions.ConnectionFailure,
+        filetransfer.exceptions.TransferFailure,
+    )
+
+
     def __init__(
         self,
         idx,
@@ -38,6 +76,39 @@ class FileUploader(Process):
         self.error_q = error_q
         self.upload_q = upload_q
 
+        # idle persistent connections by transfer class
+        self._clients = dict()
+        self._clients_lock = None
+
+        self._lane_q = dict()
+        self._lane_threads = list()
+        self._lane_exception = None
+
+        self._destination_slots = dict()
+
+        # latest task id by coalescing key, older queued tasks for the key are skipped
+        self._coalesce_latest = dict()
+        self._coalesce_lock = None
+
+        # failed uploads waiting for a retry, heap of (retry time, seq, upload dict)
+        self._spool = list()
+        self._spool_cond = None
+        self._spool_thread = None
+        self._spool_stop = False
+
+        # consecutive failures and pause time by destination
+        self._breakers = dict()
+        self._breaker_lock = None
+
+        # task state changes by task id, committed in groups
+        self._task_states = dict()
+        self._task_states_lock = None
+        self._task_commit_lock = None
+        self._task_commit_thread = None
+        self._task_commit_stop = None
+
+        self._task_seq = itertools.count()  # keeps FIFO order within a priority
+
 
     def run(self):
         ### use this as a method to log uncaught exceptions
@@ -52,180 +123,668 @@ class FileUploader(Process):
     def saferun(self):
         #raise Exception('Test exception handling in worker')
 
+        self._startLanes()
+
+        self._loadSpool()
+
         while True:
-            time.sleep(0.7)  # sleep every loop
+            if self._lane_exception:
+                self._stopLanes()
+                raise self._lane_exception
+
+
+            self._closeIdleClients()
 
             try:
-                u_dict = self.upload_q.get_nowait()
+                # block until a job is available, the timeout keeps the loop alive
+                u_dict = self.upload_q.get(timeout=self.queue_timeout)
             except queue.Empty:
                 continue
 
 
             if u_dict.get('stop'):
+                # spooled tasks stay queued in the DB and are loaded by the next uploader
+                self._stopLanes()
+                self._closeClients()
                 return
 
 
-            task_id = u_dict['task_id']
+            self._dispatch(u_dict)
 
 
-            try:
-                task = IndiAllSkyDbTaskQueueTable.query\
-                    .filter(IndiAllSkyDbTaskQueueTable.id == task_id)\
-                    .filter(IndiAllSkyDbTaskQueueTable.state == TaskQueueState.QUEUED)\
-                    .filter(IndiAllSkyDbTaskQueueTable.queue == TaskQueueQueue.UPLOAD)\
-                    .one()
-
-            except NoResultFound:
-                logger.error('Task ID %d not found', task_id)
+    def _dispatch(self, u_dict):
+        lane, priority = self.payload_lanes.get(u_dict.get('payload'), ('bulk', 3))
+
+        coalesce_key = u_dict.get('coalesce')
+        if coalesce_key and not u_dict.get('spooled'):
+            with self._coalesce_lock:
+                coalesce_entry = self._coalesce_latest.setdefault(coalesce_key, {'task_id' : u_dict['task_id'], 'pending' : 0})
+
+                # task ids only increase, a reloaded task may be older than a queued one
+                coalesce_entry['task_id'] = max(coalesce_entry['task_id'], u_dict['task_id'])
+                coalesce_entry['pending'] += 1
+
+        self._lane_q[lane].put((priority, next(self._task_seq), u_dict))
+
+
+    def _spoolWorker(self):
+        # dispatch spooled tasks when their retry time is reached
+        try:
+            with self._spool_cond:
+                while not self._spool_stop:
+                    if not self._spool:
+                        self._spool_cond.wait()
+                        continue
+
+                    retry_wait_s = self._spool[0][0] - time.time()
+                    if retry_wait_s > 0:
+                        self._spool_cond.wait(retry_wait_s)
+                        continue
+
+                    self._dispatch(heapq.heappop(self._spool)[2])
+        except Exception as e:
+            # re-raised in the main thread
+            logger.exception('Upload spool exception')
+            self._lane_exception = e
+
+
+    def _loadSpool(self):
+        # uploads waiting for a retry when the previous uploader stopped
+        spool_task_list = IndiAllSkyDbTaskQueueTable.query\
+            .filter(IndiAllSkyDbTaskQueueTable.state == TaskQueueState.QUEUED)\
+            .filter(IndiAllSkyDbTaskQueueTable.queue == TaskQueueQueue.UPLOAD)\
+            .order_by(IndiAllSkyDbTaskQueueTable.id.asc())
+
+        spool_count = 0
+        for task in spool_task_list:
+            if not task.data.get('retry'):
+                # not attempted yet, the task is still in the upload queue
                 continue
 
+            u_dict = {
+                'task_id'  : task.id,
+                'payload'  : task.data.get('payload'),
+                'coalesce' : task.data.get('coalesce'),
+            }
 
-            task.setRunning()
+            with self._spool_cond:
+                heapq.heappush(self._spool, (task.data.get('retry_after', 0.0), next(self._task_seq), u_dict))
+                self._spool_cond.notify()
 
+            spool_count += 1
 
-            action = task.data['action']
-            local_file = task.data.get('local_file')
-            remote_file = task.data.get('remote_file')
-            remove_local = task.data.get('remove_local')
+        db.session.commit()  # end the read transaction
 
-            mq_data = task.data.get('mq_data')
+        if spool_count:
+            logger.warning('Loaded %d upload tasks waiting for a retry', spool_count)
 
 
-            # Build parameters
-            if action == 'upload':
-                connect_kwargs = {
-                    'hostname'    : self.config['FILETRANSFER']['HOST'],
-                    'username'    : self.config['FILETRANSFER']['USERNAME'],
-                    'password'    : self.config['FILETRANSFER']['PASSWORD'],
-                    'private_key' : self.config['FILETRANSFER'].get('PRIVATE_KEY'),
-                    'public_key'  : self.config['FILETRANSFER'].get('PUBLIC_KEY'),
-                    'cert_bypass' : self.config['FILETRANSFER'].get('CERT_BYPASS', True),
-                }
+    def _startLanes(self):
+        # small uploads have their own threads and are never queued behind large files
+        lane_workers = {
+            'fast' : int(self.config.get('UPLOAD_WORKERS', 2)),
+            'bulk' : int(self.config.get('UPLOAD_BULK_WORKERS', 1)),
+        }
 
-                put_kwargs = {
-                    'local_file'  : Path(local_file),
-                    'remote_file' : Path(remote_file),
-                }
+        self._destination_slots = {
+            'FILETRANSFER' : BoundedSemaphore(int(self.config.get('FILETRANSFER', {}).get('MAX_TRANSFERS', 2))),
+            'MQTTPUBLISH'  : BoundedSemaphore(int(self.config.get('MQTTPUBLISH', {}).get('MAX_TRANSFERS', 1))),
+        }
 
-                try:
-                    client_class = getattr(filetransfer, self.config['FILETRANSFER']['CLASSNAME'])
-                except AttributeError:
-                    logger.error('Unknown filetransfer class: %s', self.config['FILETRANSFER']['CLASSNAME'])
-                    task.setFailed('Unknown filetransfer class: {0:s}'.format(self.config['FILETRANSFER']['CLASSNAME']))
-                    return
+        self._clients_lock = Lock()
+        self._coalesce_lock = Lock()
+        self._spool_cond = Condition()
+        self._breaker_lock = Lock()
+        self._task_states_lock = Lock()
+        self._task_commit_lock = Lock()
+        self._task_commit_stop = Event()
 
-                client = client_class(self.config)
-                client.timeout = self.config['FILETRANSFER']['TIMEOUT']
+        app = current_app._get_current_object()
 
-                if self.config['FILETRANSFER']['PORT']:
-                    client.port = self.config['FILETRANSFER']['PORT']
+        for lane, workers in lane_workers.items():
+            self._lane_q[lane] = queue.PriorityQueue()
 
-            elif action == 'mqttpub':
-                connect_kwargs = {
-                    'transport'   : self.config['MQTTPUBLISH']['TRANSPORT'],
-                    'hostname'    : self.config['MQTTPUBLISH']['HOST'],
-                    'username'    : self.config['MQTTPUBLISH']['USERNAME'],
-                    'password'    : self.config['MQTTPUBLISH']['PASSWORD'],
-                    'tls'         : self.config['MQTTPUBLISH']['TLS'],
-                    'cert_bypass' : self.config['MQTTPUBLISH'].get('CERT_BYPASS', True),
-                }
+            for x in range(max(workers, 1)):
+                lane_thread = Thread(
+                    target=self._laneWorker,
+                    args=(app, lane),
+                    name='{0:s}-{1:s}{2:d}'.format(self.name, lane, x),
+                    daemon=True,
+                )
+                lane_thread.start()
 
-                put_kwargs = {
-                    'local_file'  : Path(local_file),
-                    'base_topic'  : self.config['MQTTPUBLISH']['BASE_TOPIC'],
-                    'qos'         : self.config['MQTTPUBLISH']['QOS'],
-                    'mq_data'     : mq_data,
-                }
+                self._lane_threads.append(lane_thread)
 
-                try:
-                    client_class = getattr(filetransfer, 'paho_mqtt')
-                except AttributeError:
-                    logger.error('Unknown filetransfer class: %s', 'paho_mqtt')
-                    task.setFailed('Unknown filetransfer class: {0:s}'.format('paho_mqtt'))
-                    return
+        self._spool_thread = Thread(
+            target=self._spoolWorker,
+            name='{0:s}-spool'.format(self.name),
+            daemon=True,
+        )
+        self._spool_thread.start()
 
-                client = client_class(self.config)
+        self._task_commit_thread = Thread(
+            target=self._taskCommitWorker,
+            args=(app,),
+            name='{0:s}-commit'.format(self.name),
+            daemon=True,
+        )
+        self._task_commit_thread.start()
 
-                if self.config['MQTTPUBLISH']['PORT']:
-                    client.port = self.config['MQTTPUBLISH']['PORT']
+        logger.info('Upload lanes: %s', ', '.join(['{0:s} {1:d}'.format(k, v) for k, v in lane_workers.items()]))
 
-            else:
-                task.setFailed('Invalid transfer action')
-                raise Exception('Invalid transfer action')
 
+    def _stopLanes(self):
+        with self._spool_cond:
+            self._spool_stop = True
+            self._spool_cond.notify()
 
-            start = time.time()
+        self._spool_thread.join()
+
+        for lane_q in self._lane_q.values():
+            for x in range(len(self._lane_threads)):
+                # ahead of queued tasks, they stay queued in the DB
+                lane_q.put((-1, next(self._task_seq), None))
+
+        for lane_thread in self._lane_threads:
+            lane_thread.join()
+
+        self._lane_threads = list()
+
+        # last task states are committed before exiting
+        self._task_commit_stop.set()
+        self._task_commit_thread.join()
 
+
+    def _laneWorker(self, app, lane):
+        with app.app_context():
             try:
-                client.connect(**connect_kwargs)
-            except filetransfer.exceptions.ConnectionFailure as e:
-                logger.error('Connection failure: %s', e)
-                client.close()
-                task.setFailed('Connection failure')
-                return
-            except filetransfer.exceptions.AuthenticationFailure as e:
-                logger.error('Authentication failure: %s', e)
-                client.close()
-                task.setFailed('Authentication failure')
-                return
-            except filetransfer.exceptions.CertificateValidationFailure as e:
-                logger.error('Certificate validation failure: %s', e)
-                client.close()
-                task.setFailed('Certificate validation failure')
-                return
+                while True:
+                    priority, seq, u_dict = self._lane_q[lane].get()
+
+                    if isinstance(u_dict, type(None)):
+                        return
+
+                    spooled = False
+                    try:
+                        spooled = self._uploadTask(u_dict)
+                    finally:
+                        if not spooled:
+                            self._coalesceDone(u_dict['task_id'], u_dict.get('coalesce'))
+            except Exception as e:
+                # re-raised in the main thread
+                logger.exception('Upload lane %s exception', lane)
+                self._lane_exception = e
+            finally:
+                db.session.remove()
+
+
+    def _uploadTask(self, u_dict):
+        # returns True if the task is spooled for a retry
+        task_id = u_dict['task_id']
+        coalesce_key = u_dict.get('coalesce')
+
+        try:
+            task = IndiAllSkyDbTaskQueueTable.query\
+                .filter(IndiAllSkyDbTaskQueueTable.id == task_id)\
+                .filter(IndiAllSkyDbTaskQueueTable.state == TaskQueueState.QUEUED)\
+                .filter(IndiAllSkyDbTaskQueueTable.queue == TaskQueueQueue.UPLOAD)\
+                .one()
+
+        except NoResultFound:
+            logger.error('Task ID %d not found', task_id)
+            db.session.commit()
+            return
+
+
+        # task states are committed in groups by the commit thread, end the read transaction
+        db.session.expunge(task)
+        db.session.commit()
+
+
+        action = task.data['action']
+        local_file = task.data.get('local_file')
+        remote_file = task.data.get('remote_file')
+        remove_local = task.data.get('remove_local')
+
+        mq_data = task.data.get('mq_data')
+
+
+        latest_task_id = self._coalesceLatest(task_id, coalesce_key)
+        if latest_task_id != task_id:
+            logger.info('Upload task %d superseded by task %d (%s)', task_id, latest_task_id, coalesce_key)
+            self._setTaskState(task.id, TaskQueueState.EXPIRED, 'Superseded by task {0:d}'.format(latest_task_id))
+
+            if remove_local:
+                self._removeLocal(local_file)
+
+            return
+
+
+        # Build parameters
+        if action == 'upload':
+            connect_kwargs = {
+                'hostname'    : self.config['FILETRANSFER']['HOST'],
+                'username'    : self.config['FILETRANSFER']['USERNAME'],
+                'password'    : self.config['FILETRANSFER']['PASSWORD'],
+                'private_key' : self.config['FILETRANSFER'].get('PRIVATE_KEY'),
+                'public_key'  : self.config['FILETRANSFER'].get('PUBLIC_KEY'),
+                'cert_bypass' : self.config['FILETRANSFER'].get('CERT_BYPASS', True),
+            }
+
+            put_kwargs = {
+                'local_file'  : Path(local_file),
+                'remote_file' : Path(remote_file),
+            }
 
-            # Upload file
             try:
-                client.put(**put_kwargs)
-            except filetransfer.exceptions.ConnectionFailure as e:
-                logger.error('Connection failure: %s', e)
-                client.close()
-                task.setFailed('Connection failure')
+                client_class = getattr(filetransfer, self.config['FILETRANSFER']['CLASSNAME'])
+            except AttributeError:
+                logger.error('Unknown filetransfer class: %s', self.config['FILETRANSFER']['CLASSNAME'])
+                self._setTaskState(task.id, TaskQueueState.FAILED, 'Unknown filetransfer class: {0:s}'.format(self.config['FILETRANSFER']['CLASSNAME']))
                 return
-            except filetransfer.exceptions.AuthenticationFailure as e:
-                logger.error('Authentication failure: %s', e)
-                client.close()
-                task.setFailed('Authentication failure')
+
+            client_timeout = self.config['FILETRANSFER']['TIMEOUT']
+            client_port = self.config['FILETRANSFER']['PORT']
+
+            destination = 'FILETRANSFER'
+
+        elif action == 'mqttpub':
+            connect_kwargs = {
+                'transport'   : self.config['MQTTPUBLISH']['TRANSPORT'],
+                'hostname'    : self.config['MQTTPUBLISH']['HOST'],
+                'username'    : self.config['MQTTPUBLISH']['USERNAME'],
+                'password'    : self.config['MQTTPUBLISH']['PASSWORD'],
+                'tls'         : self.config['MQTTPUBLISH']['TLS'],
+                'cert_bypass' : self.config['MQTTPUBLISH'].get('CERT_BYPASS', True),
+            }
+
+            put_kwargs = {
+                'local_file'  : Path(local_file),
+                'base_topic'  : self.config['MQTTPUBLISH']['BASE_TOPIC'],
+                'qos'         : self.config['MQTTPUBLISH']['QOS'],
+                'mq_data'     : mq_data,
+            }
+
+            try:
+                client_class = getattr(filetransfer, 'paho_mqtt')
+            except AttributeError:
+                logger.error('Unknown filetransfer class: %s', 'paho_mqtt')
+                self._setTaskState(task.id, TaskQueueState.FAILED, 'Unknown filetransfer class: {0:s}'.format('paho_mqtt'))
                 return
-            except filetransfer.exceptions.TransferFailure as e:
-                logger.error('Tranfer failure: %s', e)
-                client.close()
-                task.setFailed('Tranfer failure')
+
+            client_timeout = None
+            client_port = self.config['MQTTPUBLISH']['PORT']
+
+            destination = 'MQTTPUBLISH'
+
+        else:
+            self._setTaskState(task.id, TaskQueueState.FAILED, 'Invalid transfer action')
+            self._commitTaskStates()
+            raise Exception('Invalid transfer action')
+
+
+        breaker_until = self._breakerOpen(destination)
+        if breaker_until:
+            # do not wait for another connection timeout
+            retry_after = breaker_until + random.uniform(0, float(self.config.get('UPLOAD_RETRY_DELAY', 10)))
+            return self._spoolTask(task, u_dict, '{0:s} unavailable'.format(destination), retry_after=retry_after)
+
+
+        self._setTaskState(task.id, TaskQueueState.RUNNING)
+
+
+        # limit parallel transfers per destination
+        with self._destination_slots[destination]:
+            start = time.time()
+
+            transfer_e = self._transfer(client_class, connect_kwargs, put_kwargs, client_port, client_timeout)
+
+            upload_elapsed_s = time.time() - start
+
+
+        if transfer_e:
+            failure = self.transfer_failures[transfer_e.__class__]
+            logger.error('%s: %s', failure, transfer_e)
+
+            if isinstance(transfer_e, self.retry_failures):
+                self._breakerFailure(destination)
+                return self._spoolTask(task, u_dict, failure)
+
+            self._setTaskState(task.id, TaskQueueState.FAILED, failure)
+
+            if remove_local:
+                self._removeLocal(local_file)
+
+            return
+
+
+        logger.info('Upload transaction completed in %0.4f s', upload_elapsed_s)
+
+        self._breakerSuccess(destination)
+
+        self._setTaskState(task.id, TaskQueueState.SUCCESS, 'File uploaded')
+
+
+        if remove_local:
+            self._removeLocal(local_file)
+
+
+        #raise Exception('Testing uncaught exception')
+
+
+    def _removeLocal(self, local_file):
+        local_file_p = Path(local_file)
+
+        try:
+            local_file_p.unlink()
+        except PermissionError as e:
+            logger.error('Cannot remove local file: %s', str(e))
+        except FileNotFoundError as e:
+            logger.error('Cannot remove local file: %s', str(e))
+
+
+    def _coalesceLatest(self, task_id, coalesce_key):
+        if not coalesce_key:
+            return task_id
+
+        with self._coalesce_lock:
+            coalesce_entry = self._coalesce_latest.get(coalesce_key)
+            if not coalesce_entry:
+                return task_id
+
+            return coalesce_entry['task_id']
+
+
+    def _coalesceDone(self, task_id, coalesce_key):
+        # forget the key once no task is pending, remote names may contain timestamps
+        if not coalesce_key:
+            return
+
+        with self._coalesce_lock:
+            coalesce_entry = self._coalesce_latest.get(coalesce_key)
+            if not coalesce_entry:
                 return
-            except filetransfer.exceptions.PermissionFailure as e:
-                logger.error('Permission failure: %s', e)
-                client.close()
-                task.setFailed('Permission failure')
+
+            coalesce_entry['pending'] -= 1
+
+            if coalesce_entry['pending'] <= 0:
+                del self._coalesce_latest[coalesce_key]
+
+
+    def _transfer(self, client_class, connect_kwargs, put_kwargs, client_port, client_timeout):
+        # returns the transfer exception on failure
+        try:
+            client = self._getClient(client_class, connect_kwargs, client_port, client_timeout)
+        except (
+            filetransfer.exceptions.ConnectionFailure,
+            filetransfer.exceptions.AuthenticationFailure,
+            filetransfer.exceptions.CertificateValidationFailure,
+        ) as e:
+            return e
+
+        # Upload file
+        try:
+            client.put(**put_kwargs)
+        except (
+            filetransfer.exceptions.ConnectionFailure,
+            filetransfer.exceptions.AuthenticationFailure,
+            filetransfer.exceptions.TransferFailure,
+            filetransfer.exceptions.PermissionFailure,
+            filetransfer.exceptions.CertificateValidationFailure,
+        ) as e:
+            self._closeClient(client)
+            return e
+
+
+        # connection is kept for the next upload
+        self._releaseClient(client)
+
+        return None
+
+
+    def _spoolTask(self, task, u_dict, failure, retry_after=None):
+        # reschedule a failed upload with exponential backoff until it is too old
+        retry = task.data.get('retry', 0)
+
+        if not retry_after:
+            retry += 1
+
+            retry_delay = min(
+                float(self.config.get('UPLOAD_RETRY_DELAY', 10)) * (2 ** (retry - 1)),
+                float(self.config.get('UPLOAD_RETRY_MAX_DELAY', 600)),
+            )
+
+            # jitter spreads out retries after an outage
+            retry_after = time.time() + (retry_delay / 2) + random.uniform(0, retry_delay / 2)
+
+
+        if task.createDate:
+            task_age_s = (datetime.now() - task.createDate).total_seconds()
+        else:
+            task_age_s = 0.0
+
+        if retry_after - time.time() + task_age_s > int(self.config.get('UPLOAD_RETRY_MAX_AGE', 14400)):
+            logger.error('Upload task %d failed after %d attempts', task.id, retry)
+            self._setTaskState(task.id, TaskQueueState.FAILED, failure)
+
+            if task.data.get('remove_local'):
+                self._removeLocal(task.data['local_file'])
+
+            return False
+
+
+        spool_data = dict(
+            task.data,
+            retry=retry,
+            retry_after=retry_after,
+            payload=u_dict.get('payload'),
+            coalesce=u_dict.get('coalesce'),
+        )
+
+        # the spool must be written before the retry
+        self._setTaskState(task.id, TaskQueueState.QUEUED, 'Retry {0:d}: {1:s}'.format(retry, failure), data=spool_data)
+        self._commitTaskStates()
+
+        spool_dict = dict(u_dict)
+        spool_dict['spooled'] = True  # already counted for coalescing
+
+        with self._spool_cond:
+            heapq.heappush(self._spool, (retry_after, next(self._task_seq), spool_dict))
+            self._spool_cond.notify()
+
+        logger.warning('Upload task %d retry %d in %0.1f s', task.id, retry, retry_after - time.time())
+
+        return True
+
+
+    def _setTaskState(self, task_id, state, result=None, data=None):
+        # only the latest state of a task is written
+        with self._task_states_lock:
+            task_state = self._task_states.setdefault(task_id, dict())
+            task_state['state'] = state
+
+            if result:
+                task_state['result'] = result
+
+            if data:
+                task_state['data'] = data
+
+
+    def _commitTaskStates(self):
+        # all pending task states in a single transaction
+        with self._task_commit_lock:
+            with self._task_states_lock:
+                task_states = self._task_states
+                self._task_states = dict()
+
+            if not task_states:
                 return
-            except filetransfer.exceptions.CertificateValidationFailure as e:
-                logger.error('Certificate validation failure: %s', e)
-                client.close()
-                task.setFailed('Certificate validation failure')
+
+            task_list = IndiAllSkyDbTaskQueueTable.query\
+                .filter(IndiAllSkyDbTaskQueueTable.id.in_(list(task_states.keys())))
+
+            for task in task_list:
+                task_state = task_states[task.id]
+
+                task.state = task_state['state']
+
+                if task_state.get('result'):
+                    task.result = task_state['result']
+
+                if task_state.get('data'):
+                    task.data = task_state['data']
+
+            db.session.commit()
+
+
+    def _taskCommitWorker(self, app):
+        commit_interval = float(self.config.get('UPLOAD_TASK_COMMIT_INTERVAL', 1.0))
+
+        with app.app_context():
+            try:
+                while not self._task_commit_stop.wait(commit_interval):
+                    self._commitTaskStates()
+
+                self._commitTaskStates()
+            except Exception as e:
+                # re-raised in the main thread
+                logger.exception('Upload task commit exception')
+                self._lane_exception = e
+            finally:
+                db.session.remove()
+
+
+    def _breakerOpen(self, destination):
+        # returns the time uploads to the destination are paused until
+        breaker_failures = int(self.config.get('UPLOAD_BREAKER_FAILURES', 3))
+        if not breaker_failures:
+            return None
+
+        now = time.time()
+
+        with self._breaker_lock:
+            breaker = self._breakers.setdefault(destination, {'failures' : 0, 'open_until' : 0.0})
+
+            if breaker['failures'] < breaker_failures:
+                return None
+
+            if now < breaker['open_until']:
+                return breaker['open_until']
+
+            # one upload tests the destination, the others keep waiting
+            breaker['open_until'] = now + int(self.config.get('UPLOAD_BREAKER_TIMEOUT', 60))
+
+        return None
+
+
+    def _breakerFailure(self, destination):
+        breaker_failures = int(self.config.get('UPLOAD_BREAKER_FAILURES', 3))
+        if not breaker_failures:
+            return
+
+        with self._breaker_lock:
+            breaker = self._breakers.setdefault(destination, {'failures' : 0, 'open_until' : 0.0})
+            breaker['failures'] += 1
+
+            if breaker['failures'] == breaker_failures:
+                breaker_timeout = int(self.config.get('UPLOAD_BREAKER_TIMEOUT', 60))
+                breaker['open_until'] = time.time() + breaker_timeout
+
+                logger.error('%s unavailable, pausing uploads for %d s', destination, breaker_timeout)
+
+
+    def _breakerSuccess(self, destination):
+        with self._breaker_lock:
+            breaker = self._breakers.get(destination)
+            if not breaker or not breaker['failures']:
                 return
 
+            if breaker['failures'] >= int(self.config.get('UPLOAD_BREAKER_FAILURES', 3)):
+                logger.warning('%s available, resuming uploads', destination)
+
+            breaker['failures'] = 0
+            breaker['open_until'] = 0.0
+
 
-            # close file transfer client
+    def _getClient(self, client_class, connect_kwargs, port, timeout):
+        client_key = client_class.__name__
+
+        while True:
+            with self._clients_lock:
+                idle_list = self._clients.get(client_key)
+                if not idle_list:
+                    break
+
+                client_entry = idle_list.pop()
+
+            if client_entry['client'].alive():
+                return client_entry['client']
+
+            logger.warning('%s connection lost, reconnecting', client_key)
+            self._closeClient(client_entry['client'])
+
+
+        client = client_class(self.config)
+
+        if timeout:
+            client.timeout = timeout
+
+        if port:
+            client.port = port
+
+
+        try:
+            client.connect(**connect_kwargs)
+        except (
+            filetransfer.exceptions.ConnectionFailure,
+            filetransfer.exceptions.AuthenticationFailure,
+            filetransfer.exceptions.CertificateValidationFailure,
+        ):
+            self._closeClient(client)
+            raise
+
+        return client
+
+
+    def _releaseClient(self, client):
+        client_entry = {
+            'client'    : client,
+            'last_used' : time.time(),
+        }
+
+        with self._clients_lock:
+            self._clients.setdefault(client.__class__.__name__, list()).append(client_entry)
+
+
+    def _closeClient(self, client):
+        try:
             client.close()
+        except Exception as e:
+            # the connection may already be gone
+            logger.warning('Error closing %s connection: %s', client.__class__.__name__, str(e))
 
-            upload_elapsed_s = time.time() - start
-            logger.info('Upload transaction completed in %0.4f s', upload_elapsed_s)
 
+    def _closeIdleClients(self):
+        idle_timeout = self.config.get('FILETRANSFER', {}).get('IDLE_TIMEOUT', 120)
 
-            task.setSuccess('File uploaded')
+        now = time.time()
 
+        idle_clients = list()
+        with self._clients_lock:
+            for client_key, idle_list in self._clients.items():
+                idle_clients.extend([e['client'] for e in idle_list if now - e['last_used'] >= idle_timeout])
+                idle_list[:] = [e for e in idle_list if now - e['last_used'] < idle_timeout]
 
-            if remove_local:
-                local_file_p = Path(local_file)
+        for client in idle_clients:
+            logger.info('Closing idle %s connection', client.__class__.__name__)
+            self._closeClient(client)
 
-                try:
-                    local_file_p.unlink()
-                except PermissionError as e:
-                    logger.error('Cannot remove local file: %s', str(e))
-                    return
-                except FileNotFoundError as e:
-                    logger.error('Cannot remove local file: %s', str(e))
-                    return
 
+    def _closeClients(self):
+        with self._clients_lock:
+            client_list = [e['client'] for idle_list in self._clients.values() for e in idle_list]
+            self._clients = dict()
 
-            #raise Exception('Testing uncaught exception')
+        for client in client_list:
+            self._closeClient(client)
 
@@ -19,6 +19,8 @@ import ephem
 from .timelapse import TimelapseGenerator
 from .keogram import KeogramGenerator
 from .starTrails import StarTrailGenerator
+from .liveProducts import IndiAllSkyLiveProducts
+from .imagePrefetch import IndiAllSkyImagePrefetch
 
 from .flask import db
 from .flask.miscDb import miscDb
@@ -49,6 +51,8 @@ class VideoWorker(Process):
 
     video_lockfile = '/tmp/timelapse_video.lock'
 
+    queue_timeout = 5.0  # seconds to block waiting for a job
+
 
     def __init__(
         self,
@@ -98,10 +102,9 @@ class VideoWorker(Process):
         #raise Exception('Test exception handling in worker')
 
         while True:
-            time.sleep(1.9)  # sleep every loop
-
             try:
-                v_dict = self.video_q.get_nowait()
+                # block until a job is available, the timeout keeps the loop alive
+                v_dict = self.video_q.get(timeout=self.queue_timeout)
             except queue.Empty:
                 continue
 
@@ -293,7 +296,7 @@ class VideoWorker(Process):
         db.session.add(task)
         db.session.commit()
 
-        self.upload_q.put({'task_id' : task.id})
+        self.upload_q.put({'task_id' : task.id, 'payload' : 'video'})
 
 
     def generateKeogramStarTrails(self, task, timespec, img_folder, timeofday, camera_id):
@@ -391,6 +394,7 @@ class VideoWorker(Process):
         kg.angle = self.config['KEOGRAM_ANGLE']
         kg.h_scale_factor = self.config['KEOGRAM_H_SCALE']
         kg.v_scale_factor = self.config['KEOGRAM_V_SCALE']
+        kg.expected_frames = image_count
 
 
 
@@ -417,22 +421,55 @@ class VideoWorker(Process):
         stg.pixel_cutoff_threshold = self.config['STARTRAILS_PIXEL_THOLD']
 
 
-        # Files are presorted from the DB
-        for i, entry in enumerate(files_entries):
-            if i % 100 == 0:
-                logger.info('Processed %d of %d images', i, image_count)
+        read_images = True
 
-            p_entry = Path(entry.getFilesystemPath())
+        live = None
+        if self.config.get('KEOGRAM_STARTRAILS_LIVE'):
+            # products built by the image worker only need to be finalized
+            live = IndiAllSkyLiveProducts(self.config, self.bin_v, mask=self._detection_mask)
+            live_frames = live.restore(camera_id, timespec, timeofday)
 
-            if not p_entry.exists():
-                logger.error('File not found: %s', p_entry)
-                continue
+            if live_frames >= image_count and live_frames > 0 and (not night or live.startrail):
+                logger.warning('Using live keogram/star trail with %d frames', live_frames)
+                kg = live.keogram
+                stg = live.startrail
+                read_images = False
+            else:
+                logger.warning('Live keogram/star trail incomplete (%d of %d frames), processing all images', live_frames, image_count)
 
-            if p_entry.stat().st_size == 0:
-                continue
 
-            #logger.info('Reading file: %s', p_entry)
-            image = cv2.imread(str(p_entry), cv2.IMREAD_UNCHANGED)
+        imread_flags = cv2.IMREAD_UNCHANGED
+        if read_images and not night and self.config['IMAGE_FILE_TYPE'] in ('jpg', 'jpeg'):
+            # keogram only, jpeg can be decoded at a reduced size when the keogram is scaled down
+            for reduction, reduced_flags in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+                if kg.v_scale_factor * reduction <= 100:
+                    logger.info('Decoding images at 1/%d size for keogram', reduction)
+                    kg.reduction = reduction
+                    imread_flags = reduced_flags
+                    break
+
+
+        prefetch = IndiAllSkyImagePrefetch(
+            workers=self.config.get('KEOGRAM_STARTRAILS_DECODE_WORKERS', 2),
+            depth=self.config.get('KEOGRAM_STARTRAILS_PREFETCH', 4),
+            imread_flags=imread_flags,
+        )
+
+
+        if read_images:
+            file_list = self._keogramStarTrailFiles(files_entries)
+
+            if night:
+                # star trail timelapse frames are piped to ffmpeg as they are produced
+                stg.timelapse_file = startrail_video_file
+        else:
+            file_list = list()
+
+
+        # Files are presorted from the DB
+        for i, (p_entry, image) in enumerate(prefetch.read(file_list)):
+            if i % 100 == 0:
+                logger.info('Processed %d of %d images', i, image_count)
 
             if isinstance(image, type(None)):
                 logger.error('Unable to read %s', p_entry)
@@ -458,10 +495,22 @@ class VideoWorker(Process):
                     timeofday=timeofday,
                 )
 
-                st_tg = TimelapseGenerator(self.config)
-                st_tg.generate(startrail_video_file, stg.timelapse_frame_list)
+                if not stg.timelapse_file:
+                    st_tg = TimelapseGenerator(self.config)
+                    st_tg.generate(startrail_video_file, stg.timelapse_frame_list)
             else:
-                logger.error('Not enough frames to generate star trails timelapse: %d', self.st_frame_count)
+                logger.error('Not enough frames to generate star trails timelapse: %d', st_frame_count)
+
+                if startrail_video_file.exists():
+                    # streamed timelapse is discarded
+                    startrail_video_file.unlink()
+
+
+        if live:
+            live.remove()
+
+
+        logger.info('Waited %0.1f s for image decoding', prefetch.wait_s)
 
 
         processing_elapsed_s = time.time() - processing_start
@@ -486,6 +535,20 @@ class VideoWorker(Process):
         task.setSuccess('Generated keogram and/or star trail')
 
 
+    def _keogramStarTrailFiles(self, files_entries):
+        for entry in files_entries:
+            p_entry = Path(entry.getFilesystemPath())
+
+            if not p_entry.exists():
+                logger.error('File not found: %s', p_entry)
+                continue
+
+            if p_entry.stat().st_size == 0:
+                continue
+
+            yield p_entry
+
+
     def uploadKeogram(self, keogram_file):
         ### Upload video
         if not self.config.get('FILETRANSFER', {}).get('UPLOAD_KEOGRAM'):
@@ -524,7 +587,7 @@ class VideoWorker(Process):
         db.session.add(task)
         db.session.commit()
 
-        self.upload_q.put({'task_id' : task.id})
+        self.upload_q.put({'task_id' : task.id, 'payload' : 'keogram'})
 
 
     def uploadStarTrail(self, startrail_file):
@@ -564,7 +627,7 @@ class VideoWorker(Process):
         db.session.add(task)
         db.session.commit()
 
-        self.upload_q.put({'task_id' : task.id})
+        self.upload_q.put({'task_id' : task.id, 'payload' : 'startrail'})
 
 
     def uploadStarTrailVideo(self, startrail_video_file):
@@ -669,7 +732,7 @@ class VideoWorker(Process):
         db.session.add(task)
         db.session.commit()
 
-        self.upload_q.put({'task_id' : task.id})
+        self.upload_q.put({'task_id' : task.id, 'payload' : 'metadata'})
 
 
     def expireData(self, task, img_folder):
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+# Compare the split/merge color processing with IndiAllSkyColorPipeline
+# (SCNR, manual + auto white balance, CLAHE) at common sensor sizes
+#
+# Each stage is checked against the old code with the same input, the
+# script exits with an AssertionError if the outputs drift apart
+
+import sys
+import time
+import argparse
+from pathlib import Path
+from collections import OrderedDict
+import logging
+
+import cv2
+import numpy
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.scnr import IndiAllskyScnr
+from indi_allsky.colorPipeline import IndiAllSkyColorPipeline
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+logging.getLogger('indi_allsky').setLevel(logging.WARNING)  # per frame messages
+
+
+class ColorPipelineTest(object):
+
+    sensor_sizes = OrderedDict({
+        'IMX290 1920x1080'  : (1080, 1920),
+        'IMX178 3096x2080'  : (2080, 3096),
+        'IMX477 4056x3040'  : (3040, 4056),
+        'IMX571 6244x4168'  : (4168, 6244),
+    })
+
+    # maximum per pixel difference for each stage, the old white balance
+    # rounds twice (manual then auto gains), the fused multiply rounds once
+    max_pixel_diff = {
+        'scnr'          : 0,
+        'white_balance' : 1,
+        'clahe'         : 0,
+    }
+
+    config = {
+        'SCNR_ALGORITHM'    : 'average_neutral',
+        'WBB_FACTOR'        : 1.1,
+        'WBG_FACTOR'        : 0.9,
+        'WBR_FACTOR'        : 1.2,
+        'AUTO_WB'           : True,
+    }
+
+
+    def __init__(self, passes):
+        self.passes = passes
+
+        self._scnr = IndiAllskyScnr(self.config)
+
+
+    def main(self):
+        for name, shape in self.sensor_sizes.items():
+            logger.info('*** %s ***', name)
+
+            # dark sky with some structure
+            image = numpy.random.normal(40, 15, size=(shape[0], shape[1], 3))
+            image = numpy.clip(image, 0, 255).astype(numpy.uint8)
+            cv2.circle(image, (shape[1] // 2, shape[0] // 2), shape[0] // 4, (200, 190, 180), -1)
+
+            color_pipeline = IndiAllSkyColorPipeline(self.config)
+
+            split_merge_s = self._time(self.split_merge, image)
+            fused_s = self._time(lambda data: self.fused(color_pipeline, data), image)
+
+            logger.info('Split/merge: %0.4f s', split_merge_s)
+            logger.info('Fused:       %0.4f s', fused_s)
+            logger.info('Savings:     %0.4f s per frame (%0.1f%%)', split_merge_s - fused_s, 100 * (split_merge_s - fused_s) / split_merge_s)
+
+            self.compare(color_pipeline, image)
+
+            # End to end differences are not checked, they include the
+            # average_neutral overflow and CLAHE amplifies the white balance rounding
+            diff = cv2.absdiff(self.split_merge(image.copy()), self.fused(color_pipeline, image.copy()))
+            logger.info('Max pixel difference: %d', int(numpy.amax(diff)))
+
+
+    def compare(self, color_pipeline, image):
+        algorithm = self.config['SCNR_ALGORITHM']
+
+        old_data = self.old_scnr(image.copy())
+        new_data = color_pipeline.scnr(color_pipeline.prepare(image.copy()), algorithm)
+
+        scnr_diff = cv2.absdiff(old_data, new_data)
+
+        if algorithm == 'average_neutral':
+            # the old average_neutral overflows when r + b > 255, only compare the pixels where it does not
+            no_overflow = (image[:, :, 2].astype(numpy.uint16) + image[:, :, 0]) <= 255
+            scnr_diff = scnr_diff[no_overflow]
+
+        self._checkDiff('scnr', scnr_diff)
+
+
+        # same input for the remaining stages
+        old_wb = self.old_white_balance(old_data.copy())
+        new_wb = color_pipeline.white_balance(old_data.copy())
+        self._checkDiff('white_balance', cv2.absdiff(old_wb, new_wb))
+
+
+        old_clahe = self.old_clahe(old_wb.copy())
+        new_clahe = color_pipeline.contrast_clahe(old_wb.copy())
+        self._checkDiff('clahe', cv2.absdiff(old_clahe, new_clahe))
+
+
+    def _checkDiff(self, stage, diff):
+        max_diff = int(numpy.amax(diff))
+        logger.info('%s max pixel difference: %d', stage, max_diff)
+
+        assert max_diff <= self.max_pixel_diff[stage], '{0:s} differs by {1:d} (max {2:d})'.format(stage, max_diff, self.max_pixel_diff[stage])
+
+
+    def _time(self, func, image):
+        elapsed_list = list()
+
+        for x in range(self.passes):
+            data = image.copy()
+
+            start = time.time()
+            func(data)
+            elapsed_list.append(time.time() - start)
+
+        return min(elapsed_list)
+
+
+    def fused(self, color_pipeline, data):
+        data = color_pipeline.prepare(data)
+        data = color_pipeline.scnr(data, self.config['SCNR_ALGORITHM'])
+        data = color_pipeline.white_balance(data)
+        data = color_pipeline.contrast_clahe(data)
+        return data
+
+
+    def split_merge(self, data):
+        # processing prior to IndiAllSkyColorPipeline
+        data = self.old_scnr(data)
+        data = self.old_white_balance(data)
+        return self.old_clahe(data)
+
+
+    def old_scnr(self, data):
+        return getattr(self._scnr, self.config['SCNR_ALGORITHM'])(data)
+
+
+    def old_white_balance(self, data):
+        # manual white balance
+        b, g, r = cv2.split(data)
+        b = cv2.multiply(b, self.config['WBB_FACTOR'])
+        g = cv2.multiply(g, self.config['WBG_FACTOR'])
+        r = cv2.multiply(r, self.config['WBR_FACTOR'])
+        data = cv2.merge([b, g, r])
+
+        # auto white balance
+        b, g, r = cv2.split(data)
+        b_avg = cv2.mean(b)[0]
+        g_avg = cv2.mean(g)[0]
+        r_avg = cv2.mean(r)[0]
+        k = (b_avg + g_avg + r_avg) / 3
+        b = cv2.addWeighted(src1=b, alpha=k / b_avg, src2=0, beta=0, gamma=0)
+        g = cv2.addWeighted(src1=g, alpha=k / g_avg, src2=0, beta=0, gamma=0)
+        r = cv2.addWeighted(src1=r, alpha=k / r_avg, src2=0, beta=0, gamma=0)
+        return cv2.merge([b, g, r])
+
+
+    def old_clahe(self, data):
+        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
+        lab = cv2.cvtColor(data, cv2.COLOR_BGR2LAB)
+        l, a, b = cv2.split(lab)
+        cl = clahe.apply(l)
+        new_lab = cv2.merge((cl, a, b))
+        return cv2.cvtColor(new_lab, cv2.COLOR_LAB2BGR)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--passes',
+        '-p',
+        help='timing passes per sensor size (fastest is reported)',
+        type=int,
+        default=5,
+    )
+
+    args = argparser.parse_args()
+
+    ct = ColorPipelineTest(args.passes)
+    ct.main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+# Accuracy report for DETECT_PYRAMID_LEVEL
+#
+# Runs star and meteor (line) detection on a folder of recorded images at
+# full resolution and at each pyramid level, and compares the results.
+# CPU time is reported per frame for each level.
+#
+# Synthetic star fields with up to 20000 stars are also detected at each
+# level, sky images rarely have more than a few hundred stars.
+
+import sys
+import time
+import json
+import argparse
+from pathlib import Path
+from collections import OrderedDict
+from multiprocessing import Value
+import logging
+
+import cv2
+import numpy
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.stars import IndiAllSkyStars
+from indi_allsky.detectLines import IndiAllskyDetectLines
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+logging.getLogger('indi_allsky').setLevel(logging.WARNING)
+
+
+class DetectPyramidTest(object):
+
+    levels = (0, 1)
+
+    match_distance = 5  # pixels, a star is matched if a full resolution star is within this distance
+
+    # synthetic star fields, same as starDetectTest.py
+    dense_width  = 4056
+    dense_height = 3040
+    dense_star_counts = (1000, 5000, 20000)
+
+
+    def __init__(self, f_config_file, image_dir):
+        if f_config_file:
+            self.config = json.loads(f_config_file.read(), object_pairs_hook=OrderedDict)
+            f_config_file.close()
+        else:
+            self.config = OrderedDict({
+                'IMAGE_FOLDER'          : '/tmp',
+                'DETECT_STARS_THOLD'    : 0.6,
+                'SQM_ROI'               : [],
+            })
+
+        self.config['DETECT_DRAW'] = False
+
+        self.image_dir = Path(image_dir)
+
+
+    def main(self):
+        image_list = sorted([p for p in self.image_dir.iterdir() if p.suffix.lower() in ('.jpg', '.jpeg', '.png')])
+        if not image_list:
+            logger.error('No images found in %s', self.image_dir)
+            sys.exit(1)
+
+        logger.info('Found %d images', len(image_list))
+
+
+        detectors = OrderedDict()
+        for level in self.levels:
+            level_config = OrderedDict(self.config)
+            level_config['DETECT_PYRAMID_LEVEL'] = level
+
+            detectors[level] = {
+                'stars'  : IndiAllSkyStars(level_config, Value('i', 1)),
+                'lines'  : IndiAllskyDetectLines(level_config, Value('i', 1)),
+            }
+
+
+        stats = OrderedDict()
+        for level in self.levels:
+            stats[level] = {
+                'stars'             : 0,
+                'stars_matched'     : 0,
+                'star_count_err'    : list(),
+                'line_frames'       : 0,
+                'line_frames_agree' : 0,
+                'stars_s'           : 0.0,
+                'lines_s'           : 0.0,
+            }
+
+
+        for image_p in image_list:
+            image = cv2.imread(str(image_p), cv2.IMREAD_UNCHANGED)
+            if isinstance(image, type(None)):
+                logger.error('Unable to read %s', image_p)
+                continue
+
+            frame_results = dict()
+            for level in self.levels:
+                start = time.process_time()
+                blobs = detectors[level]['stars'].detectObjects(image)
+                stats[level]['stars_s'] += time.process_time() - start
+
+                start = time.process_time()
+                lines = detectors[level]['lines'].detectLines(image)
+                stats[level]['lines_s'] += time.process_time() - start
+
+                frame_results[level] = (blobs, len(lines) > 0)
+
+
+            full_blobs, full_lines = frame_results[0]
+
+            for level in self.levels:
+                blobs, has_lines = frame_results[level]
+
+                stats[level]['stars'] += len(blobs)
+                stats[level]['stars_matched'] += self.matchStars(blobs, full_blobs)
+                stats[level]['star_count_err'].append(len(blobs) - len(full_blobs))
+
+                stats[level]['line_frames'] += int(has_lines)
+                stats[level]['line_frames_agree'] += int(has_lines == full_lines)
+
+            logger.info('%s: %s', image_p.name, ', '.join(['L{0:d} {1:d} stars'.format(l, len(frame_results[l][0])) for l in self.levels]))
+
+
+        self.report(stats, len(image_list))
+
+        self.denseFields()
+
+
+    def denseFields(self):
+        mask = numpy.full((self.dense_height, self.dense_width), 255, dtype=numpy.uint8)
+
+        detectors = OrderedDict()
+        for level in self.levels:
+            level_config = OrderedDict(self.config)
+            level_config['DETECT_PYRAMID_LEVEL'] = level
+            level_config['SQM_ROI'] = []
+
+            detectors[level] = IndiAllSkyStars(level_config, Value('i', 1), mask=mask)
+
+
+        logger.info('Synthetic star fields: %d x %d', self.dense_width, self.dense_height)
+        logger.info('%-6s %10s %10s %10s %10s %12s', 'level', 'field', 'stars', 'matched', 'recall', 'stars cpu ms')
+
+        for star_count in self.dense_star_counts:
+            image = self.starField(star_count)
+
+            level_blobs = OrderedDict()
+            for level in self.levels:
+                start = time.process_time()
+                blobs = detectors[level].detectObjects(image)
+                elapsed_s = time.process_time() - start
+
+                level_blobs[level] = blobs
+
+                matched = self.matchStars(blobs, level_blobs[0])
+                if level_blobs[0]:
+                    recall = matched / len(level_blobs[0])
+                else:
+                    recall = 1.0
+
+                logger.info('%-6d %10d %10d %10d %9.1f%% %12.1f', level, star_count, len(blobs), matched, recall * 100, 1000 * elapsed_s)
+
+
+    def starField(self, star_count):
+        image = numpy.random.normal(20, 2, size=(self.dense_height, self.dense_width))
+        image = numpy.clip(image, 0, 255).astype(numpy.uint8)
+
+        x = numpy.random.randint(10, self.dense_width - 10, size=star_count)
+        y = numpy.random.randint(10, self.dense_height - 10, size=star_count)
+        brightness = numpy.random.randint(80, 255, size=star_count)
+
+        for star_x, star_y, star_b in zip(x.tolist(), y.tolist(), brightness.tolist()):
+            cv2.circle(image, (star_x, star_y), 3, star_b, cv2.FILLED)
+
+        return cv2.GaussianBlur(image, (5, 5), 0)
+
+
+    def matchStars(self, blobs, full_blobs):
+        # number of full resolution stars that were also found
+        if not full_blobs or not blobs:
+            return 0
+
+        blob_array = numpy.array(blobs, dtype=numpy.float32)
+
+        matched = 0
+        for full_blob in full_blobs:
+            distance = numpy.amax(numpy.abs(blob_array - full_blob), axis=1)
+            if numpy.amin(distance) <= self.match_distance:
+                matched += 1
+
+        return matched
+
+
+    def report(self, stats, frame_count):
+        full_stars = stats[0]['stars']
+
+        logger.info('Frames: %d', frame_count)
+        logger.info('%-6s %10s %10s %10s %12s %12s %10s %12s %12s', 'level', 'stars', 'matched', 'recall', 'count err', 'line frames', 'agree', 'stars cpu ms', 'lines cpu ms')
+
+        for level, level_stats in stats.items():
+            if full_stars:
+                recall = level_stats['stars_matched'] / full_stars
+            else:
+                recall = 1.0
+
+            logger.info(
+                '%-6d %10d %10d %9.1f%% %12.1f %12d %9.1f%% %12.1f %12.1f',
+                level,
+                level_stats['stars'],
+                level_stats['stars_matched'],
+                recall * 100,
+                numpy.mean(numpy.abs(level_stats['star_count_err'])),
+                level_stats['line_frames'],
+                100 * level_stats['line_frames_agree'] / frame_count,
+                1000 * level_stats['stars_s'] / frame_count,
+                1000 * level_stats['lines_s'] / frame_count,
+            )
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        'image_dir',
+        help='folder of recorded jpg/png images',
+        type=str,
+    )
+    argparser.add_argument(
+        '--config',
+        '-c',
+        help='config file (SQM_ROI, DETECT_STARS_THOLD)',
+        type=argparse.FileType('r'),
+    )
+
+    args = argparser.parse_args()
+
+    dt = DetectPyramidTest(args.config, args.image_dir)
+    dt.main()
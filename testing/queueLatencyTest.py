@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+# Frame received to image written latency, before and after blocking queues
+#
+# Frames are put on a queue at the exposure period, the same way newBLOB
+# queues them.  A worker process takes each frame, writes a JPEG and reports
+# the latency.  The previous loop sleeps before every get_nowait(), the
+# current loop blocks in get() with a timeout.  Worker loop wakeups are
+# counted to show the idle cost.
+
+import time
+import queue
+import tempfile
+import argparse
+from pathlib import Path
+from collections import OrderedDict
+from multiprocessing import Process
+from multiprocessing import Queue
+import logging
+
+import cv2
+import numpy
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+
+class QueueLatencyTest(object):
+
+    width  = 1920
+    height = 1080
+
+    # ImageWorker.saferun() before and after the change
+    loops = OrderedDict({
+        'sleep 0.05 s + get_nowait()' : 0.05,
+        'get(timeout=5.0)'            : None,
+    })
+
+    # histogram buckets (seconds)
+    latency_buckets = (0.025, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5)
+
+
+    def __init__(self, frames, period):
+        self.frames = frames
+        self.period = period
+
+
+    def main(self):
+        results = OrderedDict()
+
+        for name, sleep_s in self.loops.items():
+            logger.info('*** %s, %d frames every %0.2f s ***', name, self.frames, self.period)
+            results[name] = self.run(sleep_s)
+
+
+        for name, (latency_list, wakeups, elapsed_s) in results.items():
+            self.report(name, latency_list, wakeups, elapsed_s)
+
+
+    def run(self, sleep_s):
+        image_q = Queue()
+        result_q = Queue()
+
+        worker = LatencyWorker(image_q, result_q, sleep_s, self.width, self.height)
+        worker.start()
+
+        time.sleep(1.0)  # worker startup
+
+
+        start = time.time()
+
+        # frames arrive at a random offset to the worker loop
+        next_frame_time = time.time() + numpy.random.uniform(0, self.period)
+        for i in range(self.frames):
+            time.sleep(max(next_frame_time - time.time(), 0))
+
+            image_q.put({'exp_time' : time.time()})
+
+            next_frame_time += self.period + numpy.random.uniform(-0.1, 0.1) * self.period
+
+
+        latency_list = [result_q.get() for i in range(self.frames)]
+        elapsed_s = time.time() - start
+
+        image_q.put({'stop' : True})
+        wakeups = result_q.get()
+
+        worker.join()
+
+        return latency_list, wakeups, elapsed_s
+
+
+    def report(self, name, latency_list, wakeups, elapsed_s):
+        latency_array = numpy.array(latency_list)
+
+        hist = [0] * (len(self.latency_buckets) + 1)
+        for latency_s in latency_list:
+            for i, bucket in enumerate(self.latency_buckets):
+                if latency_s <= bucket:
+                    hist[i] += 1
+                    break
+            else:
+                hist[-1] += 1
+
+        hist_str_list = ['<={0:0.3f}s: {1:d}'.format(b, c) for b, c in zip(self.latency_buckets, hist)]
+        hist_str_list.append('>{0:0.3f}s: {1:d}'.format(self.latency_buckets[-1], hist[-1]))
+
+        logger.info('%s', name)
+        logger.info('  Latency histogram: %s', ', '.join(hist_str_list))
+        logger.info(
+            '  Latency mean %0.4f s, p50 %0.4f s, p95 %0.4f s, max %0.4f s',
+            numpy.mean(latency_array),
+            numpy.percentile(latency_array, 50),
+            numpy.percentile(latency_array, 95),
+            numpy.amax(latency_array),
+        )
+        logger.info('  Worker loop wakeups: %d (%0.1f/s)', wakeups, wakeups / elapsed_s)
+
+
+class LatencyWorker(Process):
+
+    queue_timeout = 5.0
+
+
+    def __init__(self, image_q, result_q, sleep_s, width, height):
+        super(LatencyWorker, self).__init__()
+
+        self.name = 'LatencyWorker000'
+
+        self.image_q = image_q
+        self.result_q = result_q
+        self.sleep_s = sleep_s
+
+        self.image = numpy.random.randint(40, 60, size=(height, width, 3), dtype=numpy.uint8)
+
+
+    def run(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        image_p = Path(tmp_dir.name).joinpath('latest.jpg')
+
+        wakeups = 0
+
+        while True:
+            wakeups += 1
+
+            if self.sleep_s:
+                time.sleep(self.sleep_s)  # sleep every loop
+
+                try:
+                    i_dict = self.image_q.get_nowait()
+                except queue.Empty:
+                    continue
+            else:
+                try:
+                    i_dict = self.image_q.get(timeout=self.queue_timeout)
+                except queue.Empty:
+                    continue
+
+
+            if i_dict.get('stop'):
+                self.result_q.put(wakeups)
+                break
+
+
+            cv2.imwrite(str(image_p), self.image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+
+            self.result_q.put(time.time() - i_dict['exp_time'])
+
+
+        tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--frames',
+        '-f',
+        help='frames per loop',
+        type=int,
+        default=100,
+    )
+    argparser.add_argument(
+        '--period',
+        '-p',
+        help='seconds between frames',
+        type=float,
+        default=0.5,
+    )
+
+    args = argparser.parse_args()
+
+    qt = QueueLatencyTest(args.frames, args.period)
+    qt.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# Time star detection peak extraction on synthetic star fields
+#
+# The previous nested loop de-duplication is O(candidates x stars) and is
+# skipped above --legacy-max stars
+
+import sys
+import time
+import argparse
+from pathlib import Path
+from multiprocessing import Value
+import logging
+
+import cv2
+import numpy
+
+sys.path.append(str(Path(__file__).parent.absolute().parent))
+
+from indi_allsky.stars import IndiAllSkyStars
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging
+
+logging.getLogger('indi_allsky').setLevel(logging.WARNING)
+
+
+class StarDetectTest(object):
+
+    width  = 4056
+    height = 3040
+
+    star_counts = (1000, 5000, 20000)
+
+    config = {
+        'IMAGE_FOLDER'          : '/tmp',
+        'DETECT_STARS_THOLD'    : 0.6,
+        'DETECT_DRAW'           : False,
+        'SQM_ROI'               : [],
+    }
+
+
+    def __init__(self, legacy_max):
+        self.legacy_max = legacy_max
+
+        # full frame
+        mask = numpy.full((self.height, self.width), 255, dtype=numpy.uint8)
+
+        self._stars = IndiAllSkyStars(self.config, Value('i', 1), mask=mask)
+
+
+    def main(self):
+        for star_count in self.star_counts:
+            logger.info('*** %d stars, %d x %d ***', star_count, self.width, self.height)
+
+            image = self.starField(star_count)
+
+            result = cv2.matchTemplate(image, self._stars.star_template, cv2.TM_CCOEFF_NORMED)
+
+            start = time.time()
+            blobs = self._stars._findPeaks(result)
+            peaks_elapsed_s = time.time() - start
+
+            logger.info('Non-maximum suppression: %d objects in %0.4f s', len(blobs), peaks_elapsed_s)
+
+
+            if star_count > self.legacy_max:
+                logger.info('Nested loop: skipped')
+                continue
+
+            start = time.time()
+            legacy_blobs = self.nestedLoop(result)
+            legacy_elapsed_s = time.time() - start
+
+            logger.info('Nested loop: %d objects in %0.4f s (%0.1fx)', len(legacy_blobs), legacy_elapsed_s, legacy_elapsed_s / peaks_elapsed_s)
+
+
+    def starField(self, star_count):
+        image = numpy.random.normal(20, 2, size=(self.height, self.width))
+        image = numpy.clip(image, 0, 255).astype(numpy.uint8)
+
+        x = numpy.random.randint(10, self.width - 10, size=star_count)
+        y = numpy.random.randint(10, self.height - 10, size=star_count)
+        brightness = numpy.random.randint(80, 255, size=star_count)
+
+        for star_x, star_y, star_b in zip(x.tolist(), y.tolist(), brightness.tolist()):
+            cv2.circle(image, (star_x, star_y), 3, star_b, cv2.FILLED)
+
+        return cv2.GaussianBlur(image, (5, 5), 0)
+
+
+    def nestedLoop(self, result):
+        # de-duplication prior to _findPeaks()
+        result_filter = numpy.where(result >= self._stars._detectionThreshold)
+
+        blobs = list()
+        for pt in zip(*result_filter[::-1]):
+            for blob in blobs:
+                if (abs(pt[0] - blob[0]) < self._stars._distanceThreshold) and (abs(pt[1] - blob[1]) < self._stars._distanceThreshold):
+                    break
+
+            else:
+                blobs.append(pt)
+
+        return blobs
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--legacy-max',
+        help='largest star count to time with the nested loop',
+        type=int,
+        default=5000,
+    )
+
+    args = argparser.parse_args()
+
+    st = StarDetectTest(args.legacy_max)
+    st.main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+# Show latest image uploads are not blocked by a large upload
+#
+# A local FTP stand-in with a limited transfer rate receives one large video
+# followed by an image every second.  The upload queue is run twice, once with
+# every task in a single lane (previous behavior) and once with payload lanes.
+
+import sys
+import io
+import types
+import time
+import socket
+import socketserver
+import tempfile
+import argparse
+from pathlib import Path
+from threading import Thread
+from multiprocessing import Queue
+import logging
+
+# indi_allsky/__init__.py pulls in the camera clients (PyIndi), only the
+# uploader and the flask models are needed
+indi_allsky = types.ModuleType('indi_allsky')
+indi_allsky.__path__ = [str(Path(__file__).parent.absolute().parent.joinpath('indi_allsky'))]
+sys.modules['indi_allsky'] = indi_allsky
+
+from indi_allsky.uploader import FileUploader  # noqa: E402
+from indi_allsky.flask import create_app  # noqa: E402
+from indi_allsky.flask import db  # noqa: E402
+from indi_allsky.flask.models import TaskQueueState  # noqa: E402
+from indi_allsky.flask.models import TaskQueueQueue  # noqa: E402
+from indi_allsky.flask.models import IndiAllSkyDbTaskQueueTable  # noqa: E402
+
+
+logger = logging.getLogger('indi_allsky')
+
+LOG_HANDLER_STREAM = logging.StreamHandler()
+LOG_HANDLER_STREAM.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(threadName)s %(funcName)s() #%(lineno)d: %(message)s'))
+
+logger.handlers.clear()  # remove syslog
+logger.addHandler(LOG_HANDLER_STREAM)
+logger.setLevel(logging.WARNING)
+
+
+
+class FtpStandInHandler(socketserver.StreamRequestHandler):
+    # just enough FTP for ftplib uploads, data is discarded
+
+    rate = 2 * 1024 * 1024  # bytes per second per transfer
+
+
+    def handle(self):
+        self.pasv_sock = None
+        self.reply('220 indi-allsky FTP stand-in')
+
+        for line in self.rfile:
+            cmd, _, arg = line.decode().strip().partition(' ')
+            cmd = cmd.upper()
+
+            if cmd == 'USER':
+                self.reply('331 Password required')
+            elif cmd == 'PASS':
+                self.reply('230 Logged in')
+            elif cmd in ('TYPE', 'NOOP', 'SITE'):
+                self.reply('200 OK')
+            elif cmd == 'MKD':
+                self.reply('257 Created')
+            elif cmd == 'PASV':
+                self.pasv()
+            elif cmd == 'STOR':
+                self.stor()
+            elif cmd == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Not implemented')
+
+
+    def reply(self, msg):
+        self.wfile.write('{0:s}\r\n'.format(msg).encode())
+
+
+    def pasv(self):
+        self.pasv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.pasv_sock.bind(('127.0.0.1', 0))
+        self.pasv_sock.listen(1)
+
+        port = self.pasv_sock.getsockname()[1]
+        self.reply('227 Entering Passive Mode (127,0,0,1,{0:d},{1:d})'.format(port >> 8, port & 0xff))
+
+
+    def stor(self):
+        self.reply('150 Ok to send data')
+
+        data_sock, addr = self.pasv_sock.accept()
+        self.pasv_sock.close()
+
+        chunk_size = 65536
+        while True:
+            data = data_sock.recv(chunk_size)
+            if not data:
+                break
+
+            time.sleep(len(data) / self.rate)
+
+        data_sock.close()
+
+        self.reply('226 Transfer complete')
+
+
+
+class UploadLanesTest(object):
+
+    video_size = 16 * 1024 * 1024
+    image_size = 150 * 1024
+    image_count = 8
+
+
+    def __init__(self, rate):
+        FtpStandInHandler.rate = rate
+
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix='indi_allsky_upload_')
+        self.tmp_dir_p = Path(self.tmp_dir.name)
+
+
+    def main(self):
+        ftp_server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), FtpStandInHandler)
+        ftp_server.daemon_threads = True
+
+        ftp_thread = Thread(target=ftp_server.serve_forever, daemon=True)
+        ftp_thread.start()
+
+        ftp_port = ftp_server.server_address[1]
+        logger.warning('FTP stand-in on port %d at %0.1f MB/s', ftp_port, FtpStandInHandler.rate / 1024 / 1024)
+
+
+        # file database, the upload threads use separate connections
+        flask_config = {
+            'SQLALCHEMY_DATABASE_URI'        : 'sqlite:///{0:s}'.format(str(self.tmp_dir_p.joinpath('upload.sqlite'))),
+            'SQLALCHEMY_TRACK_MODIFICATIONS' : False,
+            'SECRET_KEY'                     : 'upload',
+            'MIGRATION_FOLDER'               : str(self.tmp_dir_p.joinpath('migrations')),
+        }
+
+        app = create_app(config_overrides=flask_config)
+        app.app_context().push()
+
+
+        config = {
+            'UPLOAD_WORKERS'      : 2,
+            'UPLOAD_BULK_WORKERS' : 1,
+            'UPLOAD_TASK_COMMIT_INTERVAL' : 0.1,  # latency is measured from the task state
+            'FILETRANSFER' : {
+                'CLASSNAME'     : 'python_ftp',
+                'HOST'          : '127.0.0.1',
+                'PORT'          : ftp_port,
+                'USERNAME'      : 'allsky',
+                'PASSWORD'      : 'allsky',
+                'TIMEOUT'       : 30.0,
+                'CERT_BYPASS'   : True,
+                'MAX_TRANSFERS' : 2,
+            },
+        }
+
+
+        video_p = self.tmp_dir_p.joinpath('allsky-timelapse.mp4')
+        with io.open(str(video_p), 'wb') as f_video:
+            f_video.write(b'\0' * self.video_size)
+
+        image_p = self.tmp_dir_p.joinpath('latest.jpg')
+        with io.open(str(image_p), 'wb') as f_image:
+            f_image.write(b'\0' * self.image_size)
+
+
+        results = dict()
+        for lanes in (False, True):
+            results[lanes] = self.run(config, lanes, video_p, image_p)
+
+        ftp_server.shutdown()
+
+
+        for lanes, (video_s, image_latency) in results.items():
+            logger.warning(
+                '%-12s video %5.1f s, image latency avg %5.2f s, max %5.2f s',
+                'lanes' if lanes else 'single lane',
+                video_s,
+                sum(image_latency) / len(image_latency),
+                max(image_latency),
+            )
+
+
+    def run(self, config, lanes, video_p, image_p):
+        error_q = Queue()
+        upload_q = Queue()
+
+        # the uploader process must not share the sqlite connection
+        db.session.remove()
+        db.engine.dispose()
+
+        uploader = FileUploader(0, config, error_q, upload_q)
+        uploader.start()
+
+
+        queued = dict()
+
+        video_id = self.addTask(upload_q, video_p, 'video', lanes)
+        queued[video_id] = time.time()
+
+        time.sleep(0.5)
+
+        image_ids = list()
+        for x in range(self.image_count):
+            image_id = self.addTask(upload_q, image_p, 'image', lanes)
+            queued[image_id] = time.time()
+            image_ids.append(image_id)
+
+            time.sleep(1.0)
+
+
+        finished = dict()
+        while len(finished) < len(queued):
+            for task_id in set(queued.keys()) - set(finished.keys()):
+                task = IndiAllSkyDbTaskQueueTable.query.get(task_id)
+                db.session.refresh(task)
+
+                if task.state in (TaskQueueState.SUCCESS, TaskQueueState.FAILED):
+                    finished[task_id] = time.time()
+
+            time.sleep(0.05)
+
+
+        upload_q.put({'stop' : True})
+        uploader.join()
+
+        image_latency = [finished[i] - queued[i] for i in image_ids]
+
+        return finished[video_id] - queued[video_id], image_latency
+
+
+    def addTask(self, upload_q, local_file_p, payload, lanes):
+        jobdata = {
+            'action'      : 'upload',
+            'local_file'  : str(local_file_p),
+            'remote_file' : '/allsky/{0:s}'.format(local_file_p.name),
+        }
+
+        task = IndiAllSkyDbTaskQueueTable(
+            queue=TaskQueueQueue.UPLOAD,
+            state=TaskQueueState.QUEUED,
+            data=jobdata,
+        )
+        db.session.add(task)
+        db.session.commit()
+
+        if lanes:
+            upload_q.put({'task_id' : task.id, 'payload' : payload})
+        else:
+            # no payload, everything is uploaded in order by one thread
+            upload_q.put({'task_id' : task.id})
+
+        return task.id
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--rate',
+        '-r',
+        help='FTP stand-in transfer rate in MB/s',
+        type=float,
+        default=2.0,
+    )
+
+    args = argparser.parse_args()
+
+    ut = UploadLanesTest(int(args.rate * 1024 * 1024))
+    ut.main()